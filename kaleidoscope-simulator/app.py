@@ -1,24 +1,106 @@
 
-from flask import Flask, request, jsonify, render_template, send_file
+from flask import Flask, request, jsonify, render_template, send_file, Response, g
 from flask_socketio import SocketIO, emit
 import json
 import os
 import sys
+import tempfile
+import time
 from datetime import datetime
 import numpy as np
 
 # プロジェクトルートをパスに追加
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from models.kaleidoscope_simulator import KaleidoscopeSimulator
-from models.optical_engine import Material, PhysicsMode
+from models.kaleidoscope_simulator import KaleidoscopeSimulator, ADAPTIVE_MAX_RAYS
+from models.optical_engine import (Material, PhysicsMode, ColorMode, TraceSolver, PathPolicy,
+                                   DEFAULT_SURVIVAL_PROBABILITY, check_spectral_samples,
+                                   check_survival_probability)
+from models.sampling import SamplingMode
+from models.inline_config import is_inline_config
+from models.realtime_session import RealtimeSession
+from models.frame_scheduler import (FrameMailbox, SimulationPool, DEFAULT_MAX_FPS,
+                                    DEFAULT_REALTIME_WORKERS)
+from models.job_queue import SimulationJobQueue, DEFAULT_JOB_MAX_RAYS
+from models.result_encoding import encode_simulation_binary, BINARY_MIMETYPE
+from models.rasterizer import PatternRasterizer, parse_tile
+from models.result_cache import SimulationResultCache, CACHE_BYPASS
+from models.profiling import StageTimer, ProfileStore, summarize_performance
+from models.metrics import MetricsRegistry, METRICS_MIMETYPE
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'kaleidoscope_secret_key_2024'
 socketio = SocketIO(app, cors_allowed_origins="*")
 
+# 決定的なシミュレーション結果のキャッシュ（シリアライズ済みレスポンスを保持）
+result_cache = SimulationResultCache(
+    max_bytes=int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+
+# 単一リクエストのプロファイル取得（?profile=1）と tracemalloc によるメモリ計測。
+# プロファイルは内部のパスやコードの構造を含み、リクエストも遅くなるため既定では無効
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '0') == '1'
+TRACE_MEMORY = os.environ.get('TRACE_MEMORY', '0') == '1'
+profile_store = ProfileStore(
+    os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'kaleidoscope-profiles')),
+    max_profiles=int(os.environ.get('PROFILE_MAX_FILES', 20)))
+
+# Prometheus 形式のメトリクス（METRICS_DIR を指定すると複数ワーカーの値を合算して出力）
+metrics = MetricsRegistry(os.environ.get('METRICS_DIR'))
+request_latency = metrics.histogram(
+    'kaleidoscope_http_request_duration_seconds', 'HTTP request latency in seconds',
+    ('endpoint', 'method', 'status'))
+simulation_rays = metrics.counter(
+    'kaleidoscope_simulation_rays_total', 'Initial rays traced', ('source',))
+simulation_seconds = metrics.counter(
+    'kaleidoscope_simulation_seconds_total', 'Time spent in simulation runs', ('source',))
+simulation_throughput = metrics.histogram(
+    'kaleidoscope_simulation_rays_per_second', 'Initial rays traced per second per run',
+    ('source',), buckets=(1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6))
+simulation_bounces = metrics.histogram(
+    'kaleidoscope_simulation_bounces_per_ray', 'Average path segments per initial ray per run',
+    ('source',), buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20))
+cache_requests = metrics.counter(
+    'kaleidoscope_cache_requests_total', 'Cache lookups by cache and result', ('cache', 'result'))
+websocket_clients = metrics.gauge(
+    'kaleidoscope_websocket_connected_clients', 'Connected WebSocket clients')
+websocket_frames = metrics.counter(
+    'kaleidoscope_websocket_frames_total', 'Frames emitted to WebSocket clients', ('event',))
+websocket_dropped_frames = metrics.counter(
+    'kaleidoscope_websocket_dropped_frames_total',
+    'Realtime requests not rendered (coalesced into a newer request or dropped on disconnect)',
+    ('reason',))
+
 # グローバルシミュレーターインスタンス
-simulator = KaleidoscopeSimulator()
+simulator = KaleidoscopeSimulator(writer_options={
+    'batch_size': int(os.environ.get('RESULT_WRITER_BATCH_SIZE', 64)),
+    'flush_interval': float(os.environ.get('RESULT_WRITER_FLUSH_INTERVAL', 1.0)),
+    'max_queue_size': int(os.environ.get('RESULT_WRITER_QUEUE_SIZE', 1024)),
+    'overflow_policy': os.environ.get('RESULT_WRITER_OVERFLOW_POLICY', 'drop_oldest')
+})
+
+def observe_simulation(performance, source):
+    """シミュレーション1回分の性能指標をメトリクスに記録"""
+    simulation_rays.inc(performance['initial_rays'], source=source)
+    simulation_seconds.inc(performance['computation_time'], source=source)
+    simulation_throughput.observe(performance['rays_per_sec'], source=source)
+    simulation_bounces.observe(performance['avg_bounces'], source=source)
+    cache_requests.inc(cache='config', result='hit' if performance['config_cache_hit'] else 'miss')
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """エンドポイントごとのレイテンシと結果キャッシュの状態を記録"""
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_latency.observe(time.perf_counter() - start, endpoint=endpoint,
+                                method=request.method, status=response.status_code)
+    if 'X-Cache' in response.headers:
+        cache_requests.inc(cache='result', result=response.headers['X-Cache'].lower())
+    return response
 
 @app.route('/')
 def index():
@@ -112,54 +194,311 @@ def get_materials():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def wants_binary_response() -> bool:
+    """バイナリ形式での応答が要求されているか（?format=binary または Accept ヘッダー）"""
+    if request.args.get('format') == 'binary':
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE])
+    return best == BINARY_MIMETYPE
+
+def profiling_options(data):
+    """
+    リクエストのプロファイル指定の解釈
+
+    Returns:
+        (cProfile を取得するか, tracemalloc でメモリを計測するか)
+    """
+    profile = PROFILING_ENABLED and (request.args.get('profile') == '1'
+                                     or bool(data.get('profile', False)))
+    trace_memory = profile or bool(data.get('trace_memory', TRACE_MEMORY))
+    return profile, trace_memory
+
+def adaptive_options(data):
+    """
+    リクエストの適応サンプリング指定の解釈
+
+    Returns:
+        noise_target・time_budget_ms・max_rays の辞書。どちらの目標も
+        指定されていなければ None（num_rays 固定で実行する）
+    """
+    noise_target = data.get('noise_target')
+    time_budget_ms = data.get('time_budget_ms')
+    if noise_target is None and time_budget_ms is None:
+        return None
+    return {
+        'noise_target': None if noise_target is None else float(noise_target),
+        'time_budget_ms': None if time_budget_ms is None else float(time_budget_ms),
+        'max_rays': max(1, int(data.get('max_rays', ADAPTIVE_MAX_RAYS)))
+    }
+
+def simulate_request(config_id, num_rays, max_bounces, adaptive, **options):
+    """num_rays 固定、または adaptive（adaptive_options の結果）に従って適応的に実行"""
+    if adaptive is None:
+        return simulator.run_simulation(config_id, num_rays, max_bounces, **options)
+    # 適応サンプリングはバッチを順に追跡するためワーカー数は使わない
+    options.pop('workers', None)
+    return simulator.run_adaptive_simulation(config_id, max_bounces=max_bounces,
+                                             **adaptive, **options)
+
+def request_config(data):
+    """
+    リクエストの設定の解決
+
+    config_id が null で設定の内容（mirror_count・material_ids・light_sources）を含む
+    場合は、DBに保存しないインライン設定として検証して返す。それ以外は設定ID（既定 1）。
+    """
+    if is_inline_config(data):
+        return simulator.build_inline_config(data)
+    return data.get('config_id') or 1
+
+def cached_response(config_id, params, compute, bypass=False):
+    """
+    決定的なリクエスト（seed 指定あり）の結果キャッシュと同時リクエストの集約
+
+    compute は (ペイロード, mimetype, 追加ヘッダー) を返す。seed がない場合、
+    時間予算の指定がある場合（結果が実行速度に依存する）と bypass が True の
+    場合は毎回計算する。
+    """
+    if bypass or params.get('seed') is None or params.get('time_budget_ms') is not None:
+        value, status = compute(), CACHE_BYPASS
+    else:
+        fingerprint = simulator.config_fingerprint(simulator.prepare_config(config_id)['config'])
+        key = result_cache.make_key(fingerprint, **params)
+        # インライン設定は設定IDによる無効化の対象外（キーは内容のハッシュ）
+        value, status = result_cache.get_or_compute(
+            key, compute, config_id=None if isinstance(config_id, dict) else config_id)
+
+    payload, mimetype, headers = value
+    response = Response(payload, mimetype=mimetype)
+    response.headers.update(headers)
+    response.headers['X-Cache'] = status
+    return response
+
+def instrumented_response(config_id, params, compute, profile=False):
+    """
+    cached_response に cProfile の取得を加えたもの
+
+    profile が True の場合はキャッシュを使わずに計算し、取得したプロファイルの
+    ダウンロードURLを X-Profile-Url ヘッダーで返す。
+    """
+    if not profile:
+        return cached_response(config_id, params, compute)
+
+    with profile_store.capture() as capture:
+        response = cached_response(config_id, params, compute, bypass=True)
+    response.headers['X-Profile-Id'] = capture.profile_id
+    response.headers['X-Profile-Url'] = f'/api/profiles/{capture.profile_id}.prof'
+    return response
+
+def serialize_simulation_binary(result, ray_buffer, ray_rgb, projected) -> bytes:
+    """シミュレーション結果をバイナリ形式に変換"""
+    return encode_simulation_binary(
+        ray_buffer,
+        ray_rgb,
+        projected,
+        result['surfaces'],
+        {
+            'performance': result['performance'],
+            'bounds': simulator.calculate_projection_bounds(projected)
+        })
+
+def serialize_simulation_json(result, ray_buffer, ray_rgb, projected) -> bytes:
+    """シミュレーション結果をJSONに変換"""
+    # 光線を列ごとに変換
+    ray_paths_serializable = [
+        {
+            'origin': origin,
+            'direction': direction,
+            'wavelength': wavelength,
+            'intensity': intensity,
+            'rgb': rgb
+        }
+        for origin, direction, wavelength, intensity, rgb in zip(
+            ray_buffer.origins.tolist(), ray_buffer.directions.tolist(),
+            ray_buffer.wavelengths.tolist(), ray_buffer.intensities.tolist(),
+            ray_rgb.tolist())
+    ]
+
+    # 表面情報も変換
+    surfaces_serializable = []
+    for surface in result['surfaces']:
+        surface_data = {
+            'point': surface.point.tolist(),
+            'normal': surface.normal.tolist(),
+            'material_id': surface.material_id
+        }
+        surfaces_serializable.append(surface_data)
+
+    # パターンデータの生成
+    pattern_data = simulator.create_pattern_visualization_data(result['ray_paths'], projected)
+
+    response = {
+        'success': True,
+        'simulation_result': {
+            'ray_paths': ray_paths_serializable,  # 表示用に制限
+            'surfaces': surfaces_serializable,
+            'pattern_data': pattern_data,
+            'performance': result['performance']
+        }
+    }
+
+    return jsonify(response).get_data()
+
 @app.route('/api/simulate', methods=['POST'])
 def run_simulation():
     """シミュレーション実行"""
     try:
         data = request.json
-        config_id = data.get('config_id', 1)
+        config_id = request_config(data)
         num_rays = data.get('num_rays', 100)
         max_bounces = data.get('max_bounces', 10)
+        workers = max(1, min(int(data.get('workers', 1)), os.cpu_count() or 1))
+        seed = data.get('seed')
+        color_mode = ColorMode(data.get('color_mode', ColorMode.LINEAR.value))
+        solver = TraceSolver(data.get('solver', TraceSolver.BOUNCE.value))
+        sampling = SamplingMode(data.get('sampling', SamplingMode.RANDOM.value))
+        policy = PathPolicy(data.get('policy', PathPolicy.THRESHOLD.value))
+        survival_probability = float(data.get('survival_probability', DEFAULT_SURVIVAL_PROBABILITY))
+        spectral_samples = int(data.get('spectral_samples', 0))
+        adaptive = adaptive_options(data)
+        binary = wants_binary_response()
+        profile, trace_memory = profiling_options(data)
 
-        # シミュレーション実行
-        result = simulator.run_simulation(config_id, num_rays, max_bounces)
-
-        # Numpy配列を通常のリストに変換
-        ray_paths_serializable = []
-        for ray in result['ray_paths']:
-            ray_data = {
-                'origin': ray.origin.tolist(),
-                'direction': ray.direction.tolist(),
-                'wavelength': float(ray.wavelength),
-                'intensity': float(ray.intensity),
-                'rgb': simulator.engine.calculate_wavelength_to_rgb(ray.wavelength)
-            }
-            ray_paths_serializable.append(ray_data)
-
-        # 表面情報も変換
-        surfaces_serializable = []
-        for surface in result['surfaces']:
-            surface_data = {
-                'point': surface.point.tolist(),
-                'normal': surface.normal.tolist(),
-                'material_id': surface.material_id
-            }
-            surfaces_serializable.append(surface_data)
-
-        # パターンデータの生成
-        pattern_data = simulator.create_pattern_visualization_data(result['ray_paths'])
-
-        response = {
-            'success': True,
-            'simulation_result': {
-                'ray_paths': ray_paths_serializable[:500],  # 表示用に制限
-                'surfaces': surfaces_serializable,
-                'pattern_data': pattern_data,
-                'performance': result['performance']
+        def compute():
+            timer = StageTimer(trace_memory=trace_memory)
+            with timer:
+                # シミュレーション実行（結果の保存はシリアライズ後）
+                result = simulate_request(config_id, num_rays, max_bounces, adaptive,
+                                          workers=workers, seed=seed, timer=timer,
+                                          save=False, solver=solver, sampling=sampling,
+                                          policy=policy, survival_probability=survival_probability,
+                                          spectral_samples=spectral_samples)
+                observe_simulation(result['performance'], 'simulate')
+
+                with timer.stage('projection'):
+                    # 表示用に先頭の光線だけを使う
+                    ray_buffer = result['ray_paths'][:500]
+                    ray_rgb = simulator.ray_colors(ray_buffer, color_mode)
+                    projected = simulator.project_pattern(result['ray_paths'], color_mode)
+
+                with timer.stage('serialization'):
+                    if binary:
+                        value = (serialize_simulation_binary(result, ray_buffer, ray_rgb, projected),
+                                 BINARY_MIMETYPE, {})
+                    else:
+                        value = (serialize_simulation_json(result, ray_buffer, ray_rgb, projected),
+                                 'application/json', {})
+
+            simulator.save_simulation_result(config_id, timer, result['performance'])
+            return value
+
+        return instrumented_response(config_id, {
+            'endpoint': 'simulate',
+            'num_rays': num_rays,
+            'max_bounces': max_bounces,
+            'workers': workers,
+            'seed': seed,
+            'color_mode': color_mode.value,
+            'solver': solver.value,
+            'sampling': sampling.value,
+            'policy': policy.value,
+            'survival_probability': survival_probability,
+            'spectral_samples': spectral_samples,
+            **(adaptive or {}),
+            'binary': binary
+        }, compute, profile)
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/render', methods=['POST'])
+def render_pattern():
+    """シミュレーション結果をサーバー側で画像化して返す（PNG または RGB8 の生データ）"""
+    try:
+        data = request.json
+        config_id = request_config(data)
+        num_rays = data.get('num_rays', 10000)
+        max_bounces = data.get('max_bounces', 10)
+        workers = max(1, min(int(data.get('workers', 1)), os.cpu_count() or 1))
+        seed = data.get('seed')
+        width = max(1, min(int(data.get('width', 512)), 4096))
+        height = max(1, min(int(data.get('height', 512)), 4096))
+        extent = float(data.get('extent', 2.0))
+        exposure = float(data.get('exposure', 1.0))
+        symmetry = bool(data.get('symmetry', True))
+        color_mode = ColorMode(data.get('color_mode', ColorMode.LINEAR.value))
+        solver = TraceSolver(data.get('solver', TraceSolver.BOUNCE.value))
+        sampling = SamplingMode(data.get('sampling', SamplingMode.RANDOM.value))
+        policy = PathPolicy(data.get('policy', PathPolicy.THRESHOLD.value))
+        survival_probability = float(data.get('survival_probability', DEFAULT_SURVIVAL_PROBABILITY))
+        spectral_samples = int(data.get('spectral_samples', 0))
+        adaptive = adaptive_options(data)
+        image_format = data.get('format', 'png')
+        tile = data.get('tile')
+        if tile is not None:
+            try:
+                tile = parse_tile(tile, width, height)
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+
+        profile, trace_memory = profiling_options(data)
+
+        def compute():
+            timer = StageTimer(trace_memory=trace_memory)
+            with timer:
+                result = simulate_request(config_id, num_rays, max_bounces, adaptive,
+                                          workers=workers, seed=seed, timer=timer,
+                                          save=False, solver=solver, sampling=sampling,
+                                          policy=policy, survival_probability=survival_probability,
+                                          spectral_samples=spectral_samples)
+                observe_simulation(result['performance'], 'render')
+
+                with timer.stage('projection'):
+                    projected = simulator.project_pattern(result['ray_paths'], color_mode)
+
+                with timer.stage('rasterization'):
+                    rasterizer = PatternRasterizer(width, height, extent=extent, exposure=exposure)
+                    mirror_count = result['config']['mirror_count'] if symmetry else 1
+                    rasterizer.accumulate(projected, mirror_count)
+
+                with timer.stage('serialization'):
+                    if image_format == 'raw':
+                        payload, (out_width, out_height) = rasterizer.encode_raw(tile)
+                        mimetype = BINARY_MIMETYPE
+                    else:
+                        payload, (out_width, out_height) = rasterizer.encode_png(tile)
+                        mimetype = 'image/png'
+
+            simulator.save_simulation_result(config_id, timer, result['performance'])
+
+            return payload, mimetype, {
+                'X-Image-Width': str(out_width),
+                'X-Image-Height': str(out_height),
+                'X-Ray-Count': str(result['performance']['ray_count']),
+                'X-Computation-Time': f"{result['performance']['computation_time']:.6f}"
             }
-        }
 
-        return jsonify(response)
+        return instrumented_response(config_id, {
+            'endpoint': 'render',
+            'num_rays': num_rays,
+            'max_bounces': max_bounces,
+            'workers': workers,
+            'seed': seed,
+            'width': width,
+            'height': height,
+            'extent': extent,
+            'exposure': exposure,
+            'symmetry': symmetry,
+            'color_mode': color_mode.value,
+            'solver': solver.value,
+            'sampling': sampling.value,
+            'policy': policy.value,
+            'survival_probability': survival_probability,
+            'spectral_samples': spectral_samples,
+            **(adaptive or {}),
+            'format': image_format,
+            'tile': tile
+        }, compute, profile)
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -206,9 +545,24 @@ def create_config():
                     light_source['type']
                 ))
 
+            # 有限の反射面の挿入
+            for surface in data.get('surfaces', []):
+                cursor.execute("""
+                    INSERT INTO config_surfaces (config_id, vertices, material_id)
+                    VALUES (?, ?, ?)
+                """, (
+                    config_id,
+                    json.dumps(surface['vertices']),
+                    surface['material_id']
+                ))
+
             conn.commit()
 
-            return jsonify({'success': True, 'config_id': config_id})
+        # 同じIDの古いキャッシュが残らないよう無効化
+        simulator.invalidate_config(config_id)
+        result_cache.invalidate_config(config_id)
+
+        return jsonify({'success': True, 'config_id': config_id})
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -217,9 +571,22 @@ def create_config():
 def get_performance_history():
     """パフォーマンス履歴の取得"""
     try:
+        # ステージ別集計の対象にする直近の結果件数
+        window = max(1, min(int(request.args.get('window', 500)), 5000))
+
         import sqlite3
         with sqlite3.connect(simulator.db_path) as conn:
             cursor = conn.cursor()
+            cursor.execute("""
+                SELECT config_id, performance_data
+                FROM simulation_results
+                ORDER BY id DESC
+                LIMIT ?
+            """, (window,))
+            stage_summary = summarize_performance(
+                (config_id, json.loads(performance_data))
+                for config_id, performance_data in cursor.fetchall() if performance_data)
+
             cursor.execute("""
                 SELECT sr.timestamp, sr.ray_count, sr.computation_time, 
                        sr.quality_score, kc.name
@@ -239,40 +606,403 @@ def get_performance_history():
                     'config_name': row[4]
                 })
 
-            return jsonify({'success': True, 'history': history})
+            return jsonify({
+                'success': True,
+                'history': history,
+                'stages': stage_summary,
+                'config_cache': simulator.config_cache.stats(),
+                'geometry_cache': simulator.geometry_cache.stats(),
+                'path_cache': simulator.path_cache.stats(),
+                'result_cache': result_cache.stats(),
+                'result_writer': (simulator.result_writer.stats()
+                                  if simulator.result_writer else None),
+                'jobs': job_queue.stats()
+            })
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/profiles/<profile_id>.prof', methods=['GET'])
+def download_profile(profile_id):
+    """?profile=1 で取得したプロファイル (.prof) のダウンロード"""
+    path = profile_store.path_for(profile_id) if PROFILING_ENABLED else None
+    if path is None:
+        return jsonify({'success': False, 'error': 'Profile not found'}), 404
+    return send_file(path, mimetype=BINARY_MIMETYPE, as_attachment=True,
+                     download_name=f'simulation-{profile_id}.prof')
+
+def observe_job_batch(batch_rays, batch_time, segments):
+    """ジョブのバッチ1回分の性能指標をメトリクスに記録"""
+    simulation_rays.inc(batch_rays, source='job')
+    simulation_seconds.inc(batch_time, source='job')
+    if batch_time > 0:
+        simulation_throughput.observe(batch_rays / batch_time, source='job')
+    simulation_bounces.observe(segments / batch_rays, source='job')
+
+# 大規模なオフライン描画のジョブキュー（状態は simulation_jobs テーブル、結果は JOB_RESULT_DIR の .npz）
+# ジョブはイベントループの外のスレッドで実行し、対話的なエンドポイントを止めない
+job_queue = SimulationJobQueue(
+    simulator,
+    os.environ.get('JOB_RESULT_DIR', os.path.join(tempfile.gettempdir(), 'kaleidoscope-jobs')),
+    workers=int(os.environ.get('JOB_WORKERS', 1)),
+    pool=SimulationPool(max(1, int(os.environ.get('JOB_WORKERS', 1))), socketio.async_mode),
+    spawn=socketio.start_background_task,
+    sleep=socketio.sleep,
+    poll_interval=float(os.environ.get('JOB_POLL_INTERVAL', 1.0)),
+    max_rays=int(os.environ.get('JOB_MAX_RAYS', DEFAULT_JOB_MAX_RAYS)),
+    on_batch=observe_job_batch)
+# ワーカーはインポート時には起動しない（テストやツールの読み込みでDBに書き込まないため）。
+# 開発サーバーは下の __main__ で、gunicorn は post_worker_init で job_queue.start() を呼ぶ
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """オフライン描画ジョブの登録（結果は GET /api/jobs/<id>/result で取得）"""
+    try:
+        job = job_queue.submit(request.json)
+        response = jsonify({'success': True, 'job': job})
+        response.status_code = 202
+        response.headers['Location'] = f"/api/jobs/{job['id']}"
+        return response
+
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """ジョブ一覧（新しい順。?status= で状態を絞り込む）"""
+    try:
+        jobs = job_queue.list(request.args.get('status'), int(request.args.get('limit', 50)))
+        return jsonify({'success': True, 'jobs': jobs})
+
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """ジョブの状態と進捗（追跡した初期光線数）"""
+    try:
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'success': False, 'error': 'Job not found'}), 404
+        return jsonify({'success': True, 'job': job})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """ジョブの中断（実行中のジョブは次のバッチの後で止まる）"""
+    try:
+        job = job_queue.cancel(job_id)
+        if job is None:
+            return jsonify({'success': False, 'error': 'Job not found'}), 404
+        return jsonify({'success': True, 'job': job})
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def download_job_result(job_id):
+    """完了したジョブの結果（np.savez_compressed の .npz）のダウンロード"""
+    path = job_queue.result_path(job_id)
+    if path is None:
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'success': False, 'error': 'Job not found'}), 404
+        return jsonify({'success': False, 'error': f"Job is {job['status']}",
+                        'job': job}), 409
+    return send_file(path, mimetype=BINARY_MIMETYPE, as_attachment=True,
+                     download_name=f'kaleidoscope-job-{job_id}.npz')
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus テキスト形式のメトリクス"""
+    return Response(metrics.render(), content_type=METRICS_MIMETYPE)
+
+class ProgressiveJob:
+    """セッションごとのプログレッシブ描画ジョブ（蓄積バッファと中断フラグを保持）"""
+
+    def __init__(self, sid, rasterizer):
+        self.sid = sid
+        self.rasterizer = rasterizer
+        self.cancelled = False
+
+# 実行中のプログレッシブ描画ジョブ（セッションID → ジョブ）
+progressive_jobs = {}
+
+def cancel_progressive_job(sid):
+    """セッションの実行中ジョブを中断"""
+    job = progressive_jobs.pop(sid, None)
+    if job is not None:
+        job.cancelled = True
+
+def trace_progressive_pass(job, batches, mirror_count, color_mode):
+    """
+    プログレッシブ描画の1パス分の追跡・蓄積・PNG の符号化（プールのスレッドで実行）
+
+    Returns:
+        (反射を含む光線数, 追跡済みの初期光線数, 追跡の秒数, (PNG, (幅, 高さ)))。
+        目標の光線数まで追跡し終えていれば None
+    """
+    batch_start = time.perf_counter()
+    batch = next(batches, None)
+    if batch is None:
+        return None
+    ray_buffer, traced = batch
+    batch_time = time.perf_counter() - batch_start
+
+    job.rasterizer.accumulate(simulator.project_pattern(ray_buffer, color_mode), mirror_count)
+    return len(ray_buffer), traced, batch_time, job.rasterizer.encode_png()
+
+def run_progressive_job(job, config_id, target_rays, batch_size, max_bounces, seed,
+                        color_mode=ColorMode.LINEAR, solver=TraceSolver.BOUNCE,
+                        sampling=SamplingMode.RANDOM, policy=PathPolicy.THRESHOLD,
+                        survival_probability=DEFAULT_SURVIVAL_PROBABILITY, spectral_samples=0):
+    """小さなバッチを追跡して蓄積し、パスごとに途中経過の画像を送信（追跡はプールのスレッドで行う）"""
+    try:
+        prepared = realtime_pool.run(simulator.prepare_config, config_id)
+        mirror_count = prepared['config']['mirror_count']
+        start_time = time.time()
+        passes = 0
+        previous_traced = 0
+        batches = simulator.iter_ray_batches(
+            config_id, target_rays, batch_size, max_bounces, seed,
+            growth=2.0, max_batch_size=max(batch_size, target_rays // 8), solver=solver,
+            sampling=sampling, policy=policy, survival_probability=survival_probability,
+            spectral_samples=spectral_samples)
+
+        # パスごとにプールのスロットを返し、他のクライアントのフレームを間に挟めるようにする
+        while not job.cancelled:
+            result = realtime_pool.run(trace_progressive_pass, job, batches, mirror_count,
+                                       color_mode)
+            if result is None or job.cancelled:
+                return
+            ray_count, traced, batch_time, (image, (width, height)) = result
+
+            batch_rays = traced - previous_traced
+            simulation_rays.inc(batch_rays, source='progressive')
+            simulation_seconds.inc(batch_time, source='progressive')
+            if batch_time > 0:
+                simulation_throughput.observe(batch_rays / batch_time, source='progressive')
+            simulation_bounces.observe(ray_count / batch_rays, source='progressive')
+            previous_traced = traced
+            passes += 1
+
+            socketio.emit('simulation_progress', {
+                'image': image,
+                'width': width,
+                'height': height,
+                'pass': passes,
+                'samples': traced,
+                'target_samples': target_rays,
+                'elapsed_time': time.time() - start_time,
+                'done': traced >= target_rays
+            }, to=job.sid)
+            websocket_frames.inc(event='simulation_progress')
+
+            # 他のクライアントと中断要求を処理できるようイベントループに制御を返す
+            socketio.sleep(0)
+
+    except Exception as e:
+        socketio.emit('simulation_error', {'error': str(e)}, to=job.sid)
+
+    finally:
+        if progressive_jobs.get(job.sid) is job:
+            del progressive_jobs[job.sid]
+
+def run_progressive_jobs(client):
+    """メールボックスの最新のプログレッシブ描画だけを順に実行（要求がなくなれば終了）"""
+    while True:
+        # realtime_simulation と同じく、届いている要求のハンドラーを先に実行させる
+        socketio.sleep(client.progressive.wait_time())
+        message = client.progressive.take()
+        if message is None:
+            return
+
+        job, args = message
+        if job.cancelled:
+            continue
+        run_progressive_job(job, *args)
+        client.progressive.complete()
+
+# リアルタイム描画の最大フレームレート（セッションごと）と、シミュレーションを
+# イベントループの外で同時に実行するスレッド数
+REALTIME_MAX_FPS = float(os.environ.get('REALTIME_MAX_FPS', DEFAULT_MAX_FPS))
+realtime_pool = SimulationPool(int(os.environ.get('REALTIME_WORKERS', DEFAULT_REALTIME_WORKERS)),
+                               socketio.async_mode)
+
+class RealtimeClient:
+    """接続ごとのリアルタイム描画の状態（差分の基準と再利用する状態・最新の要求のメールボックス）"""
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.session = RealtimeSession(simulator)
+        self.mailbox = FrameMailbox(
+            REALTIME_MAX_FPS, on_drop=lambda reason: websocket_dropped_frames.inc(reason=reason))
+        # プログレッシブ描画の要求（描画中に届いた要求は最新のものだけを次に実行する）
+        self.progressive = FrameMailbox(
+            REALTIME_MAX_FPS, on_drop=lambda reason: websocket_dropped_frames.inc(reason=reason))
+
+# リアルタイム描画の接続（セッションID → RealtimeClient）
+realtime_clients = {}
+
+def get_realtime_client(sid):
+    """接続の状態の取得（なければ作成）"""
+    client = realtime_clients.get(sid)
+    if client is None:
+        client = realtime_clients[sid] = RealtimeClient(sid)
+    return client
+
+def close_realtime_client(sid):
+    """接続の終了（処理待ちの要求は捨てる）"""
+    client = realtime_clients.pop(sid, None)
+    if client is not None:
+        client.mailbox.close()
+        client.progressive.close()
+
+def simulate_realtime_frame(session, data):
+    """
+    リアルタイム描画の1フレーム分のシミュレーションとパターンデータの生成（プールのスレッドで実行）
+
+    結果は保存しない（書き込みスレッドは hub 側で起動・使用する必要があるため、
+    呼び出し側が save_simulation_result で保存する）。
+
+    Returns:
+        (フレーム, 設定IDまたはインライン設定)
+    """
+    config_id = request_config(data)
+    num_rays = data.get('num_rays', 50)  # リアルタイム用に軽量化
+    max_bounces = data.get('max_bounces', 5)
+    seed = data.get('seed')
+    solver = TraceSolver(data.get('solver', TraceSolver.BOUNCE.value))
+    sampling = SamplingMode(data.get('sampling', SamplingMode.RANDOM.value))
+    policy = PathPolicy(data.get('policy', PathPolicy.THRESHOLD.value))
+    survival_probability = float(data.get('survival_probability', DEFAULT_SURVIVAL_PROBABILITY))
+    spectral_samples = int(data.get('spectral_samples', 0))
+
+    # シミュレーション実行（noise_target・time_budget_ms 指定時は適応的に光線数を決める。
+    # それ以外は前のフレームの初期光線と反射の幾何を再利用する）
+    options = dict(seed=seed, save=False, solver=solver, sampling=sampling, policy=policy,
+                   survival_probability=survival_probability,
+                   spectral_samples=spectral_samples)
+    adaptive = adaptive_options(data)
+    if adaptive is None:
+        result = session.simulate(config_id, num_rays, max_bounces, **options)
+    else:
+        result = simulate_request(config_id, num_rays, max_bounces, adaptive, **options)
+
+    return {
+        'pattern_data': simulator.create_pattern_visualization_data(result['ray_paths']),
+        'performance': result['performance']
+    }, config_id
+
+def run_realtime_frames(client):
+    """メールボックスの最新の要求だけを最大フレームレート以下で処理して送信（要求がなくなれば終了）"""
+    while True:
+        # 待ち時間がなくてもイベントループに制御を返し、届いている要求のハンドラーを先に
+        # 実行させる（eventlet では post と take が同じ hub で動くため、譲らないと集約されない）
+        socketio.sleep(client.mailbox.wait_time())
+        data = client.mailbox.take()
+        if data is None:
+            return
+
+        try:
+            frame, config_id = realtime_pool.run(simulate_realtime_frame, client.session, data)
+        except Exception as e:
+            socketio.emit('simulation_error', {'error': str(e)}, to=client.sid)
+            continue
+
+        observe_simulation(frame['performance'], 'realtime')
+        simulator.save_simulation_result(config_id, performance=frame['performance'])
+        if client.mailbox.complete():
+            frame['performance']['frames'] = client.mailbox.stats()
+            socketio.emit('simulation_result', frame, to=client.sid)
+            websocket_frames.inc(event='simulation_result')
+
 # WebSocket イベントハンドラ
 @socketio.on('connect')
 def handle_connect():
     print('Client connected')
+    websocket_clients.inc()
     emit('connected', {'data': 'Connected to kaleidoscope simulator'})
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print('Client disconnected')
+    websocket_clients.dec()
+    cancel_progressive_job(request.sid)
+    close_realtime_client(request.sid)
 
 @socketio.on('realtime_simulation')
 def handle_realtime_simulation(data):
-    """リアルタイムシミュレーション"""
+    """
+    リアルタイムシミュレーション
+
+    'delta' を含むメッセージはセッションの前のリクエストへの差分として適用し、
+    それ以外のメッセージはリクエスト全体として差分の基準にする。要求は接続ごとの
+    メールボックスに入れ、処理が追いつかない間に届いた要求は最新のものだけを
+    イベントループの外で処理する（REALTIME_MAX_FPS 以下のフレームレート）。
+    """
     try:
-        config_id = data.get('config_id', 1)
-        num_rays = data.get('num_rays', 50)  # リアルタイム用に軽量化
-        max_bounces = data.get('max_bounces', 5)
+        # 新しい要求が来たら実行中のプログレッシブ描画は不要
+        cancel_progressive_job(request.sid)
 
-        # シミュレーション実行
-        result = simulator.run_simulation(config_id, num_rays, max_bounces)
+        # 差分はここで基準に反映するため、途中の要求を捨てても変更は失われない
+        client = get_realtime_client(request.sid)
+        if 'delta' in data:
+            data = client.session.apply_delta(data['delta'])
+        else:
+            data = client.session.set_base(data)
 
-        # パターンデータの生成
-        pattern_data = simulator.create_pattern_visualization_data(result['ray_paths'])
+        if client.mailbox.post(data):
+            socketio.start_background_task(run_realtime_frames, client)
 
-        # 結果を送信
-        emit('simulation_result', {
-            'pattern_data': pattern_data,
-            'performance': result['performance']
-        })
+    except Exception as e:
+        emit('simulation_error', {'error': str(e)})
+
+@socketio.on('progressive_simulation')
+def handle_progressive_simulation(data):
+    """
+    プログレッシブ描画（小さなバッチごとに途中経過を送信）
+
+    realtime_simulation と同じく要求は接続ごとのメールボックスに入れ、描画中に届いた
+    要求は最新のものだけを次に実行する。バッチの追跡はイベントループの外で行う。
+    """
+    try:
+        # 同じクライアントの前の要求は破棄する
+        cancel_progressive_job(request.sid)
+
+        config_id = request_config(data)
+        target_rays = max(1, int(data.get('target_rays', 20000)))
+        batch_size = max(1, int(data.get('batch_size', 500)))
+        max_bounces = data.get('max_bounces', 5)
+        seed = data.get('seed')
+        width = max(1, min(int(data.get('width', 512)), 2048))
+        height = max(1, min(int(data.get('height', 512)), 2048))
+        extent = float(data.get('extent', 2.0))
+        color_mode = ColorMode(data.get('color_mode', ColorMode.LINEAR.value))
+        solver = TraceSolver(data.get('solver', TraceSolver.BOUNCE.value))
+        sampling = SamplingMode(data.get('sampling', SamplingMode.RANDOM.value))
+        policy = PathPolicy(data.get('policy', PathPolicy.THRESHOLD.value))
+        survival_probability = float(data.get('survival_probability', DEFAULT_SURVIVAL_PROBABILITY))
+        check_survival_probability(survival_probability)
+        spectral_samples = int(data.get('spectral_samples', 0))
+        check_spectral_samples(spectral_samples)
+
+        # 不正な要求でジョブが残らないよう、すべての項目を検証してから登録する
+        job = ProgressiveJob(request.sid, PatternRasterizer(width, height, extent=extent))
+        progressive_jobs[request.sid] = job
+
+        client = get_realtime_client(request.sid)
+        if client.progressive.post((job, (config_id, target_rays, batch_size, max_bounces, seed,
+                                          color_mode, solver, sampling, policy,
+                                          survival_probability, spectral_samples))):
+            socketio.start_background_task(run_progressive_jobs, client)
 
     except Exception as e:
         emit('simulation_error', {'error': str(e)})
@@ -281,6 +1011,9 @@ def handle_realtime_simulation(data):
 def handle_config_update(data):
     """設定更新時のリアルタイム反映"""
     try:
+        # 設定が変わったので実行中のプログレッシブ描画は中断
+        cancel_progressive_job(request.sid)
+
         # 設定変更を他のクライアントにブロードキャスト
         emit('config_updated', data, broadcast=True)
 
@@ -288,5 +1021,6 @@ def handle_config_update(data):
         emit('update_error', {'error': str(e)})
 
 if __name__ == '__main__':
+    job_queue.start()
     # 開発サーバーとして起動
     socketio.run(app, debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,70 @@
+from typing import Dict, Optional
+
+import numpy as np
+
+
+class ConvergenceMonitor:
+    """
+    投影パターンの収束（ノイズ）をバッチごとに推定するクラス
+
+    各バッチの投影点を観察面上の粗い格子に強度で集計し、バッチ平均法で
+    平均画像の標準誤差を求める。初期光線の強度は光線数で割ってあるため、
+    n_b 本のバッチ b の画像 h_b はそれ自体が画像の独立な推定値で、分散は
+    光線1本あたりの分散 σ² の 1/n_b になる。そこで σ² をバッチ間のばらつきから
+    推定し、光線数で重み付けした平均画像の分散 σ²/N を得る。
+    バッチの大きさが異なっていてもよい。
+    """
+
+    def __init__(self, bins: int = 32, extent: float = 2.0):
+        """
+        Args:
+            bins: 格子の1辺のビン数
+            extent: 格子の中心から端までの観察面上の距離
+        """
+        self.bins = bins
+        self.extent = extent
+        self.batches = 0
+        self.ray_count = 0
+        # ビンごとの Σ n_b h_b と Σ n_b h_b²
+        self._sum = np.zeros((bins, bins))
+        self._sum_squares = np.zeros((bins, bins))
+
+    def add_batch(self, projected: Dict[str, np.ndarray], initial_rays: int):
+        """
+        1バッチ分の投影結果を加える
+
+        Args:
+            projected: project_pattern の出力
+            initial_rays: このバッチの初期光線数
+        """
+        if initial_rays <= 0:
+            return
+        image, _, _ = np.histogram2d(
+            projected['x'], projected['y'], bins=self.bins,
+            range=[[-self.extent, self.extent], [-self.extent, self.extent]],
+            weights=projected['intensity'])
+        self._sum += initial_rays * image
+        self._sum_squares += initial_rays * image * image
+        self.batches += 1
+        self.ray_count += initial_rays
+
+    def relative_error(self) -> Optional[float]:
+        """
+        平均画像の相対誤差の推定値
+
+        全ビンの標準誤差の二乗和の平方根を、平均画像のノルムで割ったもの
+        （画像全体の相対 L2 誤差）。
+
+        Returns:
+            相対誤差。バッチが2つ未満、またはパターンが空の場合は None
+        """
+        if self.batches < 2:
+            return None
+        mean = self._sum / self.ray_count
+        norm = np.sqrt(np.sum(mean * mean))
+        if norm == 0.0:
+            return None
+        # Σ n_b (h_b - h)² = Σ n_b h_b² - N h²
+        deviation = np.maximum(self._sum_squares - self.ray_count * mean * mean, 0.0)
+        variance = deviation / (self.batches - 1) / self.ray_count
+        return float(np.sqrt(np.sum(variance)) / norm)
@@ -0,0 +1,157 @@
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+# リアルタイム描画の最大フレームレートの既定値 (frames/s)
+DEFAULT_MAX_FPS = 30.0
+
+# リアルタイム描画のシミュレーションを同時に実行するスレッド数の既定値
+DEFAULT_REALTIME_WORKERS = 4
+
+
+class FrameMailbox:
+    """
+    セッションごとに最新の要求だけを保持するメールボックス（latest wins）
+
+    post で要求を入れ、処理側は take で取り出してシミュレーションし、complete で
+    フレームの完成を記録する。処理中や最小フレーム間隔の待ち時間中に届いた要求は
+    最新のものだけが残り、置き換えられた要求は coalesced に数える。close の時点で
+    処理されていない要求と、close 後に完成したフレームは dropped に数える。
+    on_drop を渡すと、要求を捨てるたびに理由（'coalesced' か 'closed'）で呼ぶ。
+    """
+
+    def __init__(self, max_fps: float = DEFAULT_MAX_FPS,
+                 on_drop: Optional[Callable[[str], None]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        if not max_fps >= 0:
+            raise ValueError(f"max_fps must not be negative: {max_fps}")
+        # 0 はフレームレートの制限なし
+        self.max_fps = max_fps
+        self.min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.on_drop = on_drop
+        self.clock = clock
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.frames = 0
+        self.closed = False
+        self._pending = None
+        self._busy = False
+        self._last_start = -math.inf
+        self._lock = threading.Lock()
+
+    def post(self, message: Any) -> bool:
+        """
+        要求を入れる（まだ処理されていない前の要求は置き換える）
+
+        Returns:
+            処理側が動いていないため、新しく起動する必要がある場合は True
+        """
+        with self._lock:
+            if self.closed:
+                self._drop('closed')
+                return False
+            self.received += 1
+            if self._pending is not None:
+                self.coalesced += 1
+                self._notify('coalesced')
+            self._pending = message
+            if self._busy:
+                return False
+            self._busy = True
+            return True
+
+    def wait_time(self) -> float:
+        """次のフレームを始められるまでの秒数（最小フレーム間隔はフレームの開始から数える）"""
+        with self._lock:
+            return max(0.0, self._last_start + self.min_interval - self.clock())
+
+    def take(self) -> Optional[Any]:
+        """
+        最新の要求を取り出す
+
+        Returns:
+            要求。なければ None で、処理側はそこで終了する（次の post で再び起動する）
+        """
+        with self._lock:
+            message = self._pending
+            self._pending = None
+            if message is None or self.closed:
+                self._busy = False
+                return None
+            self._last_start = self.clock()
+            return message
+
+    def complete(self) -> bool:
+        """
+        フレームの完成を記録
+
+        Returns:
+            送信してよい場合は True。close 後に完成したフレームは dropped に数えて False
+        """
+        with self._lock:
+            if self.closed:
+                self._drop('closed')
+                return False
+            self.frames += 1
+            return True
+
+    def close(self):
+        """セッションの終了（処理されていない要求は捨てる）"""
+        with self._lock:
+            self.closed = True
+            if self._pending is not None:
+                self._pending = None
+                self._drop('closed')
+
+    def stats(self) -> Dict[str, Any]:
+        """受信・送信・集約・破棄した要求の数"""
+        with self._lock:
+            return {
+                'max_fps': self.max_fps,
+                'received': self.received,
+                'frames': self.frames,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped
+            }
+
+    def _drop(self, reason: str):
+        self.dropped += 1
+        self._notify(reason)
+
+    def _notify(self, reason: str):
+        if self.on_drop is not None:
+            self.on_drop(reason)
+
+
+class SimulationPool:
+    """
+    シミュレーションをイベントループの外のスレッドで実行するプール
+
+    async_mode が 'eventlet' の場合は eventlet.tpool のOSスレッドで実行し、
+    呼び出した green thread だけが結果を待つ（他のクライアントのソケットを
+    止めない）。それ以外（'threading'）は呼び出し元がすでにOSスレッドなので
+    そのまま実行する。どちらも同時に実行するのは workers 個まで。
+    """
+
+    def __init__(self, workers: int = DEFAULT_REALTIME_WORKERS, async_mode: str = 'threading'):
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1: {workers}")
+        self.workers = workers
+        self.async_mode = async_mode
+        if async_mode == 'eventlet':
+            from eventlet import tpool
+            from eventlet.semaphore import Semaphore
+            self._execute = tpool.execute
+            self._slots = Semaphore(workers)
+        else:
+            self._execute = None
+            self._slots = threading.BoundedSemaphore(workers)
+
+    def run(self, func: Callable, *args, **kwargs) -> Any:
+        """func を実行して結果を返す（空きがなければ待つ）"""
+        with self._slots:
+            if self._execute is None:
+                return func(*args, **kwargs)
+            return self._execute(func, *args, **kwargs)
@@ -0,0 +1,179 @@
+import math
+from typing import Any, Dict, List, Tuple
+
+from .optical_engine import Material, PhysicsMode
+
+# light_sources.type の値
+LIGHT_SOURCE_TYPES = ('point', 'directional', 'area')
+
+# インライン設定の名前の既定値
+INLINE_CONFIG_NAME = 'Inline Configuration'
+
+# 設定の内容を表すキー（これらのいずれかがあればインライン設定とみなす）
+INLINE_CONFIG_FIELDS = ('mirror_count', 'material_ids', 'light_sources')
+
+
+def is_inline_config(data: Dict[str, Any]) -> bool:
+    """リクエストが config_id の代わりに設定の内容を持つか"""
+    return data.get('config_id') is None and any(field in data for field in INLINE_CONFIG_FIELDS)
+
+
+def parse_inline_config(data: Dict[str, Any], materials: Dict[int, Material]) -> Dict:
+    """
+    リクエストで送られた設定を検証し、load_config_from_db と同じ形式の設定にする
+
+    各項目は POST /api/config と同じ（データベースのスキーマと同じ既定値を使う）。
+    材料IDは materials（材料テーブル）に存在するものだけを受け付ける。
+
+    Args:
+        data: 'mirror_count', 'material_ids', 'light_sources' と省略可能な
+            'name', 'mirror_angles', 'physics_mode', 'surfaces' を含む辞書
+        materials: 材料ID → Material の材料テーブル
+
+    Returns:
+        設定（'id' は None）
+
+    Raises:
+        ValueError: 必須項目の欠落、型・値の範囲の不正、存在しない材料ID
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Inline configuration must be an object")
+
+    mirror_count = _integer(_required(data, 'mirror_count'), 'mirror_count')
+    if mirror_count < 1:
+        raise ValueError(f"mirror_count must be at least 1: {mirror_count}")
+
+    # ミラーの配置は mirror_count だけで決まり、mirror_angles は記録のみ
+    mirror_angles = [_number(angle, 'mirror_angles') for angle in
+                     _array(data.get('mirror_angles', []), 'mirror_angles')]
+    if mirror_angles and len(mirror_angles) != mirror_count:
+        raise ValueError("mirror_angles must have one angle per mirror")
+
+    material_ids = [_material_id(material_id, materials, 'material_ids') for material_id in
+                    _array(_required(data, 'material_ids'), 'material_ids')]
+    if not material_ids:
+        raise ValueError("material_ids must not be empty")
+
+    physics_mode = PhysicsMode(data.get('physics_mode', PhysicsMode.DRY.value))
+    light_sources = [_light_source(light_source) for light_source in
+                     _array(_required(data, 'light_sources'), 'light_sources')]
+    surfaces = [_surface(surface, materials) for surface in
+                _array(data.get('surfaces', []), 'surfaces')]
+
+    used_ids = set(material_ids) | {surface['material_id'] for surface in surfaces}
+    return {
+        'id': None,
+        'name': str(data.get('name') or INLINE_CONFIG_NAME),
+        'mirror_count': mirror_count,
+        'mirror_angles': mirror_angles,
+        'materials': {material_id: materials[material_id] for material_id in sorted(used_ids)},
+        'material_ids': material_ids,
+        'physics_mode': physics_mode,
+        'light_sources': light_sources,
+        'surfaces': surfaces
+    }
+
+
+def config_to_request(config: Dict) -> Dict[str, Any]:
+    """
+    設定（load_config_from_db・parse_inline_config の形式）をインライン設定の
+    リクエストの形式に戻す（parse_inline_config の逆変換）
+
+    Args:
+        config: 設定
+
+    Returns:
+        parse_inline_config に渡せる辞書（'config_id' は None）
+    """
+    return {
+        'config_id': None,
+        'name': config['name'],
+        'mirror_count': config['mirror_count'],
+        'mirror_angles': list(config['mirror_angles']),
+        'material_ids': list(config['material_ids']),
+        'physics_mode': config['physics_mode'].value,
+        'light_sources': [
+            {'wavelength': wavelength, 'intensity': intensity,
+             'position': [x, y, z], 'type': light_type}
+            for wavelength, intensity, x, y, z, light_type in config['light_sources']
+        ],
+        'surfaces': [{'vertices': [list(vertex) for vertex in surface['vertices']],
+                      'material_id': surface['material_id']}
+                     for surface in config.get('surfaces', [])]
+    }
+
+
+def _required(data: Dict[str, Any], field: str) -> Any:
+    if field not in data or data[field] is None:
+        raise ValueError(f"{field} is required")
+    return data[field]
+
+
+def _array(value: Any, field: str) -> List:
+    if not isinstance(value, list):
+        raise ValueError(f"{field} must be an array")
+    return value
+
+
+def _number(value: Any, field: str) -> float:
+    # JSON の true/false は数値として受け付けない
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f"{field} must be a finite number: {value!r}")
+    return float(value)
+
+
+def _integer(value: Any, field: str) -> int:
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"{field} must be an integer: {value!r}")
+    return value
+
+
+def _material_id(value: Any, materials: Dict[int, Material], field: str) -> int:
+    material_id = _integer(value, field)
+    if material_id not in materials:
+        raise ValueError(f"Material with id {material_id} not found")
+    return material_id
+
+
+def _light_source(light_source: Any) -> Tuple[float, float, float, float, float, str]:
+    """光源を light_sources テーブルの行と同じ (波長, 強度, x, y, z, 種類) にする"""
+    if not isinstance(light_source, dict):
+        raise ValueError("light_sources entries must be objects")
+
+    wavelength = _number(_required(light_source, 'wavelength'), 'wavelength')
+    if wavelength <= 0:
+        raise ValueError(f"wavelength must be positive: {wavelength}")
+    intensity = _number(light_source.get('intensity', 1.0), 'intensity')
+    if intensity < 0:
+        raise ValueError(f"intensity must not be negative: {intensity}")
+
+    position = _array(light_source.get('position', [0.0, 0.0, 1.0]), 'position')
+    if len(position) != 3:
+        raise ValueError("position must have 3 coordinates")
+    x, y, z = (_number(coordinate, 'position') for coordinate in position)
+
+    light_type = light_source.get('type', 'point')
+    if light_type not in LIGHT_SOURCE_TYPES:
+        raise ValueError(f"type must be one of {', '.join(LIGHT_SOURCE_TYPES)}: {light_type!r}")
+
+    return (wavelength, intensity, x, y, z, light_type)
+
+
+def _surface(surface: Any, materials: Dict[int, Material]) -> Dict:
+    """有限の反射面を config_surfaces の行と同じ形式にする"""
+    if not isinstance(surface, dict):
+        raise ValueError("surfaces entries must be objects")
+
+    vertices = _array(_required(surface, 'vertices'), 'vertices')
+    if len(vertices) < 3:
+        raise ValueError("vertices must have at least 3 points")
+    points = []
+    for vertex in vertices:
+        if not isinstance(vertex, list) or len(vertex) != 3:
+            raise ValueError("vertices must be [x, y, z] points")
+        points.append([_number(coordinate, 'vertices') for coordinate in vertex])
+
+    return {
+        'vertices': points,
+        'material_id': _material_id(_required(surface, 'material_id'), materials, 'material_id')
+    }
@@ -0,0 +1,609 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from typing import Any, Callable, Dict, List, Optional, TYPE_CHECKING
+
+import numpy as np
+
+from .inline_config import is_inline_config
+from .optical_engine import (RayBuffer, ColorMode, TraceSolver, PathPolicy,
+                             DEFAULT_SURVIVAL_PROBABILITY, check_spectral_samples)
+from .rasterizer import PatternRasterizer
+from .realtime_session import CONFIG_FIELDS
+from .result_writer import apply_connection_pragmas
+from .sampling import SamplingMode
+
+if TYPE_CHECKING:
+    from .frame_scheduler import SimulationPool
+    from .kaleidoscope_simulator import KaleidoscopeSimulator
+
+CREATE_JOBS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS simulation_jobs (
+        id TEXT PRIMARY KEY,                   -- ジョブID（UUID の16進文字列）
+        status TEXT NOT NULL DEFAULT 'queued', -- 'queued', 'running', 'completed', 'failed', 'cancelled'
+        config_id INTEGER,                     -- インライン設定の場合は NULL
+        parameters TEXT NOT NULL,              -- JSON形式でリクエスト（インライン設定を含む）を保存
+        total_rays INTEGER NOT NULL,
+        traced_rays INTEGER NOT NULL DEFAULT 0,
+        cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        heartbeat REAL,                        -- 実行中のワーカーが最後に進捗を書き込んだUNIX時刻
+        result_path TEXT,                      -- 結果の .npz ファイル
+        result_size INTEGER,
+        performance_data TEXT,                 -- JSON形式でパフォーマンス指標を保存
+        error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        FOREIGN KEY (config_id) REFERENCES kaleidoscope_configs (id)
+    )
+"""
+
+CREATE_JOBS_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS idx_simulation_jobs_status
+    ON simulation_jobs (status, created_at)
+"""
+
+# ジョブの状態（FINISHED_STATUSES に入ったジョブは変化しない）
+JOB_STATUSES = ('queued', 'running', 'completed', 'failed', 'cancelled')
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+
+# ジョブ1件の初期光線数の上限の既定値
+DEFAULT_JOB_MAX_RAYS = 10_000_000
+
+# 進捗の書き込みと中断の確認を行う単位（初期光線数）の既定値
+DEFAULT_JOB_BATCH_SIZE = 10000
+
+# 結果のパターン画像の解像度の上限と既定値（/api/render と同じ）
+MAX_JOB_IMAGE_SIZE = 4096
+DEFAULT_JOB_IMAGE_SIZE = 512
+
+# store_rays で結果に含める RayBuffer の列
+RAY_COLUMNS = ('origins', 'directions', 'wavelengths', 'intensities', 'polarizations',
+               'path_index', 'bounce', 'spectral_wavelengths', 'spectral_intensities')
+
+# 実行中のジョブの進捗がこの秒数更新されない場合は、ワーカーが停止したとみなして再実行する
+DEFAULT_STALE_TIMEOUT = 300.0
+
+# 再実行を含めた実行回数の上限
+MAX_JOB_ATTEMPTS = 3
+
+# ジョブのリクエストで使うキー（設定の内容以外）
+JOB_OPTION_FIELDS = ('config_id', 'num_rays', 'max_bounces', 'seed', 'batch_size', 'color_mode',
+                     'solver', 'sampling', 'policy', 'survival_probability', 'spectral_samples',
+                     'store_rays', 'width', 'height', 'extent')
+
+
+def job_parameters(data: Dict[str, Any], max_rays: int = DEFAULT_JOB_MAX_RAYS) -> Dict[str, Any]:
+    """
+    ジョブのリクエストの検証と正規化
+
+    各項目は POST /api/simulate と同じ（ワーカー数と適応サンプリングは使わない）。
+    seed を省略した場合はここで決めて保存するため、再実行しても同じ結果になる。
+    インライン設定の項目はそのまま残し、実行時に検証し直す。
+
+    Returns:
+        JSONに保存できる形式のパラメータ
+
+    Raises:
+        ValueError: 光線数・反射回数・列挙値などが不正な場合
+    """
+    if not isinstance(data, dict):
+        raise ValueError("job request must be an object")
+
+    num_rays = int(data.get('num_rays', 100000))
+    if not 1 <= num_rays <= max_rays:
+        raise ValueError(f"num_rays must be in [1, {max_rays}]: {num_rays}")
+    max_bounces = int(data.get('max_bounces', 10))
+    if max_bounces < 0:
+        raise ValueError(f"max_bounces must not be negative: {max_bounces}")
+    batch_size = int(data.get('batch_size', DEFAULT_JOB_BATCH_SIZE))
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1: {batch_size}")
+    spectral_samples = int(data.get('spectral_samples', 0))
+    check_spectral_samples(spectral_samples)
+    width = int(data.get('width', DEFAULT_JOB_IMAGE_SIZE))
+    height = int(data.get('height', DEFAULT_JOB_IMAGE_SIZE))
+    if not (1 <= width <= MAX_JOB_IMAGE_SIZE and 1 <= height <= MAX_JOB_IMAGE_SIZE):
+        raise ValueError(f"width and height must be in [1, {MAX_JOB_IMAGE_SIZE}]: "
+                         f"{width}x{height}")
+    extent = float(data.get('extent', 2.0))
+    if not extent > 0:
+        raise ValueError(f"extent must be positive: {extent}")
+    seed = data.get('seed')
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy)
+
+    parameters = {
+        'config_id': None if is_inline_config(data) else data.get('config_id') or 1,
+        'num_rays': num_rays,
+        'max_bounces': max_bounces,
+        'seed': int(seed),
+        'batch_size': min(batch_size, num_rays),
+        'color_mode': ColorMode(data.get('color_mode', ColorMode.LINEAR.value)).value,
+        'solver': TraceSolver(data.get('solver', TraceSolver.BOUNCE.value)).value,
+        'sampling': SamplingMode(data.get('sampling', SamplingMode.RANDOM.value)).value,
+        'policy': PathPolicy(data.get('policy', PathPolicy.THRESHOLD.value)).value,
+        'survival_probability': float(data.get('survival_probability',
+                                               DEFAULT_SURVIVAL_PROBABILITY)),
+        'spectral_samples': spectral_samples,
+        'store_rays': bool(data.get('store_rays', False)),
+        'width': width,
+        'height': height,
+        'extent': extent
+    }
+    if parameters['config_id'] is None:
+        parameters.update({field: data[field] for field in CONFIG_FIELDS if field in data})
+    return parameters
+
+
+class SimulationJobQueue:
+    """
+    大規模なオフライン描画のジョブキュー（simulation_jobs テーブルとローカルのワーカー）
+
+    submit はジョブを simulation_jobs に 'queued' で登録するだけで、ワーカーが
+    テーブルから古い順にジョブを取り出して iter_ray_batches でバッチごとに追跡する。
+    バッチごとに traced_rays（進捗）を書き込み、中断要求（cancel_requested）を確認する。
+    完了したジョブの結果は圧縮した .npz として result_dir/<ジョブID>.npz に保存する。
+    投影パターンは固定解像度の画像に蓄積し、store_rays の光線はバッチごとに一時ファイルへ
+    書き出すため、メモリ使用量は光線数によらずバッチ1回分と画像の大きさで決まる。
+
+    状態はすべてDBにあるため、複数のワーカープロセスのどれからでも状態の取得・中断・
+    結果の取得ができ、登録したプロセス以外のワーカーもジョブを実行する。進捗が
+    stale_timeout 秒更新されない実行中のジョブ（プロセスの停止など）は最初から再実行する。
+
+    ワーカーのループは spawn で起動し（既定はデーモンスレッド）、ジョブの取り出しと本体は
+    pool を渡すと pool.run で実行する（eventlet では tpool のOSスレッドでイベントループを止めない）。
+    """
+
+    def __init__(self, simulator: 'KaleidoscopeSimulator', result_dir: str, workers: int = 1,
+                 pool: Optional['SimulationPool'] = None,
+                 spawn: Optional[Callable[[Callable], Any]] = None,
+                 sleep: Callable[[float], None] = time.sleep, poll_interval: float = 1.0,
+                 stale_timeout: float = DEFAULT_STALE_TIMEOUT,
+                 max_rays: int = DEFAULT_JOB_MAX_RAYS,
+                 on_batch: Optional[Callable[[int, float, int], None]] = None):
+        if workers < 0:
+            raise ValueError(f"workers must not be negative: {workers}")
+        self.simulator = simulator
+        self.result_dir = result_dir
+        self.workers = workers
+        self.pool = pool
+        self.spawn = spawn or self._spawn_thread
+        self.sleep = sleep
+        self.poll_interval = poll_interval
+        self.stale_timeout = stale_timeout
+        self.max_rays = max_rays
+        # バッチごとに (初期光線数, 所要時間, セグメント数) で呼ぶ（メトリクス用）
+        self.on_batch = on_batch
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self._started = False
+        self._stopped = False
+        self._lock = threading.Lock()
+        # simulation_jobs を作成済みのDBのパス（テーブルは最初の接続で作る）
+        self._table_path = None
+
+    def start(self):
+        """ワーカーのループを起動（2回目以降は何もしない。workers が 0 なら登録だけを受け付ける）"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for _ in range(self.workers):
+            self.spawn(self._worker_loop)
+
+    def stop(self):
+        """ワーカーのループを停止（実行中のジョブは次のバッチで止め、再実行の対象に戻す）"""
+        self._stopped = True
+
+    def submit(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        ジョブの登録
+
+        Returns:
+            登録したジョブ（get と同じ形式）
+
+        Raises:
+            ValueError: リクエストが不正な場合（インライン設定はここで検証する）
+        """
+        parameters = job_parameters(data, self.max_rays)
+        if parameters['config_id'] is None:
+            self.simulator.build_inline_config(parameters)
+        else:
+            self.simulator.prepare_config(parameters['config_id'])
+
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute("""
+                INSERT INTO simulation_jobs (id, status, config_id, parameters, total_rays)
+                VALUES (?, 'queued', ?, ?, ?)
+            """, (job_id, parameters['config_id'], json.dumps(parameters),
+                  parameters['num_rays']))
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """ジョブの状態と進捗（存在しない場合は None）"""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM simulation_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job_dict(row) if row is not None else None
+
+    def list(self, status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """新しい順のジョブ一覧"""
+        if status is not None and status not in JOB_STATUSES:
+            raise ValueError(f"Unknown job status: {status}")
+        query = "SELECT * FROM simulation_jobs"
+        args = []
+        if status is not None:
+            query += " WHERE status = ?"
+            args.append(status)
+        query += " ORDER BY created_at DESC, rowid DESC LIMIT ?"
+        args.append(max(1, min(int(limit), 500)))
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(query, args).fetchall()
+        return [self._job_dict(row) for row in rows]
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        ジョブの中断
+
+        待機中のジョブはすぐに 'cancelled' にし、実行中のジョブには中断を要求する
+        （ワーカーが次のバッチの後で止める）。終了したジョブは変更しない。
+
+        Returns:
+            中断後のジョブ（存在しない場合は None）
+        """
+        with self._connect() as conn:
+            conn.execute("""
+                UPDATE simulation_jobs
+                SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'queued'
+            """, (job_id,))
+            conn.execute("""
+                UPDATE simulation_jobs SET cancel_requested = TRUE
+                WHERE id = ? AND status = 'running'
+            """, (job_id,))
+        return self.get(job_id)
+
+    def result_path(self, job_id: str) -> Optional[str]:
+        """完了したジョブの結果ファイルのパス（未完了・ファイルがない場合は None）"""
+        job = self.get(job_id)
+        if job is None or job['status'] != 'completed':
+            return None
+        path = os.path.join(self.result_dir, f'{job_id}.npz')
+        return path if os.path.exists(path) else None
+
+    def stats(self) -> Dict[str, Any]:
+        """状態ごとのジョブ数と、このプロセスのワーカーが終了させたジョブ数"""
+        with self._connect() as conn:
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM simulation_jobs GROUP BY status").fetchall())
+        return {
+            'workers': self.workers,
+            'jobs': {status: counts.get(status, 0) for status in JOB_STATUSES},
+            'completed': self.completed,
+            'failed': self.failed,
+            'cancelled': self.cancelled
+        }
+
+    def run_next(self) -> Optional[str]:
+        """
+        待機中のジョブを1件取り出して実行（ワーカーのループから呼ぶ）
+
+        取り出し（_claim）も実行と同じく pool で行い、ロック待ちのある sqlite3 の呼び出しで
+        イベントループを止めない。
+
+        Returns:
+            実行したジョブのID（待機中のジョブがなければ None）
+        """
+        if self.pool is not None:
+            return self.pool.run(self._run_next)
+        return self._run_next()
+
+    def _run_next(self) -> Optional[str]:
+        job = self._claim()
+        if job is None:
+            return None
+        self._execute(job)
+        return job['id']
+
+    def _worker_loop(self):
+        while not self._stopped:
+            try:
+                job_id = self.run_next()
+            except sqlite3.Error:
+                job_id = None
+            if job_id is None:
+                self.sleep(self.poll_interval)
+
+    @staticmethod
+    def _spawn_thread(target: Callable):
+        threading.Thread(target=target, name='simulation-job-worker', daemon=True).start()
+
+    def _connect(self) -> sqlite3.Connection:
+        db_path = self.simulator.db_path
+        conn = sqlite3.connect(db_path, timeout=30.0)
+        try:
+            apply_connection_pragmas(conn)
+        except sqlite3.Error:
+            pass
+        if self._table_path != db_path:
+            # init_db.py を実行していない既存のDBにもテーブルを作る
+            with conn:
+                conn.execute(CREATE_JOBS_TABLE_SQL)
+                conn.execute(CREATE_JOBS_INDEX_SQL)
+            self._table_path = db_path
+        return conn
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """
+        最も古い待機中のジョブ（または進捗が止まった実行中のジョブ）を 'running' にして取り出す
+
+        BEGIN IMMEDIATE で書き込みロックを取ってから選ぶため、複数のプロセスが
+        同じジョブを取り出すことはない。
+        """
+        conn = self._connect()
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                stale_before = time.time() - self.stale_timeout
+                # 実行回数の上限に達した停止ジョブは再実行せずに失敗にする
+                conn.execute("""
+                    UPDATE simulation_jobs
+                    SET status = 'failed', error = 'Worker stopped responding',
+                        finished_at = CURRENT_TIMESTAMP
+                    WHERE status = 'running' AND heartbeat < ? AND attempts >= ?
+                """, (stale_before, MAX_JOB_ATTEMPTS))
+                row = conn.execute("""
+                    SELECT * FROM simulation_jobs
+                    WHERE status = 'queued' OR (status = 'running' AND heartbeat < ?)
+                    ORDER BY created_at, rowid LIMIT 1
+                """, (stale_before,)).fetchone()
+                if row is not None:
+                    conn.execute("""
+                        UPDATE simulation_jobs
+                        SET status = 'running', traced_rays = 0, attempts = attempts + 1,
+                            heartbeat = ?, started_at = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    """, (time.time(), row['id']))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        return dict(row) if row is not None else None
+
+    def _execute(self, job: Dict[str, Any]):
+        """ジョブ1件の実行（バッチごとに進捗を書き込み、中断要求を確認する）"""
+        job_id = job['id']
+        try:
+            parameters = json.loads(job['parameters'])
+            if parameters['config_id'] is None:
+                config_id = self.simulator.build_inline_config(parameters)
+            else:
+                config_id = parameters['config_id']
+            color_mode = ColorMode(parameters['color_mode'])
+            num_rays = parameters['num_rays']
+            store_rays = parameters['store_rays']
+
+            mirror_count = self.simulator.prepare_config(config_id)['config']['mirror_count']
+            rasterizer = PatternRasterizer(parameters['width'], parameters['height'],
+                                           extent=parameters['extent'])
+            rays = _RayColumnWriter(self.result_dir) if store_rays else None
+
+            start_time = time.time()
+            total_intensity = 0.0
+            segments = 0
+            previous_traced = 0
+            batch_start = time.perf_counter()
+
+            try:
+                for ray_buffer, traced in self.simulator.iter_ray_batches(
+                        config_id, num_rays, parameters['batch_size'], parameters['max_bounces'],
+                        parameters['seed'], solver=TraceSolver(parameters['solver']),
+                        sampling=SamplingMode(parameters['sampling']),
+                        policy=PathPolicy(parameters['policy']),
+                        survival_probability=parameters['survival_probability'],
+                        spectral_samples=parameters['spectral_samples']):
+                    batch_rays = traced - previous_traced
+                    # バッチごとに光線数で割ってある強度をジョブ全体の光線数で割り直す
+                    ray_buffer.scale_intensities(batch_rays / num_rays)
+                    pattern = self.simulator.project_pattern(ray_buffer, color_mode)
+                    rasterizer.accumulate(pattern, mirror_count)
+                    total_intensity += float(pattern['intensity'].sum())
+                    if rays is not None:
+                        rays.append(ray_buffer, previous_traced)
+                    segments += len(ray_buffer)
+                    previous_traced = traced
+
+                    if self.on_batch is not None:
+                        self.on_batch(batch_rays, time.perf_counter() - batch_start,
+                                      len(ray_buffer))
+                    if not self._report_progress(job_id, traced):
+                        self._finish(job_id, 'cancelled')
+                        return
+                    batch_start = time.perf_counter()
+
+                computation_time = time.time() - start_time
+                performance = {
+                    'ray_count': segments,
+                    'computation_time': computation_time,
+                    'initial_rays': previous_traced,
+                    'solver': parameters['solver'],
+                    'sampling': parameters['sampling'],
+                    'policy': parameters['policy'],
+                    'spectral_samples': parameters['spectral_samples'],
+                    'avg_bounces': segments / previous_traced if previous_traced else 0,
+                    'total_intensity': total_intensity,
+                    'rays_per_sec': (previous_traced / computation_time
+                                     if computation_time > 0 else 0.0)
+                }
+
+                path = self._save_result(job_id, parameters, performance, rasterizer, rays)
+            finally:
+                if rays is not None:
+                    rays.close()
+            self._finish(job_id, 'completed', result_path=path,
+                         result_size=os.path.getsize(path), performance=performance)
+
+        except _WorkerStopped:
+            return
+        except Exception as e:
+            self._finish(job_id, 'failed', error=str(e))
+
+    def _report_progress(self, job_id: str, traced: int) -> bool:
+        """
+        進捗の書き込みと中断要求の確認
+
+        Returns:
+            続行してよい場合は True（中断要求があるか、ワーカーを停止中なら False）
+        """
+        with self._connect() as conn:
+            conn.execute("""
+                UPDATE simulation_jobs SET traced_rays = ?, heartbeat = ? WHERE id = ?
+            """, (traced, time.time(), job_id))
+            row = conn.execute("SELECT status, cancel_requested FROM simulation_jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+        if self._stopped:
+            # 停止するプロセスのジョブは他のワーカーがすぐに再実行できるようにする
+            with self._connect() as conn:
+                conn.execute("""
+                    UPDATE simulation_jobs SET status = 'queued', heartbeat = NULL
+                    WHERE id = ? AND status = 'running'
+                """, (job_id,))
+            raise _WorkerStopped()
+        return row is not None and row[0] == 'running' and not row[1]
+
+    def _save_result(self, job_id: str, parameters: Dict[str, Any], performance: Dict[str, Any],
+                     rasterizer: PatternRasterizer, rays: Optional['_RayColumnWriter']) -> str:
+        """
+        結果を圧縮した .npz に保存（一時ファイルに書いてから置き換える）
+
+        pattern_accumulation は投影パターンを蓄積した (height, width, 3) の強度×RGB、
+        pattern_image はそれをトーンマッピングした 8bit RGB（/api/render と同じ）。
+        store_rays の場合は RayBuffer の各列を rays_ 付きの名前で加える。
+        metadata はパラメータと性能指標のJSON文字列。
+        """
+        os.makedirs(self.result_dir, exist_ok=True)
+        path = os.path.join(self.result_dir, f'{job_id}.npz')
+        temp_path = os.path.join(self.result_dir, f'{job_id}.tmp.npz')
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            _write_npz_array(archive, 'pattern_accumulation', rasterizer.accumulation)
+            _write_npz_array(archive, 'pattern_image', rasterizer.tone_map())
+            if rays is not None:
+                rays.write_to(archive)
+            _write_npz_array(archive, 'metadata', np.array(json.dumps({
+                'job_id': job_id,
+                'parameters': parameters,
+                'performance': performance
+            })))
+        os.replace(temp_path, path)
+        return path
+
+    def _finish(self, job_id: str, status: str, result_path: Optional[str] = None,
+                result_size: Optional[int] = None, performance: Optional[Dict] = None,
+                error: Optional[str] = None):
+        with self._connect() as conn:
+            conn.execute("""
+                UPDATE simulation_jobs
+                SET status = ?, result_path = ?, result_size = ?, performance_data = ?,
+                    error = ?, heartbeat = NULL, finished_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'running'
+            """, (status, result_path, result_size,
+                  json.dumps(performance) if performance is not None else None, error, job_id))
+        with self._lock:
+            setattr(self, status, getattr(self, status) + 1)
+
+    @staticmethod
+    def _job_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        parameters = json.loads(row['parameters'])
+        total_rays = row['total_rays']
+        return {
+            'id': row['id'],
+            'status': row['status'],
+            'config_id': row['config_id'],
+            'parameters': {key: parameters[key] for key in JOB_OPTION_FIELDS if key in parameters},
+            'total_rays': total_rays,
+            'traced_rays': row['traced_rays'],
+            'progress': row['traced_rays'] / total_rays if total_rays else 0.0,
+            'cancel_requested': bool(row['cancel_requested']),
+            'attempts': row['attempts'],
+            'result_size': row['result_size'],
+            'performance': (json.loads(row['performance_data'])
+                            if row['performance_data'] else None),
+            'error': row['error'],
+            'created_at': row['created_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at']
+        }
+
+
+class _WorkerStopped(Exception):
+    """stop() の後に実行中のジョブを打ち切るための例外"""
+
+
+def _write_npz_array(archive: zipfile.ZipFile, name: str, array: np.ndarray):
+    """配列を .npz（zip）のエントリ name.npy として書き込む（np.savez_compressed と同じ形式）"""
+    with archive.open(f'{name}.npy', 'w', force_zip64=True) as member:
+        np.lib.format.write_array(member, np.asanyarray(array), allow_pickle=False)
+
+
+class _RayColumnWriter:
+    """
+    store_rays の光線をバッチごとに列別の一時ファイルへ追記し、最後に .npz のエントリにする
+
+    全バッチの RayBuffer をメモリに残さないため、ジョブのメモリ使用量が光線数に比例しない。
+    path_index はジョブ全体の初期光線の通し番号に振り直す。
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        # 列名 → [一時ファイル, dtype, 2次元目以降の形, 行数]
+        self._columns: Dict[str, list] = {}
+
+    def append(self, ray_buffer: RayBuffer, path_offset: int):
+        """バッチの各列を追記（path_offset はこのバッチより前に追跡した初期光線数）"""
+        for key in RAY_COLUMNS:
+            column = getattr(ray_buffer, key)
+            if column is None:
+                continue
+            if key == 'path_index':
+                column = column.astype(np.int64) + path_offset
+            column = np.ascontiguousarray(column)
+            entry = self._columns.get(key)
+            if entry is None:
+                entry = self._columns[key] = [
+                    tempfile.TemporaryFile(dir=self.directory), column.dtype, column.shape[1:], 0]
+            entry[0].write(column.astype(entry[1], copy=False).tobytes())
+            entry[3] += len(column)
+
+    def write_to(self, archive: zipfile.ZipFile):
+        """各列を rays_<列名>.npy として書き込む（一時ファイルから少しずつコピーする）"""
+        for key, (file, dtype, shape, rows) in self._columns.items():
+            file.seek(0)
+            with archive.open(f'rays_{key}.npy', 'w', force_zip64=True) as member:
+                np.lib.format.write_array_header_2_0(member, {
+                    'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False,
+                    'shape': (rows,) + tuple(shape)
+                })
+                shutil.copyfileobj(file, member)
+
+    def close(self):
+        """一時ファイルの削除"""
+        for entry in self._columns.values():
+            entry[0].close()
+        self._columns.clear()
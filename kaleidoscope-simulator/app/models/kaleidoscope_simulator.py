@@ -1,20 +1,51 @@
 
 import numpy as np
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional, Union
 import json
+import hashlib
+import threading
 import time
 import sqlite3
-from .optical_engine import OpticalEngine, Ray, Surface, Material, PhysicsMode
+from .optical_engine import (OpticalEngine, Ray, RayBuffer, Surface, Material, PhysicsMode, ColorMode,
+                             TraceSolver, PathPolicy, DEFAULT_SURVIVAL_PROBABILITY, SPECTRAL_RANGE,
+                             check_spectral_samples, hero_wavelengths, spectral_to_rgb, wavelengths_to_rgb)
+from .parallel_tracer import trace_rays_parallel
+from .unfolded_solver import MirrorGroup, build_mirror_group, inside_chamber, trace_rays_unfolded
+from .surface_bvh import SurfaceBVH
+from .sampling import SamplingMode, unit_square_samples
+from .convergence import ConvergenceMonitor
+from .config_cache import ConfigCache
+from .inline_config import parse_inline_config
+from .path_geometry import (PathGeometry, PathGeometryCache, DEFAULT_PATH_CACHE_BYTES,
+                            path_geometry_key, replay_path_geometry, smooth_surfaces)
+from .result_writer import SimulationResultWriter, INSERT_RESULT_SQL
+from .profiling import StageTimer
+
+# 適応サンプリングで追跡する初期光線数の上限（既定値）
+ADAPTIVE_MAX_RAYS = 100000
 
 class KaleidoscopeSimulator:
     """万華鏡シミュレーターのメインクラス"""
 
-    def __init__(self, db_path="database/kaleidoscope.db"):
+    def __init__(self, db_path="database/kaleidoscope.db", config_cache_size: int = 32,
+                 async_writes: bool = True, writer_options: Optional[Dict] = None,
+                 path_cache_bytes: int = DEFAULT_PATH_CACHE_BYTES):
         self.db_path = db_path
         self.engine = OpticalEngine()
         self.current_config = None
         self.current_surfaces = []
         self.performance_metrics = {}
+        self.config_cache = ConfigCache(config_cache_size)
+        # ミラー面・鏡映群・BVH（形状と材料IDの配置だけで決まる。キーは geometry_fingerprint）
+        self.geometry_cache = ConfigCache(config_cache_size)
+        # 初期光線ごとの反射の幾何（波長・強度・材料を変えた追跡で再利用する）
+        self.path_cache = PathGeometryCache(path_cache_bytes)
+        self.async_writes = async_writes
+        self.writer_options = writer_options or {}
+        self.result_writer = None
+        # 材料テーブル全体（インライン設定の材料の解決用、初回使用時に読み込む）
+        self.material_table = None
+        self._material_table_lock = threading.Lock()
 
     def load_config_from_db(self, config_id: int) -> Dict:
         """データベースから設定を読み込む"""
@@ -43,17 +74,32 @@ class KaleidoscopeSimulator:
 
             light_sources = cursor.fetchall()
 
+            # 有限の反射面（多面体などのファセット）の取得
+            try:
+                cursor.execute("""
+                    SELECT vertices, material_id
+                    FROM config_surfaces
+                    WHERE config_id = ?
+                    ORDER BY id
+                """, (config_id,))
+                surfaces = [{'vertices': json.loads(vertices), 'material_id': material_id}
+                            for vertices, material_id in cursor.fetchall()]
+            except sqlite3.OperationalError:
+                # config_surfaces テーブルがない古いデータベース
+                surfaces = []
+
             # マテリアル情報の取得
             material_ids = json.loads(materials_json)
+            unique_ids = sorted(set(material_ids) | {s['material_id'] for s in surfaces})
             materials = {}
-            for mat_id in set(material_ids):
-                cursor.execute("""
-                    SELECT name, reflectance, dispersion, roughness, 
+            if unique_ids:
+                placeholders = ', '.join('?' * len(unique_ids))
+                cursor.execute(f"""
+                    SELECT id, name, reflectance, dispersion, roughness,
                            refractive_index, absorption_coefficient
-                    FROM materials WHERE id = ?
-                """, (mat_id,))
-                mat_row = cursor.fetchone()
-                if mat_row:
+                    FROM materials WHERE id IN ({placeholders})
+                """, unique_ids)
+                for mat_id, *mat_row in cursor.fetchall():
                     materials[mat_id] = Material(*mat_row)
 
             config = {
@@ -64,14 +110,42 @@ class KaleidoscopeSimulator:
                 'materials': materials,
                 'material_ids': material_ids,
                 'physics_mode': PhysicsMode(physics_mode),
-                'light_sources': light_sources
+                'light_sources': light_sources,
+                'surfaces': surfaces
             }
 
             self.current_config = config
             return config
 
+    def load_material_table(self) -> Dict[int, Material]:
+        """材料テーブル全体の取得（初回のみDBから読み込み、invalidate_materials まで再利用）"""
+        with self._material_table_lock:
+            if self.material_table is None:
+                with sqlite3.connect(self.db_path) as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT id, name, reflectance, dispersion, roughness,
+                               refractive_index, absorption_coefficient
+                        FROM materials
+                    """)
+                    self.material_table = {mat_id: Material(*mat_row)
+                                           for mat_id, *mat_row in cursor.fetchall()}
+            return self.material_table
+
+    def build_inline_config(self, data: Dict) -> Dict:
+        """
+        リクエストで送られた設定（DBに保存しない設定）の検証と変換
+
+        材料は load_material_table のキャッシュから解決するため、2回目以降は
+        DBを読まない。得られた設定は config_id の代わりに run_simulation などへ渡せる。
+
+        Raises:
+            ValueError: 設定の内容が不正な場合（parse_inline_config を参照）
+        """
+        return parse_inline_config(data, self.load_material_table())
+
     def create_mirror_surfaces(self, config: Dict) -> List[Surface]:
-        """ミラー面の生成"""
+        """ミラー面の生成（mirror_count 枚の無限平面ミラーと、設定の有限の反射面）"""
         surfaces = []
         mirror_count = config['mirror_count']
         mirror_angles = config['mirror_angles']
@@ -95,121 +169,713 @@ class KaleidoscopeSimulator:
             surface = Surface(point=point, normal=normal, material_id=mat_id)
             surfaces.append(surface)
 
+        for facet in config.get('surfaces', []):
+            surfaces.append(Surface.polygon(facet['vertices'], facet['material_id']))
+
         self.current_surfaces = surfaces
         return surfaces
 
-    def setup_optical_engine(self, config: Dict):
-        """光学エンジンの設定"""
-        self.engine = OpticalEngine(config['physics_mode'])
+    def prepare_config(self, config_id: Union[int, Dict], timer: Optional[StageTimer] = None) -> Dict:
+        """
+        設定・光学エンジン・ミラー面の準備（キャッシュ利用）
+
+        キャッシュにあればDB読み込みとエンジン構築を省略する。config_id の代わりに
+        build_inline_config で作った設定を渡すとDBを読まず、設定の内容のハッシュを
+        キーとしてキャッシュする。ミラー面などは prepare_geometry で別にキャッシュするため、
+        光源や物理モードだけが違う設定では作り直さない。
+
+        Args:
+            config_id: 設定ID、またはインライン設定
+            timer: キャッシュミス時の各ステージの所要時間を記録するタイマー
+
+        Returns:
+            'config', 'engine', 'surfaces', 'mirror_group', 'accelerator', 'cache_hit' を含む辞書
+            （mirror_group は展開ソルバーが使えない配置では None、accelerator は
+            有限の反射面がない場合は None）
+        """
+        if timer is None:
+            timer = StageTimer()
+
+        if isinstance(config_id, dict):
+            config = config_id
+            cache_key = ('inline', self.config_fingerprint(config))
+        else:
+            config = None
+            cache_key = config_id
+
+        entry = self.config_cache.get(cache_key)
+        cache_hit = entry is not None
+
+        if entry is None:
+            with timer.stage('config_load'):
+                if config is None:
+                    config = self.load_config_from_db(config_id)
+            with timer.stage('engine_setup'):
+                engine = self.setup_optical_engine(config)
+            with timer.stage('surface_creation'):
+                geometry = self.prepare_geometry(config)
+            entry = dict(geometry, config=config, engine=engine)
+            self.config_cache.put(cache_key, entry)
+
+        self.current_config = entry['config']
+        self.engine = entry['engine']
+        self.current_surfaces = entry['surfaces']
+
+        return dict(entry, cache_hit=cache_hit)
+
+    def prepare_geometry(self, config: Dict) -> Dict:
+        """
+        ミラー面・鏡映群・BVHの準備（geometry_fingerprint をキーとしてキャッシュ利用）
+
+        Returns:
+            'surfaces', 'mirror_group', 'accelerator' を含む辞書
+        """
+        cache_key = self.geometry_fingerprint(config)
+        entry = self.geometry_cache.get(cache_key)
+        if entry is None:
+            surfaces = self.create_mirror_surfaces(config)
+            entry = {
+                'surfaces': surfaces,
+                'mirror_group': build_mirror_group(surfaces),
+                'accelerator': (SurfaceBVH.build(surfaces)
+                                if any(surface.bounded for surface in surfaces) else None)
+            }
+            self.geometry_cache.put(cache_key, entry)
+        self.current_surfaces = entry['surfaces']
+        return entry
+
+    def geometry_fingerprint(self, config: Dict) -> str:
+        """
+        ミラー面の配置のハッシュ（SHA-256）
+
+        create_mirror_surfaces の出力を決める mirror_count・material_ids・surfaces だけから
+        計算する（光源・物理モード・材料特性には依存しない）。
+        """
+        canonical = {
+            'mirror_count': config['mirror_count'],
+            'material_ids': config['material_ids'],
+            'surfaces': config.get('surfaces', [])
+        }
+        encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def config_fingerprint(self, config: Dict) -> str:
+        """
+        設定内容のハッシュ（SHA-256）
+
+        ミラー構成・材料特性・物理モード・光源を正規化したJSONから計算するため、
+        内容が同じ設定は同じ値になる。
+        """
+        canonical = {
+            'mirror_count': config['mirror_count'],
+            'mirror_angles': config['mirror_angles'],
+            'material_ids': config['material_ids'],
+            'materials': {
+                str(mat_id): [material.name, material.reflectance, material.dispersion,
+                              material.roughness, material.refractive_index,
+                              material.absorption_coefficient]
+                for mat_id, material in sorted(config['materials'].items())
+            },
+            'physics_mode': config['physics_mode'].value,
+            'light_sources': [list(light_source) for light_source in config['light_sources']],
+            'surfaces': config.get('surfaces', [])
+        }
+        encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def invalidate_config(self, config_id: Optional[int] = None):
+        """設定キャッシュの無効化（config_id 省略時は全件）"""
+        self.config_cache.invalidate(config_id)
+
+    def invalidate_materials(self):
+        """材料の変更時に呼ぶ（材料はどの設定からも参照されうるため全件無効化）"""
+        self.config_cache.invalidate()
+        with self._material_table_lock:
+            self.material_table = None
+
+    def setup_optical_engine(self, config: Dict) -> OpticalEngine:
+        """光学エンジンの設定（作ったエンジンを返す）"""
+        engine = OpticalEngine(config['physics_mode'])
 
         # マテリアルの追加
         for mat_id, material in config['materials'].items():
-            self.engine.add_material(mat_id, material)
-
-    def generate_initial_rays(self, config: Dict, num_rays: int = 100) -> List[Ray]:
-        """初期光線の生成"""
-        rays = []
+            engine.add_material(mat_id, material)
+
+        self.engine = engine
+        return engine
+
+    def generate_initial_ray_arrays(self, config: Dict, num_rays: int = 100,
+                                    rng: Optional[np.random.Generator] = None,
+                                    sampling: SamplingMode = SamplingMode.RANDOM,
+                                    spectral_samples: int = 0) -> Dict[str, np.ndarray]:
+        """
+        初期光線を配列としてまとめて生成
+
+        Args:
+            config: 設定
+            num_rays: 光線数（光源ごとに等分する）
+            rng: 乱数生成器。省略時は新しい乱数生成器（毎回異なる結果）
+            sampling: 方向のサンプリング方式。RANDOM 以外は光源ごとのコーン内に
+                光線を均等に散らすため、少ない光線数でノイズが減る
+            spectral_samples: 1 以上でスペクトルモード。光源を SPECTRAL_RANGE の白色光とみなし、
+                各光線に一様な代表波長から hero_wavelengths で作った波長サンプルを持たせる
+                （光源の wavelength は使わない）
+
+        Returns:
+            'origins', 'directions', 'wavelengths', 'intensities' の配列。
+            スペクトルモードでは 'wavelengths' が (N, spectral_samples)
+        """
+        sampling = SamplingMode(sampling)
+        check_spectral_samples(spectral_samples)
+        if rng is None:
+            rng = np.random.default_rng()
+
+        origins, directions, wavelengths = [], [], []
 
         for light_source in config['light_sources']:
-            wavelength, intensity, pos_x, pos_y, pos_z, light_type = light_source
+            pos_x, pos_y, pos_z = light_source[2:5]
 
             # 各光源から複数の光線を生成
             rays_per_source = num_rays // len(config['light_sources'])
+            if rays_per_source <= 0:
+                continue
+
+            # ランダムな方向（下向き優先）
+            if sampling == SamplingMode.RANDOM:
+                theta = rng.uniform(0, np.pi/3, rays_per_source)  # 60度コーン内
+                phi = rng.uniform(0, 2*np.pi, rays_per_source)
+            else:
+                samples = unit_square_samples(rays_per_source, sampling, rng)
+                theta = samples[:, 0] * (np.pi/3)
+                phi = samples[:, 1] * (2*np.pi)
+
+            directions.append(np.column_stack([
+                np.sin(theta) * np.cos(phi),
+                np.sin(theta) * np.sin(phi),
+                -np.cos(theta)  # 下向き
+            ]))
+            origins.append(np.tile(np.array([pos_x, pos_y, pos_z], dtype=np.float64),
+                                   (rays_per_source, 1)))
+            if spectral_samples:
+                hero = rng.uniform(*SPECTRAL_RANGE, rays_per_source)
+                wavelengths.append(hero_wavelengths(hero, spectral_samples))
+
+        if not origins:
+            return {
+                'origins': np.empty((0, 3)),
+                'directions': np.empty((0, 3)),
+                'wavelengths': np.empty((0, spectral_samples)) if spectral_samples else np.empty(0),
+                'intensities': np.empty(0)
+            }
 
-            for i in range(rays_per_source):
-                # 光源位置からランダムな方向への光線
-                origin = np.array([pos_x, pos_y, pos_z])
-
-                # ランダムな方向（下向き優先）
-                theta = np.random.uniform(0, np.pi/3)  # 60度コーン内
-                phi = np.random.uniform(0, 2*np.pi)
-
-                direction = np.array([
-                    np.sin(theta) * np.cos(phi),
-                    np.sin(theta) * np.sin(phi),
-                    -np.cos(theta)  # 下向き
-                ])
-
-                ray = Ray(
-                    origin=origin,
-                    direction=direction,
-                    wavelength=wavelength,
-                    intensity=intensity / rays_per_source
-                )
-
-                rays.append(ray)
-
-        return rays
+        source_wavelengths, intensities = self.light_source_values(config, num_rays)
+        return {
+            'origins': np.concatenate(origins),
+            'directions': np.concatenate(directions),
+            'wavelengths': np.concatenate(wavelengths) if spectral_samples else source_wavelengths,
+            'intensities': intensities
+        }
 
-    def run_simulation(self, config_id: int, num_rays: int = 100, 
-                      max_bounces: int = 10) -> Dict:
-        """シミュレーション実行"""
+    def light_source_values(self, config: Dict, num_rays: int = 100) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        初期光線の波長と強度（generate_initial_ray_arrays と同じ並び）
+
+        波長と強度は光源の値だけで決まり乱数を使わないため、方向を生成し直さずに
+        光源の波長・強度の変更を反映できる。
+
+        Args:
+            config: 設定
+            num_rays: 光線数（光源ごとに等分する）
+
+        Returns:
+            (波長 (N,), 強度 (N,))
+        """
+        wavelengths, intensities = [], []
+        rays_per_source = num_rays // len(config['light_sources']) if config['light_sources'] else 0
+        if rays_per_source > 0:
+            for wavelength, intensity, *_ in config['light_sources']:
+                wavelengths.append(np.full(rays_per_source, wavelength, dtype=np.float64))
+                intensities.append(np.full(rays_per_source, intensity / rays_per_source,
+                                           dtype=np.float64))
+        if not wavelengths:
+            return np.empty(0), np.empty(0)
+        return np.concatenate(wavelengths), np.concatenate(intensities)
+
+    def generate_initial_rays(self, config: Dict, num_rays: int = 100,
+                              rng: Optional[np.random.Generator] = None,
+                              sampling: SamplingMode = SamplingMode.RANDOM) -> List[Ray]:
+        """初期光線の生成（引数は generate_initial_ray_arrays と同じ）"""
+        arrays = self.generate_initial_ray_arrays(config, num_rays, rng, sampling)
+
+        return [
+            Ray(origin=origin, direction=direction, wavelength=float(wavelength),
+                intensity=float(intensity))
+            for origin, direction, wavelength, intensity in zip(
+                arrays['origins'], arrays['directions'],
+                arrays['wavelengths'], arrays['intensities'])
+        ]
+
+    def resolve_solver(self, solver: TraceSolver, mirror_group: Optional[MirrorGroup],
+                       initial: Dict[str, np.ndarray]) -> TraceSolver:
+        """
+        実際に使う追跡方式の決定
+
+        展開ソルバーは鏡映群を構成できる配置（1〜4面の正多角形）で、すべての
+        光源がミラーの内側にある場合のみ使い、それ以外は反射ごとの追跡に切り替える。
+        スペクトルモードの初期光線も反射ごとに追跡する。
+        """
+        solver = TraceSolver(solver)
+        if solver == TraceSolver.UNFOLDED and (
+                mirror_group is None or initial['wavelengths'].ndim == 2 or
+                not np.all(inside_chamber(mirror_group, initial['origins']))):
+            return TraceSolver.BOUNCE
+        return solver
+
+    def run_simulation(self, config_id: Union[int, Dict], num_rays: int = 100,
+                      max_bounces: int = 10, vectorized: bool = True,
+                      workers: int = 1, seed: Optional[int] = None,
+                      timer: Optional[StageTimer] = None, save: bool = True,
+                      solver: TraceSolver = TraceSolver.BOUNCE,
+                      sampling: SamplingMode = SamplingMode.RANDOM,
+                      policy: PathPolicy = PathPolicy.THRESHOLD,
+                      survival_probability: float = DEFAULT_SURVIVAL_PROBABILITY,
+                      spectral_samples: int = 0) -> Dict:
+        """
+        シミュレーション実行
+
+        vectorized が True（既定）の場合は全光線を配列でまとめて追跡する。
+        False の場合は従来どおり trace_ray で1本ずつ追跡する。
+        workers が2以上の場合は初期光線をシャードに分けてプロセスプールで追跡する。
+        seed を指定すると、同じ seed とワーカー数で結果が再現する（vectorized が
+        False の場合も同じ seed で再現する）。乱数はすべて seed から派生した
+        numpy.random.Generator で生成し、グローバルな乱数状態は使わない。
+        sampling は初期光線の方向のサンプリング方式（SamplingMode）。
+        policy は経路の打ち切りの方式（PathPolicy）で、
+        PathPolicy.ROULETTE では生存確率 survival_probability のロシアンルーレットで
+        打ち切る（展開ソルバーは粗さを無視するため従来どおり強度の閾値で打ち切る）。
+
+        solver に TraceSolver.UNFOLDED を指定すると、ミラーの筒を鏡映で展開して
+        反射ごとの交点探索なしで追跡する（ミラーの粗さは無視する）。展開できない
+        配置では反射ごとの追跡になる。実際に使った方式は performance['solver'] に入る。
+
+        spectral_samples を 1 以上にするとスペクトルモードになり、光源を白色光として
+        各光線が spectral_samples 個の波長サンプルを同じ経路で運ぶ（分散・フレネル反射・
+        吸収を波長ごとに適用する）。色は project_pattern・ray_colors で RGB にまとめる。
+        スペクトルモードは常に配列でまとめて反射ごとに追跡する（vectorized と
+        TraceSolver.UNFOLDED は使わない）。
+
+        seed を指定し、すべての面の粗さが 0 で PathPolicy.THRESHOLD の反射ごとの追跡
+        （ワーカー1つ）の場合は、反射の幾何を path_cache に記録して、同じ初期光線と
+        形状での波長・強度・材料の違う追跡では減衰だけを計算し直す（結果は毎回
+        追跡した場合と同じ。performance['path_cache_hit'] が True）。
+
+        config_id には設定IDの代わりに build_inline_config で作った設定を渡せる
+        （DBを読まず、結果も保存しない）。iter_ray_batches・run_adaptive_simulation も同じ。
+
+        timer を渡すと各ステージの所要時間をそこに記録する。呼び出し側で投影や
+        シリアライズの時間も記録する場合は save=False とし、後で
+        save_simulation_result(config_id, timer) を呼ぶ。
+        """
         start_time = time.time()
-
-        # 設定の読み込み
-        config = self.load_config_from_db(config_id)
-
-        # 光学エンジンの設定
-        self.setup_optical_engine(config)
-
-        # ミラー面の生成
-        surfaces = self.create_mirror_surfaces(config)
-
-        # 初期光線の生成
-        initial_rays = self.generate_initial_rays(config, num_rays)
+        if timer is None:
+            timer = StageTimer()
+
+        # 設定の読み込み・光学エンジンの設定・ミラー面の生成（キャッシュ利用）
+        prepared = self.prepare_config(config_id, timer)
+        config = prepared['config']
+        engine = prepared['engine']
+        surfaces = prepared['surfaces']
+
+        # 初期光線用と追跡用で独立した乱数系列を使う
+        generation_seed, trace_seed = np.random.SeedSequence(seed).spawn(2)
+        sampling = SamplingMode(sampling)
+        policy = PathPolicy(policy)
+        check_spectral_samples(spectral_samples)
+        # スペクトルモードは1本ずつの追跡に対応しない
+        vectorized = vectorized or spectral_samples > 0
 
         # 光線追跡の実行
-        all_ray_paths = []
-        for ray in initial_rays:
-            ray_path = self.engine.trace_ray(ray, surfaces, max_bounces)
-            all_ray_paths.extend(ray_path)
+        path_cache_hit = False
+        if vectorized:
+            with timer.stage('ray_generation'):
+                initial = self.generate_initial_ray_arrays(
+                    config, num_rays, rng=np.random.default_rng(generation_seed),
+                    sampling=sampling, spectral_samples=spectral_samples)
+            initial_count = len(initial['origins'])
+            used_solver = self.resolve_solver(solver, prepared['mirror_group'], initial)
+            mirror_group = prepared['mirror_group'] if used_solver == TraceSolver.UNFOLDED else None
+
+            with timer.stage('tracing'):
+                if workers > 1 and initial_count > 1:
+                    ray_buffer = trace_rays_parallel(
+                        engine, initial, surfaces, max_bounces, workers, seed=seed,
+                        mirror_group=mirror_group, accelerator=prepared['accelerator'],
+                        policy=policy, survival_probability=survival_probability)
+                elif mirror_group is not None:
+                    ray_buffer = trace_rays_unfolded(
+                        engine, initial['origins'], initial['directions'],
+                        initial['wavelengths'], initial['intensities'],
+                        surfaces, mirror_group, max_bounces)
+                elif (seed is not None and policy == PathPolicy.THRESHOLD and
+                      smooth_surfaces(engine, surfaces)):
+                    ray_buffer, path_cache_hit = self.trace_cached_paths(
+                        prepared, initial, max_bounces, np.random.default_rng(trace_seed))
+                else:
+                    ray_buffer = engine.trace_rays(
+                        initial['origins'], initial['directions'],
+                        initial['wavelengths'], initial['intensities'],
+                        surfaces, max_bounces, rng=np.random.default_rng(trace_seed),
+                        accelerator=prepared['accelerator'], policy=policy,
+                        survival_probability=survival_probability)
+        else:
+            with timer.stage('ray_generation'):
+                initial_rays = self.generate_initial_rays(
+                    config, num_rays, rng=np.random.default_rng(generation_seed), sampling=sampling)
+            initial_count = len(initial_rays)
+            used_solver = TraceSolver.BOUNCE
+            trace_rng = np.random.default_rng(trace_seed)
+            with timer.stage('tracing'):
+                paths = [engine.trace_ray(ray, surfaces, max_bounces, prepared['accelerator'],
+                                               rng=trace_rng, policy=policy,
+                                               survival_probability=survival_probability)
+                         for ray in initial_rays]
+                ray_buffer = RayBuffer.from_rays(
+                    [ray for path in paths for ray in path],
+                    path_index=[i for i, path in enumerate(paths) for _ in path],
+                    bounce=[b for path in paths for b in range(len(path))])
 
         # パフォーマンス指標の計算
         computation_time = time.time() - start_time
 
-        self.performance_metrics = {
-            'ray_count': len(all_ray_paths),
+        performance = {
+            'ray_count': len(ray_buffer),
             'computation_time': computation_time,
-            'initial_rays': len(initial_rays),
-            'avg_bounces': len(all_ray_paths) / len(initial_rays) if initial_rays else 0,
-            'total_intensity': sum(ray.intensity for ray in all_ray_paths)
+            'initial_rays': initial_count,
+            'workers': workers if vectorized else 1,
+            'solver': used_solver.value,
+            'sampling': sampling.value,
+            'policy': policy.value,
+            'spectral_samples': spectral_samples,
+            'config_cache_hit': prepared['cache_hit'],
+            'path_cache_hit': path_cache_hit,
+            'avg_bounces': len(ray_buffer) / initial_count if initial_count else 0,
+            'total_intensity': ray_buffer.total_intensity(),
+            'rays_per_sec': initial_count / computation_time if computation_time > 0 else 0.0,
+            'stages': dict(timer.stages)
         }
 
+        self.performance_metrics = performance
+
         # 結果の保存
-        self.save_simulation_result(config_id)
+        if save:
+            self.save_simulation_result(config_id, timer, performance)
 
         return {
             'config': config,
-            'ray_paths': all_ray_paths,
+            'ray_paths': ray_buffer,
             'surfaces': surfaces,
-            'performance': self.performance_metrics
+            'performance': performance
         }
 
-    def save_simulation_result(self, config_id: int):
-        """シミュレーション結果をデータベースに保存"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+    def trace_cached_paths(self, prepared: Dict, initial: Dict[str, np.ndarray], max_bounces: int,
+                           rng: Optional[np.random.Generator] = None) -> Tuple[RayBuffer, bool]:
+        """
+        path_cache の反射の幾何を使った追跡（PathPolicy.THRESHOLD の trace_rays と同じ結果）
+
+        初期光線の起点・方向、面の形状と粗さ、max_bounces が同じ幾何がキャッシュに
+        あれば、波長・強度・材料の減衰だけを計算し直す（足りない反射はその場で追跡して
+        記録する）。粗い面の幾何は記録した散乱のサンプルを使い回す。
+
+        Args:
+            prepared: prepare_config の結果
+            initial: generate_initial_ray_arrays の結果
+            max_bounces: 最大反射回数
+            rng: 新しく記録する幾何の散乱に使う乱数生成器
+
+        Returns:
+            (RayBuffer, キャッシュの幾何を使ったか)
+        """
+        engine = prepared['engine']
+        surfaces = prepared['surfaces']
+        key = path_geometry_key(engine, surfaces, initial['origins'], initial['directions'],
+                                max_bounces)
+        geometry = self.path_cache.get(key)
+        cache_hit = geometry is not None
+        if geometry is None:
+            geometry = PathGeometry.create(initial['origins'], initial['directions'],
+                                           max_bounces, rng)
+        ray_buffer = replay_path_geometry(engine, geometry, surfaces, initial['wavelengths'],
+                                          initial['intensities'],
+                                          accelerator=prepared['accelerator'])
+        # 再生で追跡した反射の分だけ大きくなるため、サイズを更新する
+        self.path_cache.put(key, geometry)
+        return ray_buffer, cache_hit
+
+    def iter_ray_batches(self, config_id: Union[int, Dict], total_rays: int, batch_size: int = 1000,
+                         max_bounces: int = 10, seed: Optional[int] = None,
+                         growth: float = 1.0, max_batch_size: Optional[int] = None,
+                         solver: TraceSolver = TraceSolver.BOUNCE,
+                         sampling: SamplingMode = SamplingMode.RANDOM,
+                         policy: PathPolicy = PathPolicy.THRESHOLD,
+                         survival_probability: float = DEFAULT_SURVIVAL_PROBABILITY,
+                         spectral_samples: int = 0):
+        """
+        初期光線を小さなバッチに分けて追跡し、バッチごとの結果を順に返すジェネレーター
+
+        結果はDBに保存しない。呼び出し側はいつでも反復を打ち切ってよい。
+        growth を 1 より大きくすると、バッチサイズを max_batch_size まで等比的に増やす
+        （最初の結果を早く返しつつ、後半のバッチあたりのオーバーヘッドを減らす）。
+        solver・sampling・policy・survival_probability・spectral_samples は
+        run_simulation と同じ（サンプリングはバッチごとに行う）。
+
+        Yields:
+            (RayBuffer, これまでに追跡した初期光線数)
+        """
+        prepared = self.prepare_config(config_id)
+        seed_sequence = np.random.SeedSequence(seed)
+        traced = 0
+
+        while traced < total_rays:
+            count = min(batch_size, total_rays - traced)
+            ray_buffer, initial_count, _ = self._trace_batch(
+                prepared, count, seed_sequence, max_bounces, solver, sampling,
+                policy, survival_probability, spectral_samples)
+            if not initial_count:
+                break
+            traced += count
+
+            yield ray_buffer, traced
+
+            batch_size = int(batch_size * growth)
+            if max_batch_size is not None:
+                batch_size = min(batch_size, max_batch_size)
+
+    def run_adaptive_simulation(self, config_id: Union[int, Dict], noise_target: Optional[float] = None,
+                                time_budget_ms: Optional[float] = None,
+                                max_rays: int = ADAPTIVE_MAX_RAYS, batch_size: int = 256,
+                                max_bounces: int = 10, seed: Optional[int] = None,
+                                timer: Optional[StageTimer] = None, save: bool = True,
+                                solver: TraceSolver = TraceSolver.BOUNCE,
+                                sampling: SamplingMode = SamplingMode.RANDOM,
+                                policy: PathPolicy = PathPolicy.THRESHOLD,
+                                survival_probability: float = DEFAULT_SURVIVAL_PROBABILITY,
+                                spectral_samples: int = 0) -> Dict:
+        """
+        目標のノイズ量または時間予算に達するまで光線を追加するシミュレーション
+
+        光線数を固定せず、バッチを倍々に大きくしながら追跡し、バッチごとに
+        投影パターンの相対誤差を ConvergenceMonitor で推定する。誤差が noise_target
+        以下になるか、経過時間が time_budget_ms に達するか、max_rays 本を追跡した
+        時点で終了する。時間予算がある場合は直前までの光線1本あたりの時間から
+        次のバッチを予算内に収まる大きさに縮める。
+
+        戻り値は run_simulation と同じ形式で、performance['adaptive'] に
+        終了理由と推定誤差が入る。光線の強度は全バッチを合わせた光線数で
+        正規化し直すため、同じ光線数の run_simulation と同じ尺度になる。
+
+        Args:
+            config_id: 設定ID、またはインライン設定
+            noise_target: 目標の相対誤差（例: 0.05 で 5%）。None なら誤差では止めない
+            time_budget_ms: 時間予算 (ms)。None なら時間では止めない
+            max_rays: 初期光線数の上限
+            batch_size: 最初のバッチの光線数
+            max_bounces: 最大反射回数
+            seed: 乱数シード（時間予算を指定しない場合は結果が再現する）
+            timer: ステージ計測用（run_simulation と同じ）
+            save: 結果をDBに保存するか
+            solver: 追跡方式（run_simulation と同じ）
+            sampling: 初期光線のサンプリング方式（run_simulation と同じ）
+            policy: 経路の打ち切りの方式（run_simulation と同じ）
+            survival_probability: ロシアンルーレットの生存確率（run_simulation と同じ）
+            spectral_samples: スペクトルモードの波長サンプル数（run_simulation と同じ）
+
+        Returns:
+            'config', 'ray_paths', 'surfaces', 'performance' を含む辞書
+        """
+        start_time = time.time()
+        deadline = None if time_budget_ms is None else time.perf_counter() + time_budget_ms / 1000.0
+        if timer is None:
+            timer = StageTimer()
+
+        prepared = self.prepare_config(config_id, timer)
+        config = prepared['config']
+        monitor = ConvergenceMonitor()
+        seed_sequence = np.random.SeedSequence(seed)
+
+        buffers, counts = [], []
+        used_solver = TraceSolver(solver)
+        traced = 0
+        error = None
+        stop_reason = 'max_rays'
+        batch_start = time.perf_counter()
+
+        while traced < max_rays:
+            count = min(batch_size, max_rays - traced)
+            if deadline is not None and traced:
+                # 直前までの速度で予算内に収まる光線数に縮め、小さすぎれば打ち切る
+                seconds_per_ray = (time.perf_counter() - batch_start) / traced
+                affordable = int((deadline - time.perf_counter()) / seconds_per_ray)
+                if affordable < batch_size // 4:
+                    stop_reason = 'time_budget'
+                    break
+                count = min(count, affordable)
+
+            with timer.stage('tracing'):
+                ray_buffer, initial_count, used_solver = self._trace_batch(
+                    prepared, count, seed_sequence, max_bounces, solver, sampling,
+                    policy, survival_probability, spectral_samples)
+            if not initial_count:
+                break
+            with timer.stage('convergence'):
+                monitor.add_batch(self.project_pattern(ray_buffer), initial_count)
+            buffers.append(ray_buffer)
+            counts.append(initial_count)
+            traced += count
+
+            error = monitor.relative_error()
+            if noise_target is not None and error is not None and error <= noise_target:
+                stop_reason = 'converged'
+                break
+            if deadline is not None and time.perf_counter() >= deadline:
+                stop_reason = 'time_budget'
+                break
+            batch_size *= 2
+
+        # バッチごとに光線数で割ってある強度を全体の光線数で割り直す
+        initial_total = sum(counts)
+        for ray_buffer, initial_count in zip(buffers, counts):
+            ray_buffer.scale_intensities(initial_count / initial_total)
+        ray_buffer = RayBuffer.concatenate(buffers)
 
-            cursor.execute("""
-                INSERT INTO simulation_results 
-                (config_id, performance_data, ray_count, computation_time, 
-                 memory_usage, quality_score)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                config_id,
-                json.dumps(self.performance_metrics),
-                self.performance_metrics['ray_count'],
-                self.performance_metrics['computation_time'],
-                0,  # メモリ使用量（実装保留）
-                self.calculate_quality_score()
-            ))
+        computation_time = time.time() - start_time
+        performance = {
+            'ray_count': len(ray_buffer),
+            'computation_time': computation_time,
+            'initial_rays': initial_total,
+            'workers': 1,
+            'solver': used_solver.value,
+            'sampling': SamplingMode(sampling).value,
+            'policy': PathPolicy(policy).value,
+            'spectral_samples': spectral_samples,
+            'config_cache_hit': prepared['cache_hit'],
+            'avg_bounces': len(ray_buffer) / initial_total if initial_total else 0,
+            'total_intensity': ray_buffer.total_intensity(),
+            'rays_per_sec': initial_total / computation_time if computation_time > 0 else 0.0,
+            'adaptive': {
+                'noise_target': noise_target,
+                'time_budget_ms': time_budget_ms,
+                'achieved_error': error,
+                'batches': monitor.batches,
+                'stop_reason': stop_reason
+            },
+            'stages': dict(timer.stages)
+        }
+
+        self.performance_metrics = performance
+
+        if save:
+            self.save_simulation_result(config_id, timer, performance)
+
+        return {
+            'config': config,
+            'ray_paths': ray_buffer,
+            'surfaces': prepared['surfaces'],
+            'performance': performance
+        }
+
+    def _trace_batch(self, prepared: Dict, count: int, seed_sequence: np.random.SeedSequence,
+                     max_bounces: int, solver: TraceSolver, sampling: SamplingMode,
+                     policy: PathPolicy, survival_probability: float,
+                     spectral_samples: int = 0) -> Tuple[RayBuffer, int, TraceSolver]:
+        """
+        count 本の初期光線を生成して追跡（iter_ray_batches・run_adaptive_simulation 用）
+
+        乱数は seed_sequence から毎回新しく派生させるため、同じ seed からは
+        同じバッチ列が得られる。
+
+        Returns:
+            (RayBuffer, 実際に生成した初期光線数, 実際に使った追跡方式)
+        """
+        generation_seed, trace_seed = seed_sequence.spawn(2)
+        initial = self.generate_initial_ray_arrays(
+            prepared['config'], count, rng=np.random.default_rng(generation_seed), sampling=sampling,
+            spectral_samples=spectral_samples)
+        initial_count = len(initial['origins'])
+        if not initial_count:
+            return RayBuffer.empty(), 0, TraceSolver(solver)
+
+        used_solver = self.resolve_solver(solver, prepared['mirror_group'], initial)
+        if used_solver == TraceSolver.UNFOLDED:
+            ray_buffer = trace_rays_unfolded(
+                prepared['engine'], initial['origins'], initial['directions'],
+                initial['wavelengths'], initial['intensities'],
+                prepared['surfaces'], prepared['mirror_group'], max_bounces)
+        else:
+            ray_buffer = prepared['engine'].trace_rays(
+                initial['origins'], initial['directions'],
+                initial['wavelengths'], initial['intensities'],
+                prepared['surfaces'], max_bounces, rng=np.random.default_rng(trace_seed),
+                accelerator=prepared['accelerator'], policy=policy,
+                survival_probability=survival_probability)
+        return ray_buffer, initial_count, used_solver
+
+    def get_result_writer(self) -> SimulationResultWriter:
+        """バックグラウンド書き込みスレッドの取得（初回使用時に起動）"""
+        if self.result_writer is None:
+            self.result_writer = SimulationResultWriter(self.db_path, **self.writer_options)
+        return self.result_writer
+
+    def save_simulation_result(self, config_id: Union[int, Dict], timer: Optional[StageTimer] = None,
+                               performance: Optional[Dict] = None):
+        """
+        シミュレーション結果をデータベースに保存
+
+        async_writes が True の場合はキューに積むだけで戻り、
+        書き込みはバックグラウンドでまとめて行う。
+        timer を渡すと、ステージごとの所要時間とメモリ使用量も performance_data に含める。
+        インライン設定の結果は保存しない（performance_data への追加のみ行う）。
+        performance は保存するパフォーマンス情報（結果の 'performance'）。省略時は
+        performance_metrics（直前の実行の値。複数スレッドから実行する場合は明示する）。
+        """
+        if performance is None:
+            performance = self.performance_metrics
+        if timer is not None:
+            performance.update(timer.summary())
+        if isinstance(config_id, dict):
+            return
+
+        # メモリ使用量 (MB): tracemalloc のピーク、計測していなければプロセスの RSS
+        memory_bytes = (performance.get('peak_memory_bytes')
+                        or performance.get('rss_bytes') or 0)
+
+        row = (
+            config_id,
+            json.dumps(performance),
+            performance['ray_count'],
+            performance['computation_time'],
+            memory_bytes / (1024 * 1024),
+            self.calculate_quality_score(performance)
+        )
+
+        if self.async_writes:
+            self.get_result_writer().submit(row)
+            return
 
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute(INSERT_RESULT_SQL, row)
             conn.commit()
 
-    def calculate_quality_score(self) -> float:
-        """品質スコアの計算"""
+    def flush_results(self, timeout: Optional[float] = None) -> bool:
+        """キューに残っている結果の書き込みを待つ"""
+        if self.result_writer is None:
+            return True
+        return self.result_writer.flush(timeout)
+
+    def calculate_quality_score(self, performance: Optional[Dict] = None) -> float:
+        """品質スコアの計算（performance 省略時は performance_metrics）"""
         # 光線数、計算時間、総強度から品質を評価
-        metrics = self.performance_metrics
+        metrics = self.performance_metrics if performance is None else performance
 
         # 正規化された指標
         ray_score = min(1.0, metrics['ray_count'] / 1000.0)
@@ -218,30 +884,89 @@ class KaleidoscopeSimulator:
 
         return (ray_score + time_score + intensity_score) / 3.0
 
-    def create_pattern_visualization_data(self, ray_paths: List[Ray]) -> Dict:
-        """パターン可視化用データの生成"""
+    def project_pattern(self, ray_paths: RayBuffer,
+                        color_mode: Optional[ColorMode] = None) -> Dict[str, np.ndarray]:
+        """
+        観察面（z=0）への投影を配列で計算
+
+        self.engine を使わないため、SimulationPool のスレッドから同時に呼んでよい。
+        スペクトルモードの結果では 'rgb' は波長サンプルをまとめた色（ray_colors）、
+        'wavelength' は代表波長になる。
+        """
+        if not isinstance(ray_paths, RayBuffer):
+            ray_paths = RayBuffer.from_rays(list(ray_paths))
+
+        origins = ray_paths.origins.astype(np.float64)
+        directions = ray_paths.directions.astype(np.float64)
+
+        dz = directions[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(dz != 0, -origins[:, 2] / dz, -1.0)
+        forward = t > 0  # 前方投影のみ
+
+        projection = origins[forward] + t[forward, np.newaxis] * directions[forward]
+        wavelengths = ray_paths.wavelengths[forward].astype(np.float64)
+        if ray_paths.spectral:
+            rgb = spectral_to_rgb(ray_paths.spectral_wavelengths[forward],
+                                  ray_paths.spectral_intensities[forward], color_mode or ColorMode.LINEAR)
+        else:
+            rgb = self.wavelengths_to_rgb(wavelengths, color_mode)
+
+        return {
+            'x': projection[:, 0],
+            'y': projection[:, 1],
+            'intensity': ray_paths.intensities[forward],
+            'rgb': rgb,
+            'wavelength': wavelengths
+        }
+
+    def ray_colors(self, ray_paths: RayBuffer,
+                   color_mode: Optional[ColorMode] = None) -> np.ndarray:
+        """
+        光線セグメントごとのRGB (M, 3)
+
+        スペクトルモードの結果は波長サンプルごとの強度から、それ以外は波長から変換する。
+        """
+        if ray_paths.spectral:
+            return spectral_to_rgb(ray_paths.spectral_wavelengths,
+                                   ray_paths.spectral_intensities, color_mode or ColorMode.LINEAR)
+        return self.wavelengths_to_rgb(ray_paths.wavelengths, color_mode)
+
+    def wavelengths_to_rgb(self, wavelengths: np.ndarray,
+                           color_mode: Optional[ColorMode] = None) -> np.ndarray:
+        """波長の配列をRGB (N, 3) に変換"""
+        return wavelengths_to_rgb(wavelengths, color_mode or ColorMode.LINEAR)
+
+    def create_pattern_visualization_data(self, ray_paths: RayBuffer,
+                                          projected: Optional[Dict[str, np.ndarray]] = None) -> Dict:
+        """パターン可視化用データの生成（投影済みの配列があれば再利用）"""
         # 光線の最終位置と色情報を収集
-        pattern_points = []
-
-        for ray in ray_paths:
-            # 観察面（z=0）での投影位置を計算
-            if ray.direction[2] != 0:
-                t = -ray.origin[2] / ray.direction[2]
-                if t > 0:  # 前方投影のみ
-                    projection_point = ray.origin + t * ray.direction
-                    rgb = self.engine.calculate_wavelength_to_rgb(ray.wavelength)
-
-                    pattern_points.append({
-                        'x': projection_point[0],
-                        'y': projection_point[1],
-                        'intensity': ray.intensity,
-                        'rgb': rgb,
-                        'wavelength': ray.wavelength
-                    })
+        if projected is None:
+            projected = self.project_pattern(ray_paths)
+
+        pattern_points = [
+            {'x': x, 'y': y, 'intensity': intensity, 'rgb': tuple(rgb), 'wavelength': wavelength}
+            for x, y, intensity, rgb, wavelength in zip(
+                projected['x'].tolist(), projected['y'].tolist(),
+                projected['intensity'].tolist(), projected['rgb'].tolist(),
+                projected['wavelength'].tolist())
+        ]
 
         return {
             'points': pattern_points,
-            'bounds': self.calculate_pattern_bounds(pattern_points)
+            'bounds': self.calculate_projection_bounds(projected)
+        }
+
+    def calculate_projection_bounds(self, projected: Dict[str, np.ndarray]) -> Dict:
+        """投影済み配列からパターンの境界を計算"""
+        if not len(projected['x']):
+            return {'min_x': 0, 'max_x': 0, 'min_y': 0, 'max_y': 0}
+
+        return {
+            'min_x': float(projected['x'].min()),
+            'max_x': float(projected['x'].max()),
+            'min_y': float(projected['y'].min()),
+            'max_y': float(projected['y'].max())
         }
 
     def calculate_pattern_bounds(self, points: List[Dict]) -> Dict:
@@ -0,0 +1,275 @@
+import atexit
+import json
+import math
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Prometheus テキスト形式の Content-Type
+METRICS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# レイテンシ (秒) の既定のバケット
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in labels) + '}'
+
+
+class _Metric:
+    """メトリクスの共通処理（ラベル値の組 → 値）"""
+
+    metric_type = ''
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str,
+                 labelnames: Sequence[str] = ()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def describe(self) -> Dict:
+        return {'type': self.metric_type, 'help': self.documentation,
+                'labelnames': list(self.labelnames)}
+
+
+class Counter(_Metric):
+    """単調増加するカウンター"""
+
+    metric_type = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels):
+        if amount < 0:
+            raise ValueError('Counters can only be incremented')
+        key = self._key(labels)
+        with self.registry.lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+            self.registry.dirty = True
+
+    def snapshot(self) -> Dict:
+        return dict(self.describe(), samples=[[list(key), value]
+                                              for key, value in self._values.items()])
+
+
+class Gauge(_Metric):
+    """増減する値（複数プロセスの値は生存中のプロセスについて合計する）"""
+
+    metric_type = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self._values[key] = float(value)
+            self.registry.dirty = True
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+            self.registry.dirty = True
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def snapshot(self) -> Dict:
+        return dict(self.describe(), samples=[[list(key), value]
+                                              for key, value in self._values.items()])
+
+
+class Histogram(_Metric):
+    """バケットごとの度数・合計・件数を持つヒストグラム"""
+
+    metric_type = 'histogram'
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str,
+                 labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            state = self._values.get(key)
+            if state is None:
+                state = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+                self._values[key] = state
+            # 値が入る最初のバケット（最後は +Inf）
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound),
+                         len(self.buckets))
+            state['counts'][index] += 1
+            state['sum'] += value
+            state['count'] += 1
+            self.registry.dirty = True
+
+    def describe(self) -> Dict:
+        return dict(super().describe(), buckets=list(self.buckets))
+
+    def snapshot(self) -> Dict:
+        return dict(self.describe(), samples=[[list(key), {'counts': list(state['counts']),
+                                                           'sum': state['sum'],
+                                                           'count': state['count']}]
+                                              for key, state in self._values.items()])
+
+
+class MetricsRegistry:
+    """
+    Prometheus テキスト形式で出力するプロセス内のメトリクスレジストリ
+
+    directory を指定すると、各プロセスが自分の値を metrics-<pid>.json として
+    flush_interval 秒ごとに書き出し、render() はディレクトリ内の全プロセスの値を
+    合算して出力する（gunicorn などの複数ワーカー構成用）。終了したプロセスの
+    カウンター・ヒストグラムは合計に残し、ゲージは生存中のプロセスのみ合計する。
+    """
+
+    def __init__(self, directory: Optional[str] = None, flush_interval: float = 1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.dirty = False
+        self._metrics: Dict[str, _Metric] = {}
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+            self._thread = threading.Thread(target=self._run, name='metrics-flusher',
+                                            daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """このプロセスの全メトリクスの値"""
+        with self.lock:
+            self.dirty = False
+            return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def flush(self):
+        """このプロセスの値をファイルに書き出す（directory 未指定時は何もしない）"""
+        if not self.directory:
+            return
+        snapshot = self.snapshot()
+        temp_path = f'{self._path}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'pid': os.getpid(), 'metrics': snapshot}, f)
+            os.replace(temp_path, self._path)
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self.dirty:
+                self.flush()
+
+    def _load_snapshots(self) -> List[Tuple[int, Dict[str, Dict], bool]]:
+        """(pid, 値, 生存中か) の一覧（このプロセスの値は最新のものを使う）"""
+        own_pid = os.getpid()
+        snapshots = [(own_pid, self.snapshot(), True)]
+        if not self.directory:
+            return snapshots
+
+        for name in os.listdir(self.directory):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if data.get('pid') == own_pid:
+                continue
+            snapshots.append((data['pid'], data['metrics'], _process_alive(data['pid'])))
+        return snapshots
+
+    def render(self) -> str:
+        """全プロセスを合算した Prometheus テキスト形式"""
+        merged: Dict[str, Dict] = {}
+
+        for _, metrics, alive in self._load_snapshots():
+            for name, metric in metrics.items():
+                if metric['type'] == 'gauge' and not alive:
+                    continue
+                target = merged.setdefault(name, dict(metric, samples={}))
+                for labels, value in metric['samples']:
+                    key = tuple(labels)
+                    if metric['type'] == 'histogram':
+                        state = target['samples'].setdefault(
+                            key, {'counts': [0] * len(value['counts']), 'sum': 0.0, 'count': 0})
+                        state['counts'] = [a + b for a, b in zip(state['counts'], value['counts'])]
+                        state['sum'] += value['sum']
+                        state['count'] += value['count']
+                    else:
+                        target['samples'][key] = target['samples'].get(key, 0.0) + value
+
+        lines = []
+        for name in sorted(merged):
+            metric = merged[name]
+            labelnames = metric['labelnames']
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+
+            for key in sorted(metric['samples']):
+                value = metric['samples'][key]
+                labels = list(zip(labelnames, key))
+                if metric['type'] != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(list(metric['buckets']) + [math.inf], value['counts']):
+                    cumulative += count
+                    bucket_labels = labels + [('le', _format_value(bound))]
+                    lines.append(f'{name}_bucket{_format_labels(bucket_labels)} {cumulative}')
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value['sum'])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
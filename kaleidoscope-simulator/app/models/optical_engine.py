@@ -1,14 +1,96 @@
 
 import numpy as np
 import math
-from typing import List, Tuple, Dict, Optional
+from typing import List, Tuple, Dict, Optional, TYPE_CHECKING
 from dataclasses import dataclass
 from enum import Enum
 
+from .reflectance_lut import (ReflectanceTable, WET_REFLECTANCE_FACTOR, fresnel_reflectance,
+                              get_reflectance_table)
+
+if TYPE_CHECKING:
+    from .surface_bvh import SurfaceBVH
+
 class PhysicsMode(Enum):
     DRY = "dry"
     WET = "wet"
 
+class TraceSolver(Enum):
+    BOUNCE = "bounce"  # 反射ごとに全ミラー面との交点を求める
+    UNFOLDED = "unfolded"  # ミラーの鏡映群で展開して直線として追跡する
+
+class PathPolicy(Enum):
+    # どちらの方式も粗い面の散乱は reflect_ray・scatter_reflections の従来の散乱ローブを使う。
+    # このローブはサンプリング手順そのもので定義されているため、重点サンプリングの重みは常に 1 になる
+    THRESHOLD = "threshold"  # 強度 0.01 未満で打ち切る（従来の動作）
+    ROULETTE = "roulette"  # ロシアンルーレットで打ち切り、生き残った経路の強度を生存確率で割る
+
+# ロシアンルーレットを始める経路の透過率（初期強度に対する現在の強度の比）
+ROULETTE_THRESHOLD = 0.1
+
+# ロシアンルーレットの生存確率の既定値
+DEFAULT_SURVIVAL_PROBABILITY = 0.5
+
+def check_survival_probability(survival_probability: float):
+    """ロシアンルーレットの生存確率が (0, 1] にあることの確認"""
+    if not 0.0 < survival_probability <= 1.0:
+        raise ValueError(f"survival_probability must be in (0, 1]: {survival_probability}")
+
+# スペクトルモードの光源の波長範囲 (nm)。光源は範囲内で一様なエネルギーの白色光とする
+SPECTRAL_RANGE = (380.0, 750.0)
+
+# スペクトルモードで光線1本が運ぶ波長サンプル数の既定値と上限
+DEFAULT_SPECTRAL_SAMPLES = 4
+MAX_SPECTRAL_SAMPLES = 16
+
+# 分散のコーシーの式 n(λ) = n + dispersion × B × (1/λ² - 1/λd²) の係数 B (nm²) と
+# 基準波長 λd (nm)。dispersion = 1 で BK7 ガラス程度の分散になる
+CAUCHY_COEFFICIENT = 4200.0
+DISPERSION_REFERENCE_WAVELENGTH = 587.6
+
+def check_spectral_samples(spectral_samples: int):
+    """スペクトルモードの波長サンプル数が [0, MAX_SPECTRAL_SAMPLES] にあることの確認（0 は単一波長）"""
+    if not 0 <= spectral_samples <= MAX_SPECTRAL_SAMPLES:
+        raise ValueError(f"spectral_samples must be in [0, {MAX_SPECTRAL_SAMPLES}]: {spectral_samples}")
+
+def hero_wavelengths(hero: np.ndarray, samples: int) -> np.ndarray:
+    """
+    代表波長（hero wavelength）から光線が運ぶ波長サンプルを生成
+
+    SPECTRAL_RANGE を samples 等分した間隔で代表波長を回転させた波長を並べる
+    （範囲の端で折り返す）。代表波長が範囲内で一様なら、各サンプルも一様に分布し、
+    1本の光線でスペクトル全体を層別に覆う。
+
+    Args:
+        hero: 代表波長 (N,)
+        samples: 光線1本あたりの波長サンプル数
+
+    Returns:
+        波長サンプル (N, samples)。先頭の列が代表波長
+    """
+    low, high = SPECTRAL_RANGE
+    width = high - low
+    offsets = np.arange(samples) * (width / samples)
+    return low + np.mod(np.asarray(hero, dtype=np.float64)[:, np.newaxis] - low + offsets, width)
+
+def dispersed_refractive_index(refractive_index: float, dispersion: float,
+                               wavelengths: np.ndarray) -> np.ndarray:
+    """
+    分散を考慮した波長ごとの屈折率（コーシーの式）
+
+    Args:
+        refractive_index: 基準波長での屈折率
+        dispersion: 材料の分散係数（0 で分散なし）
+        wavelengths: 波長 (nm) の配列
+
+    Returns:
+        屈折率の配列（wavelengths と同じ形状、正の値）
+    """
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    shift = dispersion * CAUCHY_COEFFICIENT * (1.0 / wavelengths**2 -
+                                               1.0 / DISPERSION_REFERENCE_WAVELENGTH**2)
+    return np.maximum(refractive_index + shift, 1e-6)
+
 @dataclass
 class Ray:
     """光線を表すクラス"""
@@ -26,14 +108,99 @@ class Ray:
 
 @dataclass
 class Surface:
-    """反射面を表すクラス"""
+    """
+    反射面を表すクラス
+
+    vertices を指定すると、その凸多角形（三角形・四角形など）の範囲だけが
+    反射面になる。省略時は point と normal で決まる無限平面。
+    """
     point: np.ndarray  # 面上の一点 (3D)
     normal: np.ndarray  # 法線ベクトル (3D)
     material_id: int  # マテリアルID
+    vertices: Optional[np.ndarray] = None  # 有限の面の頂点 (K, 3)、同一平面上の凸多角形
 
     def __post_init__(self):
         # 法線ベクトルを正規化
         self.normal = self.normal / np.linalg.norm(self.normal)
+        if self.vertices is not None:
+            self.vertices = np.asarray(self.vertices, dtype=np.float64).reshape(-1, 3)
+            if len(self.vertices) < 3:
+                raise ValueError("A bounded surface needs at least 3 vertices")
+
+    @classmethod
+    def polygon(cls, vertices, material_id: int) -> 'Surface':
+        """凸多角形の頂点から有限の面を生成（法線は頂点の並びから右手系で決まる）"""
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+        return cls(point=vertices.mean(axis=0), normal=polygon_normal(vertices),
+                   material_id=material_id, vertices=vertices)
+
+    @classmethod
+    def rectangle(cls, center: np.ndarray, normal: np.ndarray, width: float, height: float,
+                  material_id: int, up: Optional[np.ndarray] = None) -> 'Surface':
+        """
+        中心・法線・幅・高さから長方形の面を生成
+
+        Args:
+            center: 中心
+            normal: 法線
+            width: 幅
+            height: 高さ（up 方向の長さ）
+            material_id: マテリアルID
+            up: 高さ方向（省略時は z 軸。法線と平行な場合は y 軸）
+        """
+        center = np.asarray(center, dtype=np.float64)
+        normal = np.asarray(normal, dtype=np.float64)
+        normal = normal / np.linalg.norm(normal)
+        up = np.array([0.0, 0.0, 1.0]) if up is None else np.asarray(up, dtype=np.float64)
+        if np.linalg.norm(np.cross(normal, up)) < 1e-6:
+            up = np.array([0.0, 1.0, 0.0])
+        u_axis = np.cross(up, normal)
+        u_axis /= np.linalg.norm(u_axis)
+        v_axis = np.cross(normal, u_axis)
+
+        half_u = 0.5 * width * u_axis
+        half_v = 0.5 * height * v_axis
+        vertices = [center - half_u - half_v, center + half_u - half_v,
+                    center + half_u + half_v, center - half_u + half_v]
+        return cls(point=center, normal=normal, material_id=material_id,
+                   vertices=np.array(vertices))
+
+    @property
+    def bounded(self) -> bool:
+        return self.vertices is not None
+
+    def contains(self, point: np.ndarray, tolerance: float = 1e-9) -> bool:
+        """面上の点が面の範囲内にあるか（無限平面なら常に True）"""
+        if self.vertices is None:
+            return True
+        starts, inward = polygon_edges(self.vertices)
+        return bool(np.all(np.einsum('ij,ij->i', point - starts, inward) >= -tolerance))
+
+
+def polygon_normal(vertices: np.ndarray) -> np.ndarray:
+    """多角形の単位法線（Newell の方法、頂点が反時計回りに見える側）"""
+    following = np.roll(vertices, -1, axis=0)
+    normal = np.array([
+        np.sum((vertices[:, 1] - following[:, 1]) * (vertices[:, 2] + following[:, 2])),
+        np.sum((vertices[:, 2] - following[:, 2]) * (vertices[:, 0] + following[:, 0])),
+        np.sum((vertices[:, 0] - following[:, 0]) * (vertices[:, 1] + following[:, 1]))
+    ])
+    length = np.linalg.norm(normal)
+    if length < 1e-12:
+        raise ValueError("Polygon vertices are degenerate")
+    return normal / length
+
+
+def polygon_edges(vertices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    凸多角形の各辺の始点と、面内で内側を向く辺の法線
+
+    Returns:
+        (始点 (K, 3), 内向きの辺の法線 (K, 3))。内側の点 p は全ての辺で
+        (p - 始点)・法線 >= 0 を満たす
+    """
+    edges = np.roll(vertices, -1, axis=0) - vertices
+    return vertices, np.cross(polygon_normal(vertices), edges)
 
 @dataclass
 class Material:
@@ -45,16 +212,416 @@ class Material:
     refractive_index: float  # 屈折率
     absorption_coefficient: float  # 吸収係数
 
+@dataclass
+class RayBuffer:
+    """
+    光線の反射過程を列指向の配列で保持するクラス
+
+    1行が1本の光線セグメントに対応する。path_index は初期光線の番号、
+    bounce はその光線内での反射回数。Ray は個々の行を参照する際の
+    ビューとしてのみ生成する。
+
+    スペクトルモードでは各行が K 個の波長サンプルを運び、spectral_wavelengths と
+    spectral_intensities に波長ごとの値が入る。その場合 wavelengths は代表波長
+    （先頭のサンプル）、intensities は波長サンプルの強度の平均になる。
+    """
+    origins: np.ndarray  # 光線の起点 (M, 3) float32
+    directions: np.ndarray  # 光線の方向ベクトル (M, 3) float32
+    wavelengths: np.ndarray  # 波長 (M,) float32
+    intensities: np.ndarray  # 強度 (M,) float64
+    polarizations: np.ndarray  # 偏光状態 (M, 2) float32
+    path_index: np.ndarray  # 初期光線の番号 (M,) int32
+    bounce: np.ndarray  # 反射回数 (M,) int32
+    spectral_wavelengths: Optional[np.ndarray] = None  # 波長サンプル (M, K) float32
+    spectral_intensities: Optional[np.ndarray] = None  # 波長サンプルごとの強度 (M, K) float64
+
+    def __post_init__(self):
+        # 連続したメモリ配置と列ごとの型をそろえる
+        self.origins = np.ascontiguousarray(self.origins, dtype=np.float32).reshape(-1, 3)
+        self.directions = np.ascontiguousarray(self.directions, dtype=np.float32).reshape(-1, 3)
+        self.wavelengths = np.ascontiguousarray(self.wavelengths, dtype=np.float32).reshape(-1)
+        self.intensities = np.ascontiguousarray(self.intensities, dtype=np.float64).reshape(-1)
+        self.polarizations = np.ascontiguousarray(self.polarizations, dtype=np.float32).reshape(-1, 2)
+        self.path_index = np.ascontiguousarray(self.path_index, dtype=np.int32).reshape(-1)
+        self.bounce = np.ascontiguousarray(self.bounce, dtype=np.int32).reshape(-1)
+        if self.spectral_wavelengths is not None:
+            samples = np.shape(self.spectral_wavelengths)[-1]
+            self.spectral_wavelengths = np.ascontiguousarray(
+                self.spectral_wavelengths, dtype=np.float32).reshape(-1, samples)
+            self.spectral_intensities = np.ascontiguousarray(
+                self.spectral_intensities, dtype=np.float64).reshape(-1, samples)
+
+    @classmethod
+    def empty(cls) -> 'RayBuffer':
+        """空のバッファを生成"""
+        return cls(np.empty((0, 3)), np.empty((0, 3)), np.empty(0), np.empty(0),
+                   np.empty((0, 2)), np.empty(0), np.empty(0))
+
+    @classmethod
+    def from_rays(cls, rays: List[Ray], path_index: Optional[List[int]] = None,
+                  bounce: Optional[List[int]] = None) -> 'RayBuffer':
+        """Ray のリストからバッファを生成（既存APIとの互換用）"""
+        if not rays:
+            return cls.empty()
+        return cls(
+            origins=np.array([ray.origin for ray in rays]),
+            directions=np.array([ray.direction for ray in rays]),
+            wavelengths=np.array([ray.wavelength for ray in rays]),
+            intensities=np.array([ray.intensity for ray in rays]),
+            polarizations=np.array([ray.polarization for ray in rays]),
+            path_index=np.zeros(len(rays)) if path_index is None else path_index,
+            bounce=np.arange(len(rays)) if bounce is None else bounce
+        )
+
+    @classmethod
+    def concatenate(cls, buffers: List['RayBuffer']) -> 'RayBuffer':
+        """複数のバッファを連結（path_index は連番に振り直す）"""
+        buffers = [buffer for buffer in buffers if len(buffer)]
+        if not buffers:
+            return cls.empty()
+
+        path_index = []
+        offset = 0
+        for buffer in buffers:
+            path_index.append(buffer.path_index.astype(np.int64) + offset)
+            offset += int(buffer.path_index.max()) + 1
+
+        return cls(
+            origins=np.concatenate([buffer.origins for buffer in buffers]),
+            directions=np.concatenate([buffer.directions for buffer in buffers]),
+            wavelengths=np.concatenate([buffer.wavelengths for buffer in buffers]),
+            intensities=np.concatenate([buffer.intensities for buffer in buffers]),
+            polarizations=np.concatenate([buffer.polarizations for buffer in buffers]),
+            path_index=np.concatenate(path_index),
+            bounce=np.concatenate([buffer.bounce for buffer in buffers]),
+            **cls._concatenate_spectral(buffers)
+        )
+
+    @staticmethod
+    def _concatenate_spectral(buffers: List['RayBuffer']) -> Dict[str, np.ndarray]:
+        """スペクトルの列の連結（すべてのバッファがスペクトルモードの場合のみ）"""
+        if any(buffer.spectral_wavelengths is None for buffer in buffers):
+            return {}
+        return {
+            'spectral_wavelengths': np.concatenate([buffer.spectral_wavelengths for buffer in buffers]),
+            'spectral_intensities': np.concatenate([buffer.spectral_intensities for buffer in buffers])
+        }
+
+    def __len__(self) -> int:
+        return len(self.intensities)
+
+    def __getitem__(self, index):
+        # 整数なら Ray ビュー、スライス・マスクなら部分バッファを返す
+        if isinstance(index, (int, np.integer)):
+            return Ray(
+                origin=self.origins[index].astype(np.float64),
+                direction=self.directions[index].astype(np.float64),
+                wavelength=float(self.wavelengths[index]),
+                intensity=float(self.intensities[index]),
+                polarization=self.polarizations[index].astype(np.float64)
+            )
+        return RayBuffer(
+            origins=self.origins[index],
+            directions=self.directions[index],
+            wavelengths=self.wavelengths[index],
+            intensities=self.intensities[index],
+            polarizations=self.polarizations[index],
+            path_index=self.path_index[index],
+            bounce=self.bounce[index],
+            spectral_wavelengths=(None if self.spectral_wavelengths is None
+                                  else self.spectral_wavelengths[index]),
+            spectral_intensities=(None if self.spectral_intensities is None
+                                  else self.spectral_intensities[index])
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def num_paths(self) -> int:
+        """含まれる初期光線（経路）の数"""
+        return int(np.unique(self.path_index).size)
+
+    @property
+    def spectral(self) -> bool:
+        """スペクトルモードの結果か"""
+        return self.spectral_wavelengths is not None
+
+    @property
+    def nbytes(self) -> int:
+        """全列の合計メモリ使用量 (bytes)"""
+        return sum(column.nbytes for column in (
+            self.origins, self.directions, self.wavelengths, self.intensities,
+            self.polarizations, self.path_index, self.bounce,
+            self.spectral_wavelengths, self.spectral_intensities) if column is not None)
+
+    def scale_intensities(self, factor: float):
+        """強度（スペクトルモードでは波長サンプルごとの強度も）を factor 倍する"""
+        self.intensities *= factor
+        if self.spectral_intensities is not None:
+            self.spectral_intensities *= factor
+
+    def total_intensity(self) -> float:
+        """全セグメントの強度の合計"""
+        return float(self.intensities.sum())
+
+class ColorMode(Enum):
+    LINEAR = "linear"  # 区分線形近似（従来の変換）
+    CIE1931 = "cie1931"  # CIE 1931 等色関数による変換
+
+# 波長→RGB変換テーブルのキャッシュ（ColorMode → (波長, RGB)）
+_RGB_LUTS: Dict[ColorMode, Tuple[np.ndarray, np.ndarray]] = {}
+
+# 白色スペクトルの平均RGBのキャッシュ（ColorMode → RGB）
+_SPECTRAL_WHITES: Dict[ColorMode, np.ndarray] = {}
+
+# XYZ → リニア sRGB (D65)
+_XYZ_TO_LINEAR_SRGB = np.array([
+    [3.2404542, -1.5371385, -0.4985314],
+    [-0.9692660, 1.8760108, 0.0415560],
+    [0.0556434, -0.2040259, 1.0572252]
+])
+
+def _piecewise_wavelength_to_rgb(wavelength: float) -> Tuple[float, float, float]:
+    """区分線形近似による波長→RGB変換（LUT構築用）"""
+    if wavelength < 380 or wavelength > 750:
+        return (0.0, 0.0, 0.0)
+
+    if 380 <= wavelength < 440:
+        R = -(wavelength - 440) / (440 - 380)
+        G = 0.0
+        B = 1.0
+    elif 440 <= wavelength < 490:
+        R = 0.0
+        G = (wavelength - 440) / (490 - 440)
+        B = 1.0
+    elif 490 <= wavelength < 510:
+        R = 0.0
+        G = 1.0
+        B = -(wavelength - 510) / (510 - 490)
+    elif 510 <= wavelength < 580:
+        R = (wavelength - 510) / (580 - 510)
+        G = 1.0
+        B = 0.0
+    elif 580 <= wavelength < 645:
+        R = 1.0
+        G = -(wavelength - 645) / (645 - 580)
+        B = 0.0
+    elif 645 <= wavelength <= 750:
+        R = 1.0
+        G = 0.0
+        B = 0.0
+
+    # 強度による減衰（紫外線・赤外線領域）
+    factor = 1.0
+    if wavelength < 420:
+        factor = 0.3 + 0.7 * (wavelength - 380) / (420 - 380)
+    elif wavelength > 700:
+        factor = 0.3 + 0.7 * (750 - wavelength) / (750 - 700)
+
+    return (R * factor, G * factor, B * factor)
+
+def _cie1931_xyz(wavelengths: np.ndarray) -> np.ndarray:
+    """
+    CIE 1931 2度視野等色関数の解析的近似
+    (Wyman, Sloan, Shirley 2013 の多峰ガウス近似)
+    """
+    def lobe(x, mu, sigma_low, sigma_high):
+        sigma = np.where(x < mu, sigma_low, sigma_high)
+        return np.exp(-0.5 * ((x - mu) / sigma)**2)
+
+    x = (1.056 * lobe(wavelengths, 599.8, 37.9, 31.0) +
+         0.362 * lobe(wavelengths, 442.0, 16.0, 26.7) -
+         0.065 * lobe(wavelengths, 501.1, 20.4, 26.2))
+    y = (0.821 * lobe(wavelengths, 568.8, 46.9, 40.5) +
+         0.286 * lobe(wavelengths, 530.9, 16.3, 31.1))
+    z = (1.217 * lobe(wavelengths, 437.0, 11.8, 36.0) +
+         0.681 * lobe(wavelengths, 459.0, 26.0, 13.8))
+    return np.column_stack([x, y, z])
+
+def _build_rgb_lut(color_mode: ColorMode) -> Tuple[np.ndarray, np.ndarray]:
+    """1nm刻みの波長→RGBテーブルを構築"""
+    if color_mode == ColorMode.CIE1931:
+        wavelengths = np.arange(360.0, 831.0, 1.0)
+        linear = _cie1931_xyz(wavelengths) @ _XYZ_TO_LINEAR_SRGB.T
+        # 色域外の負値は切り捨て、テーブル全体の最大値で正規化
+        linear = np.clip(linear, 0.0, None)
+        linear /= linear.max()
+        # sRGB のガンマ特性
+        rgb = np.where(linear <= 0.0031308, 12.92 * linear,
+                       1.055 * np.power(linear, 1.0 / 2.4) - 0.055)
+        return wavelengths, rgb
+
+    # 区分線形近似の折れ点はすべて整数nmなので、1nm刻みの線形補間との差は
+    # 両端の減衰係数との積による二次の項だけになる（最大でも 1e-4 未満）
+    wavelengths = np.arange(380.0, 751.0, 1.0)
+    rgb = np.array([_piecewise_wavelength_to_rgb(w) for w in wavelengths])
+    return wavelengths, rgb
+
+def get_rgb_lut(color_mode: ColorMode = ColorMode.LINEAR) -> Tuple[np.ndarray, np.ndarray]:
+    """波長→RGBテーブルの取得（プロセス内で一度だけ構築）"""
+    lut = _RGB_LUTS.get(color_mode)
+    if lut is None:
+        lut = _build_rgb_lut(color_mode)
+        _RGB_LUTS[color_mode] = lut
+    return lut
+
+def get_spectral_white(color_mode: ColorMode = ColorMode.LINEAR) -> np.ndarray:
+    """SPECTRAL_RANGE で一様な白色スペクトルの平均RGB（スペクトルモードで白とみなす色）"""
+    white = _SPECTRAL_WHITES.get(color_mode)
+    if white is None:
+        lut_wavelengths, lut_rgb = get_rgb_lut(color_mode)
+        low, high = SPECTRAL_RANGE
+        inside = (lut_wavelengths >= low) & (lut_wavelengths <= high)
+        white = lut_rgb[inside].mean(axis=0)
+        _SPECTRAL_WHITES[color_mode] = white
+    return white
+
+def wavelengths_to_rgb(wavelengths: np.ndarray,
+                       color_mode: ColorMode = ColorMode.LINEAR) -> np.ndarray:
+    """
+    波長の配列をまとめてRGB色に変換（1nm刻みのテーブルを線形補間）
+
+    OpticalEngine の状態を使わないため、複数のスレッドから同時に呼んでよい。
+
+    Args:
+        wavelengths: 波長 (nm) の配列 (N,)
+        color_mode: 変換方式
+
+    Returns:
+        RGB値 (N, 3)、各成分 0-1。テーブルの範囲外は黒
+    """
+    lut_wavelengths, lut_rgb = get_rgb_lut(color_mode)
+    wavelengths = np.asarray(wavelengths, dtype=np.float64).reshape(-1)
+
+    rgb = np.empty((len(wavelengths), 3))
+    for channel in range(3):
+        rgb[:, channel] = np.interp(wavelengths, lut_wavelengths, lut_rgb[:, channel],
+                                    left=0.0, right=0.0)
+    return rgb
+
+def spectral_to_rgb(wavelengths: np.ndarray, intensities: np.ndarray,
+                    color_mode: ColorMode = ColorMode.LINEAR) -> np.ndarray:
+    """
+    波長サンプルごとの強度をRGB色にまとめる（スペクトルモードの最終段）
+
+    各光線の色は波長サンプルの色を強度で重み付けした平均を、白色スペクトルの
+    平均色（get_spectral_white）で割ったもの。経路で減衰しなかった白色光は
+    多数の光線の平均としてほぼ白になる（1 を超える成分がある光線は色相を保って
+    縮めるため、その分だけわずかに暗くなる）。
+    光線の明るさは RayBuffer.intensities（波長サンプルの強度の平均）が担う。
+
+    Args:
+        wavelengths: 波長サンプル (N, K)
+        intensities: 波長サンプルごとの強度 (N, K)
+        color_mode: 変換方式
+
+    Returns:
+        RGB値 (N, 3)、各成分 0-1。強度がすべて 0 の光線は黒
+    """
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    intensities = np.asarray(intensities, dtype=np.float64)
+    samples = wavelengths.shape[1]
+    sample_rgb = wavelengths_to_rgb(wavelengths.ravel(), color_mode).reshape(-1, samples, 3)
+
+    total = intensities.sum(axis=1)
+    rgb = np.einsum('nk,nkc->nc', intensities, sample_rgb)
+    rgb /= np.where(total > 0.0, total, 1.0)[:, np.newaxis]
+    rgb /= get_spectral_white(color_mode)
+    rgb /= np.maximum(rgb.max(axis=1, keepdims=True), 1.0)
+    return rgb
+
 class OpticalEngine:
     """光学計算エンジン"""
 
-    def __init__(self, physics_mode: PhysicsMode = PhysicsMode.DRY):
+    def __init__(self, physics_mode: PhysicsMode = PhysicsMode.DRY,
+                 color_mode: ColorMode = ColorMode.LINEAR):
         self.physics_mode = physics_mode
+        self.color_mode = color_mode
         self.materials = {}
+        # 材料IDごとの反射の減衰率テーブル（add_material で登録）
+        self.reflectance_tables: Dict[int, ReflectanceTable] = {}
 
     def add_material(self, material_id: int, material: Material):
-        """材料を追加"""
+        """材料を追加（反射の減衰率テーブルも用意する。同じ特性のテーブルは共有）"""
         self.materials[material_id] = material
+        self.reflectance_tables[material_id] = get_reflectance_table(
+            material.reflectance, material.refractive_index, material.absorption_coefficient,
+            wet=self.physics_mode == PhysicsMode.WET)
+
+    def reflection_attenuation(self, material_ids: np.ndarray, cos_theta_i: np.ndarray,
+                               s_component: np.ndarray, p_component: np.ndarray,
+                               wavelengths: np.ndarray) -> np.ndarray:
+        """
+        反射1回あたりの強度の減衰率の配列版（材料ごとの参照テーブルを使う）
+
+        Args:
+            material_ids: 反射した面の材料ID (N,)
+            cos_theta_i: 入射角の余弦 (N,)
+            s_component: s偏光の成分の二乗 (N,)
+            p_component: p偏光の成分の二乗 (N,)
+            wavelengths: 波長 (N,)
+
+        Returns:
+            減衰率 (N,)
+        """
+        material_ids = np.asarray(material_ids)
+        unique_ids = np.unique(material_ids)
+        if len(unique_ids) == 1:
+            return self.reflectance_tables[int(unique_ids[0])].attenuation(
+                cos_theta_i, s_component, p_component, wavelengths)
+
+        attenuation = np.empty(len(material_ids))
+        for material_id in unique_ids:
+            mask = material_ids == material_id
+            attenuation[mask] = self.reflectance_tables[int(material_id)].attenuation(
+                cos_theta_i[mask], s_component[mask], p_component[mask], wavelengths[mask])
+        return attenuation
+
+    def spectral_attenuation(self, material_ids: np.ndarray, cos_theta_i: np.ndarray,
+                             s_component: np.ndarray, p_component: np.ndarray,
+                             wavelengths: np.ndarray) -> np.ndarray:
+        """
+        波長サンプルごとの反射1回あたりの強度の減衰率（スペクトルモード用）
+
+        reflection_attenuation と同じ物理を波長サンプルごとに適用する。屈折率は
+        材料の分散係数から波長ごとに求める（dispersed_refractive_index）ため、
+        フレネル反射率は材料の参照テーブルではなく厳密な式で計算し、
+        波長による吸収は参照テーブルから引く。
+
+        Args:
+            material_ids: 反射した面の材料ID (N,)
+            cos_theta_i: 入射角の余弦 (N,)
+            s_component: s偏光の成分の二乗 (N,)
+            p_component: p偏光の成分の二乗 (N,)
+            wavelengths: 波長サンプル (N, K)
+
+        Returns:
+            減衰率 (N, K)
+        """
+        material_ids = np.asarray(material_ids)
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        wet_factor = WET_REFLECTANCE_FACTOR if self.physics_mode == PhysicsMode.WET else 1.0
+
+        attenuation = np.empty(wavelengths.shape)
+        for material_id in np.unique(material_ids):
+            mask = material_ids == material_id
+            material = self.materials[int(material_id)]
+            sample_wavelengths = wavelengths[mask]
+
+            refractive_index = dispersed_refractive_index(
+                material.refractive_index, material.dispersion, sample_wavelengths)
+            rs, rp = fresnel_reflectance(cos_theta_i[mask][:, np.newaxis], refractive_index)
+            reflectance = material.reflectance * wet_factor * (
+                rs * s_component[mask][:, np.newaxis] + rp * p_component[mask][:, np.newaxis])
+            if self.physics_mode == PhysicsMode.WET:
+                reflectance = np.minimum(1.0, reflectance)
+
+            absorption = self.reflectance_tables[int(material_id)].absorption_factor(
+                sample_wavelengths.ravel()).reshape(sample_wavelengths.shape)
+            attenuation[mask] = reflectance * absorption
+        return attenuation
 
     def fresnel_coefficients(self, n1: float, n2: float, theta_i: float) -> Tuple[float, float]:
         """
@@ -90,6 +657,36 @@ class OpticalEngine:
 
         return rs, rp
 
+    def fresnel_coefficients_batch(self, n1: np.ndarray, n2: np.ndarray,
+                                   theta_i: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        フレネル方程式の配列版（fresnel_coefficients と同じ式を要素ごとに適用）
+
+        Args:
+            n1: 入射側の屈折率 (N,)
+            n2: 透過側の屈折率 (N,)
+            theta_i: 入射角 (ラジアン) (N,)
+
+        Returns:
+            (rs, rp): s偏光とp偏光の反射係数 (N,)
+        """
+        cos_theta_i = np.cos(theta_i)
+        sin_theta_t = (n1 / n2) * np.sin(theta_i)
+
+        # 全反射の要素は後で 1.0 に置き換える
+        total_reflection = sin_theta_t > 1.0
+        cos_theta_t = np.sqrt(np.maximum(0.0, 1.0 - sin_theta_t**2))
+
+        rs = ((n1 * cos_theta_i - n2 * cos_theta_t) /
+              (n1 * cos_theta_i + n2 * cos_theta_t))**2
+        rp = ((n2 * cos_theta_i - n1 * cos_theta_t) /
+              (n2 * cos_theta_i + n1 * cos_theta_t))**2
+
+        rs = np.where(total_reflection, 1.0, rs)
+        rp = np.where(total_reflection, 1.0, rp)
+
+        return rs, rp
+
     def snells_law(self, n1: float, n2: float, incident_dir: np.ndarray, 
                    normal: np.ndarray) -> Optional[np.ndarray]:
         """
@@ -123,13 +720,18 @@ class OpticalEngine:
 
         return refracted / np.linalg.norm(refracted)
 
-    def reflect_ray(self, ray: Ray, surface: Surface) -> Ray:
+    def reflect_ray(self, ray: Ray, surface: Surface,
+                    rng: Optional[np.random.Generator] = None,
+                    scatter_sample: Optional[np.ndarray] = None) -> Ray:
         """
         光線の反射計算
 
         Args:
             ray: 入射光線
             surface: 反射面
+            rng: 散乱に使う乱数生成器。省略時は新しい乱数生成器（毎回異なる結果）
+            scatter_sample: 事前に生成した散乱用の乱数（標準正規乱数1つと [0, 1) の
+                一様乱数2つ）。指定した場合は rng を使わない
 
         Returns:
             反射光線
@@ -146,13 +748,19 @@ class OpticalEngine:
         else:
             normal = surface.normal
 
-        # 理想的な反射方向
-        ideal_reflection = ray.direction - 2.0 * cos_theta_i * normal
+        # 理想的な反射方向（d - 2(d・n)n、ここで d・n = -cos_theta_i）
+        ideal_reflection = ray.direction + 2.0 * cos_theta_i * normal
 
         # 表面粗さによるランダム散乱
         if material.roughness > 0:
+            if scatter_sample is None:
+                if rng is None:
+                    rng = np.random.default_rng()
+                scatter_sample = (rng.standard_normal(), rng.random(), rng.random())
+            normal_sample, uniform1, uniform2 = scatter_sample
+
             # ランダムな散乱角度
-            scatter_angle = np.random.normal(0, material.roughness)
+            scatter_angle = material.roughness * normal_sample
 
             # 接線方向のランダムベクトル生成
             tangent1 = np.cross(normal, np.array([1, 0, 0]))
@@ -162,35 +770,19 @@ class OpticalEngine:
             tangent2 = np.cross(normal, tangent1)
 
             # 散乱を適用
-            scatter_dir = (ideal_reflection + 
-                         scatter_angle * tangent1 * np.random.random() +
-                         scatter_angle * tangent2 * np.random.random())
+            scatter_dir = (ideal_reflection +
+                         scatter_angle * tangent1 * uniform1 +
+                         scatter_angle * tangent2 * uniform2)
             reflection_dir = scatter_dir / np.linalg.norm(scatter_dir)
         else:
             reflection_dir = ideal_reflection
 
-        # 反射率による強度減衰
-        theta_i = np.arccos(cos_theta_i)
-
-        # フレネル反射率の計算（空気から材料への反射として近似）
-        n1 = 1.0  # 空気
-        n2 = material.refractive_index
-        rs, rp = self.fresnel_coefficients(n1, n2, theta_i)
-
-        # 偏光状態に基づく反射率
-        s_component = ray.polarization[0]**2
-        p_component = ray.polarization[1]**2
-        effective_reflectance = material.reflectance * (rs * s_component + rp * p_component)
-
-        # ウェットモードでは反射率が向上
-        if self.physics_mode == PhysicsMode.WET:
-            effective_reflectance = min(1.0, effective_reflectance * 1.1)
-
-        new_intensity = ray.intensity * effective_reflectance
-
-        # 波長による吸収
-        absorption_loss = np.exp(-material.absorption_coefficient * ray.wavelength / 1000.0)
-        new_intensity *= absorption_loss
+        # 反射率による強度減衰（フレネル反射率・偏光・ウェットモード補正・波長による吸収）
+        # は材料ごとの参照テーブルから引く
+        s_component = float(ray.polarization[0]**2)
+        p_component = float(ray.polarization[1]**2)
+        new_intensity = ray.intensity * self.reflectance_tables[surface.material_id].attenuation_scalar(
+            float(cos_theta_i), s_component, p_component, float(ray.wavelength))
 
         return Ray(
             origin=surface.point,
@@ -225,11 +817,25 @@ class OpticalEngine:
         if t < 1e-6:
             return None
 
+        # 有限の面は範囲外の交点を無効にする
+        if surface.vertices is not None and not surface.contains(ray.origin + t * ray.direction):
+            return None
+
         return t
 
+    def wavelengths_to_rgb(self, wavelengths: np.ndarray,
+                           color_mode: Optional[ColorMode] = None) -> np.ndarray:
+        """波長の配列をRGB色に変換（モジュールの wavelengths_to_rgb。color_mode の省略時はエンジンの設定）"""
+        return wavelengths_to_rgb(wavelengths, color_mode or self.color_mode)
+
+    def spectral_to_rgb(self, wavelengths: np.ndarray, intensities: np.ndarray,
+                        color_mode: Optional[ColorMode] = None) -> np.ndarray:
+        """波長サンプルごとの強度をRGB色にまとめる（モジュールの spectral_to_rgb。color_mode の省略時はエンジンの設定）"""
+        return spectral_to_rgb(wavelengths, intensities, color_mode or self.color_mode)
+
     def calculate_wavelength_to_rgb(self, wavelength: float) -> Tuple[float, float, float]:
         """
-        波長をRGB色に変換
+        波長をRGB色に変換（wavelengths_to_rgb の1要素版）
 
         Args:
             wavelength: 波長 (nm)
@@ -237,51 +843,32 @@ class OpticalEngine:
         Returns:
             (R, G, B) 値 (0-1)
         """
-        if wavelength < 380 or wavelength > 750:
-            return (0.0, 0.0, 0.0)
-
-        if 380 <= wavelength < 440:
-            R = -(wavelength - 440) / (440 - 380)
-            G = 0.0
-            B = 1.0
-        elif 440 <= wavelength < 490:
-            R = 0.0
-            G = (wavelength - 440) / (490 - 440)
-            B = 1.0
-        elif 490 <= wavelength < 510:
-            R = 0.0
-            G = 1.0
-            B = -(wavelength - 510) / (510 - 490)
-        elif 510 <= wavelength < 580:
-            R = (wavelength - 510) / (580 - 510)
-            G = 1.0
-            B = 0.0
-        elif 580 <= wavelength < 645:
-            R = 1.0
-            G = -(wavelength - 645) / (645 - 580)
-            B = 0.0
-        elif 645 <= wavelength <= 750:
-            R = 1.0
-            G = 0.0
-            B = 0.0
-
-        # 強度による減衰（紫外線・赤外線領域）
-        factor = 1.0
-        if wavelength < 420:
-            factor = 0.3 + 0.7 * (wavelength - 380) / (420 - 380)
-        elif wavelength > 700:
-            factor = 0.3 + 0.7 * (750 - wavelength) / (750 - 700)
-
-        return (R * factor, G * factor, B * factor)
-
-    def trace_ray(self, ray: Ray, surfaces: List[Surface], max_bounces: int = 10) -> List[Ray]:
+        r, g, b = self.wavelengths_to_rgb(np.array([wavelength]))[0]
+        return (float(r), float(g), float(b))
+
+    def trace_ray(self, ray: Ray, surfaces: List[Surface], max_bounces: int = 10,
+                  accelerator: Optional['SurfaceBVH'] = None,
+                  rng: Optional[np.random.Generator] = None,
+                  policy: PathPolicy = PathPolicy.THRESHOLD,
+                  survival_probability: float = DEFAULT_SURVIVAL_PROBABILITY) -> List[Ray]:
         """
         光線追跡メインルーチン
 
+        policy が PathPolicy.THRESHOLD の場合は強度が 0.01 未満になった時点で
+        経路を打ち切る。PathPolicy.ROULETTE の場合は、透過率（初期強度に対する
+        強度の比）が ROULETTE_THRESHOLD 未満になった経路を確率 survival_probability
+        で生き残らせ、生き残った経路の強度を survival_probability で割る。
+        打ち切りによる強度の期待値の偏りがなくなる。
+
         Args:
             ray: 初期光線
             surfaces: 反射面のリスト
             max_bounces: 最大反射回数
+            accelerator: surfaces から構築した BVH。指定すると全面との総当たりの
+                代わりに BVH で交点を探す
+            rng: 散乱に使う乱数生成器。省略時は新しい乱数生成器（毎回異なる結果）
+            policy: 経路の打ち切りの方式
+            survival_probability: ロシアンルーレットの生存確率 (0, 1]
 
         Returns:
             反射過程の光線リスト
@@ -289,16 +876,31 @@ class OpticalEngine:
         ray_path = [ray]
         current_ray = ray
 
+        # 散乱用の乱数は反射ごとに呼び出さず最大反射回数分をまとめて生成する
+        if rng is None:
+            rng = np.random.default_rng()
+        scatter_samples = np.column_stack([rng.standard_normal(max_bounces),
+                                           rng.random(max_bounces), rng.random(max_bounces)])
+        policy = PathPolicy(policy)
+        if policy == PathPolicy.ROULETTE:
+            check_survival_probability(survival_probability)
+            roulette_samples = rng.random(max_bounces)
+
         for bounce in range(max_bounces):
             # 最も近い交点を見つける
             closest_distance = float('inf')
             closest_surface = None
 
-            for surface in surfaces:
-                distance = self.ray_surface_intersection(current_ray, surface)
-                if distance is not None and distance < closest_distance:
-                    closest_distance = distance
-                    closest_surface = surface
+            if accelerator is not None:
+                distance, index = accelerator.first_hit(current_ray.origin, current_ray.direction)
+                if index >= 0:
+                    closest_distance, closest_surface = distance, surfaces[index]
+            else:
+                for surface in surfaces:
+                    distance = self.ray_surface_intersection(current_ray, surface)
+                    if distance is not None and distance < closest_distance:
+                        closest_distance = distance
+                        closest_surface = surface
 
             # 交点が見つからない場合は終了
             if closest_surface is None:
@@ -315,10 +917,19 @@ class OpticalEngine:
             )
 
             # 反射計算
-            reflected_ray = self.reflect_ray(current_ray, intersection_surface)
-
-            # 強度が閾値以下になったら終了
-            if reflected_ray.intensity < 0.01:
+            reflected_ray = self.reflect_ray(current_ray, intersection_surface,
+                                             scatter_sample=scatter_samples[bounce])
+
+            if policy == PathPolicy.ROULETTE:
+                # 透過率が低い経路はロシアンルーレットで打ち切る
+                if reflected_ray.intensity <= 0.0:
+                    break
+                if reflected_ray.intensity < ROULETTE_THRESHOLD * ray.intensity:
+                    if roulette_samples[bounce] >= survival_probability:
+                        break
+                    reflected_ray.intensity /= survival_probability
+            elif reflected_ray.intensity < 0.01:
+                # 強度が閾値以下になったら終了
                 break
 
             ray_path.append(reflected_ray)
@@ -326,6 +937,272 @@ class OpticalEngine:
 
         return ray_path
 
+    def surface_arrays(self, surfaces: List[Surface]) -> Dict[str, np.ndarray]:
+        """
+        反射面リストをバッチ追跡用の配列にまとめる
+
+        Args:
+            surfaces: 反射面のリスト
+
+        Returns:
+            面ごとの点・法線・平面オフセットと材料特性の配列。'bounds' は有限の面ごとの
+            (面の番号, 辺の始点 (K, 3), 内向きの辺の法線 (K, 3)) のリスト
+        """
+        points = np.array([surface.point for surface in surfaces], dtype=np.float64).reshape(-1, 3)
+        normals = np.array([surface.normal for surface in surfaces], dtype=np.float64).reshape(-1, 3)
+        materials = [self.materials[surface.material_id] for surface in surfaces]
+
+        bounds = [(i, *polygon_edges(surface.vertices)) for i, surface in enumerate(surfaces)
+                  if surface.vertices is not None]
+
+        return {
+            'points': points,
+            'normals': normals,
+            'offsets': np.einsum('ij,ij->i', points, normals),
+            'reflectance': np.array([m.reflectance for m in materials], dtype=np.float64),
+            'roughness': np.array([m.roughness for m in materials], dtype=np.float64),
+            'refractive_index': np.array([m.refractive_index for m in materials], dtype=np.float64),
+            'absorption_coefficient': np.array([m.absorption_coefficient for m in materials],
+                                               dtype=np.float64),
+            'material_ids': np.array([surface.material_id for surface in surfaces], dtype=np.int64),
+            'bounds': bounds,
+        }
+
+    def closest_surfaces(self, origins: np.ndarray, directions: np.ndarray,
+                         arrays: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """全光線 × 全ミラー面の交点距離を一度に計算し、最も近い面を返す（交点なしは inf）"""
+        normals = arrays['normals']
+        denominator = directions @ normals.T
+        numerator = arrays['offsets'][np.newaxis, :] - origins @ normals.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = numerator / denominator
+        valid = (np.abs(denominator) >= 1e-6) & (distances >= 1e-6)
+
+        # 有限の面は交点が多角形の内側にある場合のみ有効
+        for index, starts, inward in arrays['bounds']:
+            hit_distances = np.where(valid[:, index], distances[:, index], 0.0)
+            points = origins + hit_distances[:, np.newaxis] * directions
+            inside = np.einsum('nkj,kj->nk', points[:, np.newaxis, :] - starts, inward)
+            valid[:, index] &= np.all(inside >= -1e-9, axis=1)
+
+        distances = np.where(valid, distances, np.inf)
+        closest = np.argmin(distances, axis=1)
+        return distances[np.arange(len(origins)), closest], closest
+
+    def scatter_reflections(self, reflection_dirs: np.ndarray, surface_normals: np.ndarray,
+                            roughness: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        """
+        表面粗さによる反射方向のランダム散乱の配列版（trace_rays の各反射で使う）
+
+        Args:
+            reflection_dirs: 鏡面反射の方向 (N, 3)。粗い面の行は上書きされる
+            surface_normals: 入射側を向いた面の法線 (N, 3)
+            roughness: 面の粗さ (N,)
+            rng: 乱数生成器
+
+        Returns:
+            正規化した反射方向 (N, 3)
+        """
+        rough = roughness > 0
+        if np.any(rough):
+            rough_normals = surface_normals[rough]
+            scatter_angle = rng.normal(0, roughness[rough])
+
+            tangent1 = np.cross(rough_normals, np.array([1.0, 0.0, 0.0]))
+            degenerate = np.linalg.norm(tangent1, axis=1) < 0.1
+            if np.any(degenerate):
+                tangent1[degenerate] = np.cross(rough_normals[degenerate],
+                                                np.array([0.0, 1.0, 0.0]))
+            tangent1 /= np.linalg.norm(tangent1, axis=1, keepdims=True)
+            tangent2 = np.cross(rough_normals, tangent1)
+
+            count = int(np.count_nonzero(rough))
+            scatter_dirs = (reflection_dirs[rough] +
+                            (scatter_angle * rng.random(count))[:, np.newaxis] * tangent1 +
+                            (scatter_angle * rng.random(count))[:, np.newaxis] * tangent2)
+            reflection_dirs[rough] = scatter_dirs
+
+        reflection_dirs /= np.linalg.norm(reflection_dirs, axis=1, keepdims=True)
+        return reflection_dirs
+
+    def trace_rays(self, origins: np.ndarray, directions: np.ndarray,
+                   wavelengths: np.ndarray, intensities: np.ndarray,
+                   surfaces: List[Surface], max_bounces: int = 10,
+                   polarizations: Optional[np.ndarray] = None,
+                   rng: Optional[np.random.Generator] = None,
+                   accelerator: Optional['SurfaceBVH'] = None,
+                   policy: PathPolicy = PathPolicy.THRESHOLD,
+                   survival_probability: float = DEFAULT_SURVIVAL_PROBABILITY) -> RayBuffer:
+        """
+        光線追跡のバッチ版
+
+        trace_ray と同じ物理（フレネル反射、粗さ散乱、波長吸収、ウェットモード補正、
+        policy に応じた経路の打ち切り）を、全光線の配列に対して反射ごとに一括で適用する。
+        accelerator を省略すると全光線 × 全面の交点を総当たりで求める。
+
+        wavelengths に (N, K) の配列を渡すとスペクトルモードになり、各光線が K 個の
+        波長サンプルを同じ経路で運ぶ（反射の方向は波長によらないため）。減衰は
+        spectral_attenuation で波長サンプルごとに求め、打ち切りは波長サンプルの
+        強度の平均で判定する。
+
+        Args:
+            origins: 光線の起点 (N, 3)
+            directions: 光線の方向ベクトル (N, 3)
+            wavelengths: 波長 (N,)、またはスペクトルモードの波長サンプル (N, K)
+            intensities: 強度 (N,)
+            surfaces: 反射面のリスト
+            max_bounces: 最大反射回数
+            polarizations: 偏光状態 (N, 2)。省略時はs偏光
+            rng: 散乱に使う乱数生成器。省略時は新しい乱数生成器（毎回異なる結果）
+            accelerator: surfaces から構築した BVH（面が多い場合に指定する）
+            policy: 経路の打ち切りの方式（trace_ray と同じ）
+            survival_probability: ロシアンルーレットの生存確率 (0, 1]
+
+        Returns:
+            全光線の反射過程をまとめた RayBuffer。
+            行は (path_index, bounce) の順に並ぶ
+        """
+        origins = np.array(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.array(directions, dtype=np.float64).reshape(-1, 3)
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        num_rays = len(origins)
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        spectral = wavelengths.ndim == 2
+        if spectral:
+            spectral_wavelengths = wavelengths.reshape(num_rays, -1)
+            wavelengths = spectral_wavelengths[:, 0].copy()
+        else:
+            wavelengths = np.broadcast_to(wavelengths, (num_rays,)).copy()
+        intensities = np.broadcast_to(np.asarray(intensities, dtype=np.float64), (num_rays,)).copy()
+        if polarizations is None:
+            polarizations = np.tile(np.array([1.0, 0.0]), (num_rays, 1))
+        else:
+            polarizations = np.array(polarizations, dtype=np.float64).reshape(-1, 2)
+
+        if rng is None:
+            rng = np.random.default_rng()
+        policy = PathPolicy(policy)
+        if policy == PathPolicy.ROULETTE:
+            check_survival_probability(survival_probability)
+
+        # 各反射で生き残った光線を蓄積する
+        segments = {
+            'origins': [origins],
+            'directions': [directions],
+            'wavelengths': [wavelengths],
+            'intensities': [intensities],
+            'polarizations': [polarizations],
+            'path_index': [np.arange(num_rays)],
+            'bounce': [np.zeros(num_rays, dtype=np.int64)],
+        }
+        if spectral:
+            # 各波長サンプルは光線の強度をそのまま持ち、平均が光線の強度になる
+            spectral_intensities = np.repeat(intensities[:, np.newaxis],
+                                             spectral_wavelengths.shape[1], axis=1)
+            segments['spectral_wavelengths'] = [spectral_wavelengths]
+            segments['spectral_intensities'] = [spectral_intensities]
+
+        if surfaces and num_rays:
+            arrays = self.surface_arrays(surfaces)
+            normals = arrays['normals']
+            s_component = polarizations[:, 0]**2
+            p_component = polarizations[:, 1]**2
+
+            active = np.arange(num_rays)
+            current_origins = origins
+            current_directions = directions
+            current_intensities = intensities
+            if spectral:
+                current_spectral = spectral_intensities
+
+            for bounce in range(1, max_bounces + 1):
+                if accelerator is not None:
+                    closest_distance, closest = accelerator.intersect(current_origins,
+                                                                      current_directions)
+                else:
+                    closest_distance, closest = self.closest_surfaces(
+                        current_origins, current_directions, arrays)
+
+                # 交点が見つからない光線は終了
+                hit = np.isfinite(closest_distance)
+                if not np.any(hit):
+                    break
+                active = active[hit]
+                closest = closest[hit]
+                closest_distance = closest_distance[hit]
+                current_origins = current_origins[hit]
+                current_directions = current_directions[hit]
+                current_intensities = current_intensities[hit]
+                if spectral:
+                    current_spectral = current_spectral[hit]
+
+                intersection_points = current_origins + closest_distance[:, np.newaxis] * current_directions
+
+                # 入射角の計算（法線が反対向きの場合は反転）
+                surface_normals = normals[closest]
+                cos_theta_i = -np.einsum('ij,ij->i', current_directions, surface_normals)
+                flip = cos_theta_i < 0
+                surface_normals = np.where(flip[:, np.newaxis], -surface_normals, surface_normals)
+                cos_theta_i = np.abs(cos_theta_i)
+
+                reflection_dirs = current_directions + 2.0 * cos_theta_i[:, np.newaxis] * surface_normals
+
+                # 表面粗さによるランダム散乱
+                reflection_dirs = self.scatter_reflections(
+                    reflection_dirs, surface_normals, arrays['roughness'][closest], rng)
+
+                # 反射率による強度減衰（フレネル反射率・偏光・ウェットモード補正・波長による吸収）
+                if spectral:
+                    new_spectral = current_spectral * self.spectral_attenuation(
+                        arrays['material_ids'][closest], cos_theta_i, s_component[active],
+                        p_component[active], spectral_wavelengths[active])
+                    new_intensities = new_spectral.mean(axis=1)
+                else:
+                    new_intensities = current_intensities * self.reflection_attenuation(
+                        arrays['material_ids'][closest], cos_theta_i, s_component[active],
+                        p_component[active], wavelengths[active])
+
+                if policy == PathPolicy.ROULETTE:
+                    # 透過率が低い光線はロシアンルーレットで打ち切り、生き残りの強度を補正
+                    # 乱数は打ち切り判定の対象の光線だけで引き、散乱の乱数列を THRESHOLD と揃える
+                    roulette = new_intensities < ROULETTE_THRESHOLD * intensities[active]
+                    survive = np.ones(len(active), dtype=bool)
+                    survive[roulette] = (rng.random(int(np.count_nonzero(roulette))) <
+                                         survival_probability)
+                    alive = (new_intensities > 0.0) & survive
+                    new_intensities = np.where(roulette, new_intensities / survival_probability,
+                                               new_intensities)
+                    if spectral:
+                        new_spectral = np.where(roulette[:, np.newaxis],
+                                                new_spectral / survival_probability, new_spectral)
+                else:
+                    # 強度が閾値以下になった光線は終了
+                    alive = new_intensities >= 0.01
+                if not np.any(alive):
+                    break
+                active = active[alive]
+                current_origins = intersection_points[alive]
+                current_directions = reflection_dirs[alive]
+                current_intensities = new_intensities[alive]
+                if spectral:
+                    current_spectral = new_spectral[alive]
+                    segments['spectral_wavelengths'].append(spectral_wavelengths[active])
+                    segments['spectral_intensities'].append(current_spectral)
+
+                segments['origins'].append(current_origins)
+                segments['directions'].append(current_directions)
+                segments['wavelengths'].append(wavelengths[active])
+                segments['intensities'].append(current_intensities)
+                segments['polarizations'].append(polarizations[active])
+                segments['path_index'].append(active)
+                segments['bounce'].append(np.full(len(active), bounce, dtype=np.int64))
+
+        result = {key: np.concatenate(values) for key, values in segments.items()}
+
+        # trace_ray を光線ごとに連結した場合と同じ並び順にそろえる
+        order = np.lexsort((result['bounce'], result['path_index']))
+        return RayBuffer(**{key: values[order] for key, values in result.items()})
+
 # テスト用の使用例
 if __name__ == "__main__":
     # エンジンの初期化
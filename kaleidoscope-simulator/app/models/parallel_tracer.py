@@ -0,0 +1,239 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .optical_engine import (OpticalEngine, RayBuffer, Surface, Material, PhysicsMode, PathPolicy,
+                             DEFAULT_SURVIVAL_PROBABILITY)
+from .unfolded_solver import MirrorGroup, trace_rays_unfolded
+from .surface_bvh import SurfaceBVH
+
+# RayBuffer の列レイアウト (列名, dtype, 1行あたりの要素数)
+_COLUMNS = [
+    ('origins', np.float32, 3),
+    ('directions', np.float32, 3),
+    ('wavelengths', np.float32, 1),
+    ('intensities', np.float64, 1),
+    ('polarizations', np.float32, 2),
+    ('path_index', np.int32, 1),
+    ('bounce', np.int32, 1),
+]
+
+# スペクトルモードで加わる列 (列名, dtype)。1行あたりの要素数は波長サンプル数
+_SPECTRAL_COLUMNS = [
+    ('spectral_wavelengths', np.float32),
+    ('spectral_intensities', np.float64),
+]
+
+# 常駐ワーカープールのプロセス数（一度だけ作り、作り直さない）
+POOL_WORKERS = os.cpu_count() or 1
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _column_layout(capacity: int,
+                   spectral_samples: int = 0) -> Tuple[List[Tuple[str, np.dtype, Tuple[int, ...], int]], int]:
+    """共有メモリ上の列配置（8バイト境界にそろえる）と合計サイズを計算"""
+    columns = list(_COLUMNS)
+    if spectral_samples:
+        columns += [(name, dtype, spectral_samples) for name, dtype in _SPECTRAL_COLUMNS]
+
+    layout = []
+    offset = 0
+    for name, dtype, width in columns:
+        shape = (capacity, width) if width > 1 else (capacity,)
+        layout.append((name, np.dtype(dtype), shape, offset))
+        offset += np.dtype(dtype).itemsize * capacity * width
+        offset = (offset + 7) & ~7
+    return layout, max(offset, 8)
+
+
+def _column_views(buffer, capacity: int, spectral_samples: int = 0) -> Dict[str, np.ndarray]:
+    """共有メモリを列ごとの ndarray として参照"""
+    layout, _ = _column_layout(capacity, spectral_samples)
+    return {
+        name: np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        for name, dtype, shape, offset in layout
+    }
+
+
+def _trace_shard(physics_mode: str, materials: Dict[int, Material], surfaces: List[Surface],
+                 shard: Dict[str, np.ndarray], max_bounces: int,
+                 seed_sequence: np.random.SeedSequence,
+                 mirror_group: Optional[MirrorGroup] = None,
+                 accelerator: Optional[SurfaceBVH] = None,
+                 policy: str = PathPolicy.THRESHOLD.value,
+                 survival_probability: float = DEFAULT_SURVIVAL_PROBABILITY) -> Tuple[str, int]:
+    """
+    ワーカープロセスで1シャードを追跡し、結果を共有メモリに書き込む
+
+    共有メモリは追跡の後に実際の行数で確保する（最大反射回数分を先に確保すると、
+    ほとんどの光線が途中で終わる場合でも初期光線数 × (max_bounces + 1) 行が必要になる）。
+    解放は呼び出し側が行う。
+
+    Returns:
+        (共有メモリの名前, 行数)
+    """
+    engine = OpticalEngine(PhysicsMode(physics_mode))
+    for mat_id, material in materials.items():
+        engine.add_material(mat_id, material)
+
+    if mirror_group is not None:
+        ray_buffer = trace_rays_unfolded(
+            engine, shard['origins'], shard['directions'], shard['wavelengths'],
+            shard['intensities'], surfaces, mirror_group, max_bounces)
+    else:
+        ray_buffer = engine.trace_rays(
+            shard['origins'], shard['directions'], shard['wavelengths'], shard['intensities'],
+            surfaces, max_bounces, rng=np.random.default_rng(seed_sequence),
+            accelerator=accelerator, policy=PathPolicy(policy),
+            survival_probability=survival_probability)
+
+    count = len(ray_buffer)
+    spectral_samples = _spectral_samples(shard)
+    _, size = _column_layout(count, spectral_samples)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    # 共有メモリは呼び出し側が unlink するため、このプロセスの resource_tracker の管理から外す
+    resource_tracker.unregister(block._name, 'shared_memory')
+    try:
+        views = _column_views(block.buf, count, spectral_samples)
+        for name, view in views.items():
+            view[:] = getattr(ray_buffer, name)
+        del views
+    finally:
+        block.close()
+
+    return block.name, count
+
+
+def _read_shard(shm_name: str, count: int, spectral_samples: int) -> Dict[str, np.ndarray]:
+    """ワーカーが書き込んだ共有メモリの列をコピーして解放"""
+    block = shared_memory.SharedMemory(name=shm_name)
+    try:
+        views = _column_views(block.buf, count, spectral_samples)
+        columns = {name: view.copy() for name, view in views.items()}
+        del views
+    finally:
+        block.close()
+        block.unlink()
+    return columns
+
+
+def _release_shard(future):
+    """読み取らなかったシャードの共有メモリを解放（失敗したシャードは何もしない）"""
+    try:
+        shm_name, _ = future.result()
+        block = shared_memory.SharedMemory(name=shm_name)
+    except Exception:
+        return
+    block.close()
+    block.unlink()
+
+
+def _spectral_samples(initial: Dict[str, np.ndarray]) -> int:
+    """初期光線の波長サンプル数（スペクトルモードでなければ 0）"""
+    wavelengths = initial['wavelengths']
+    return wavelengths.shape[1] if wavelengths.ndim == 2 else 0
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    常駐ワーカープールの取得（POOL_WORKERS プロセスで一度だけ作る）
+
+    ワーカー数の多い要求が来ても作り直さないため、他の要求がシャードを投入中の
+    プールを停止することはない。シャード数がプロセス数より多い場合は順に実行される。
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            # eventlet やスレッドとの干渉を避けるため spawn で起動する
+            _executor = ProcessPoolExecutor(max_workers=POOL_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def shutdown_executor():
+    """常駐ワーカープールの停止"""
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+        _executor = None
+
+
+atexit.register(shutdown_executor)
+
+
+def trace_rays_parallel(engine: OpticalEngine, initial: Dict[str, np.ndarray],
+                        surfaces: List[Surface], max_bounces: int, workers: int,
+                        seed: Optional[int] = None,
+                        mirror_group: Optional[MirrorGroup] = None,
+                        accelerator: Optional[SurfaceBVH] = None,
+                        policy: PathPolicy = PathPolicy.THRESHOLD,
+                        survival_probability: float = DEFAULT_SURVIVAL_PROBABILITY) -> RayBuffer:
+    """
+    初期光線をシャードに分割し、プロセスプールで並列に追跡する
+
+    各シャードは SeedSequence から派生した独立の乱数で追跡されるため、
+    同じ seed とワーカー数なら結果は再現する。結果は共有メモリ経由で
+    列ごとに受け取り、光線オブジェクトのピクルは行わない。
+
+    Args:
+        engine: 材料と物理モードを設定済みの光学エンジン
+        initial: generate_initial_ray_arrays の出力（スペクトルモードでは
+            wavelengths が (N, K) の波長サンプル）
+        surfaces: 反射面のリスト
+        max_bounces: 最大反射回数
+        workers: ワーカー数
+        seed: 乱数シード（省略時は毎回異なる結果）
+        mirror_group: 指定すると各シャードを展開ソルバーで追跡する
+        accelerator: surfaces から構築した BVH（各ワーカーに渡して使う）
+        policy: 経路の打ち切りの方式（展開ソルバーでは使わない）
+        survival_probability: ロシアンルーレットの生存確率
+
+    Returns:
+        全シャードを連結した RayBuffer（path_index は初期光線の通し番号）
+    """
+    num_rays = len(initial['origins'])
+    workers = max(1, min(workers, num_rays))
+    seed_sequences = np.random.SeedSequence(seed).spawn(workers)
+    bounds = np.linspace(0, num_rays, workers + 1).astype(int)
+    spectral_samples = _spectral_samples(initial)
+
+    executor = get_executor()
+    futures = []
+    buffers = []
+
+    try:
+        for shard_id in range(workers):
+            start, end = bounds[shard_id], bounds[shard_id + 1]
+            shard = {key: values[start:end] for key, values in initial.items()}
+            futures.append(executor.submit(
+                _trace_shard, engine.physics_mode.value, engine.materials, surfaces,
+                shard, max_bounces, seed_sequences[shard_id], mirror_group, accelerator,
+                PathPolicy(policy).value, survival_probability))
+
+        for shard_id, future in enumerate(futures):
+            shm_name, count = future.result()
+            columns = _read_shard(shm_name, count, spectral_samples)
+            columns['path_index'] = columns['path_index'].astype(np.int64) + bounds[shard_id]
+            buffers.append(RayBuffer(**columns))
+
+    finally:
+        # 途中で失敗した場合も、残りのワーカーが作った共有メモリを解放する
+        for future in futures[len(buffers):]:
+            _release_shard(future)
+
+    if not buffers:
+        return RayBuffer.empty()
+
+    return RayBuffer(**{name: np.concatenate([getattr(buffer, name) for buffer in buffers])
+                        for name in columns})
@@ -0,0 +1,349 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Hashable, List, Optional, TYPE_CHECKING
+
+import numpy as np
+
+from .optical_engine import OpticalEngine, RayBuffer, Surface
+
+if TYPE_CHECKING:
+    from .surface_bvh import SurfaceBVH
+
+# 強度の打ち切りの閾値（trace_rays の PathPolicy.THRESHOLD と同じ）
+INTENSITY_THRESHOLD = 0.01
+
+# 経路の幾何のキャッシュのメモリ上限（既定値, bytes）
+DEFAULT_PATH_CACHE_BYTES = 128 * 1024 * 1024
+
+
+@dataclass
+class PathGeometry:
+    """
+    初期光線ごとの反射の幾何（当たった面・交点・反射後の方向・入射角の余弦）
+
+    波長・強度・材料の反射特性には依存しない部分だけを持ち、減衰は
+    replay_path_geometry で後から計算する。幾何は必要になった反射の分だけ
+    追跡して列を追加する（depth は光線ごとに追跡済みの反射の数で、列は
+    まとめて確保するため depth より多いことがある）。
+    反射 b で面に当たらなかった光線は surface_index[:, b] が -1 で、以降の反射はない。
+    """
+    origins: np.ndarray  # 初期光線の起点 (N, 3)
+    directions: np.ndarray  # 初期光線の方向 (N, 3)
+    max_bounces: int
+    surface_index: np.ndarray  # 反射ごとに当たった面の番号 (N, D) int32、なしは -1
+    hit_points: np.ndarray  # 反射ごとの交点 (N, D, 3)
+    reflected: np.ndarray  # 反射ごとの反射後の方向 (N, D, 3)
+    cos_theta_i: np.ndarray  # 反射ごとの入射角の余弦 (N, D)
+    depth: np.ndarray  # 光線ごとの追跡済みの反射の数 (N,)
+    rng: np.random.Generator  # 粗さによる散乱に使う乱数生成器（追跡を続けるときも同じもの）
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    @classmethod
+    def create(cls, origins: np.ndarray, directions: np.ndarray, max_bounces: int,
+               rng: Optional[np.random.Generator] = None) -> 'PathGeometry':
+        """
+        反射をまだ追跡していない幾何を作る
+
+        Args:
+            origins: 光線の起点 (N, 3)
+            directions: 光線の方向ベクトル (N, 3)
+            max_bounces: 最大反射回数
+            rng: 散乱に使う乱数生成器。省略時は新しい乱数生成器
+
+        Returns:
+            PathGeometry
+        """
+        origins = np.array(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.array(directions, dtype=np.float64).reshape(-1, 3)
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        num_rays = len(origins)
+        return cls(
+            origins=origins,
+            directions=directions,
+            max_bounces=max(0, max_bounces),
+            surface_index=np.empty((num_rays, 0), dtype=np.int32),
+            hit_points=np.empty((num_rays, 0, 3)),
+            reflected=np.empty((num_rays, 0, 3)),
+            cos_theta_i=np.empty((num_rays, 0)),
+            depth=np.zeros(num_rays, dtype=np.int32),
+            rng=rng if rng is not None else np.random.default_rng()
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """全配列の合計メモリ使用量 (bytes)"""
+        return sum(column.nbytes for column in (
+            self.origins, self.directions, self.surface_index, self.hit_points,
+            self.reflected, self.cos_theta_i, self.depth))
+
+    def _grow(self):
+        # 列の追加のたびに全体を複製しないよう、列数を倍にする（max_bounces まで）
+        num_rays, columns = self.surface_index.shape
+        added = min(max(1, columns), self.max_bounces - columns)
+        self.surface_index = np.hstack([self.surface_index,
+                                        np.full((num_rays, added), -1, dtype=np.int32)])
+        self.hit_points = np.concatenate([self.hit_points, np.zeros((num_rays, added, 3))], axis=1)
+        self.reflected = np.concatenate([self.reflected, np.zeros((num_rays, added, 3))], axis=1)
+        self.cos_theta_i = np.hstack([self.cos_theta_i, np.zeros((num_rays, added))])
+
+
+def smooth_surfaces(engine: OpticalEngine, surfaces: List[Surface]) -> bool:
+    """すべての面の粗さが 0 か（反射の経路が初期光線と形状だけで決まるか）"""
+    return all(engine.materials[surface.material_id].roughness == 0 for surface in surfaces)
+
+
+def path_geometry_key(engine: OpticalEngine, surfaces: List[Surface], origins: np.ndarray,
+                      directions: np.ndarray, max_bounces: int) -> str:
+    """
+    PathGeometry のキャッシュのキー（SHA-256）
+
+    幾何を決める面の形状・各面の粗さ・初期光線の起点と方向・最大反射回数から
+    計算する（材料IDや反射率・屈折率・吸収係数、波長・強度には依存しない）。
+    """
+    digest = hashlib.sha256()
+    for surface in surfaces:
+        digest.update(np.asarray(surface.point, dtype=np.float64).tobytes())
+        digest.update(np.asarray(surface.normal, dtype=np.float64).tobytes())
+        if surface.vertices is not None:
+            digest.update(surface.vertices.tobytes())
+        digest.update(np.float64(engine.materials[surface.material_id].roughness).tobytes())
+        digest.update(b'|')
+    digest.update(np.ascontiguousarray(origins, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(directions, dtype=np.float64).tobytes())
+    digest.update(str(max_bounces).encode('ascii'))
+    return digest.hexdigest()
+
+
+def _extend_path_geometry(engine: OpticalEngine, geometry: PathGeometry, arrays: Dict[str, Any],
+                          rays: np.ndarray, bounce: int,
+                          accelerator: Optional['SurfaceBVH'] = None):
+    """rays（昇順の光線番号）の反射 bounce を追跡して記録する（trace_rays の1反射分と同じ）"""
+    if geometry.surface_index.shape[1] <= bounce:
+        geometry._grow()
+    geometry.depth[rays] = bounce + 1
+
+    if bounce == 0:
+        origins = geometry.origins[rays]
+        directions = geometry.directions[rays]
+    else:
+        origins = geometry.hit_points[rays, bounce - 1]
+        directions = geometry.reflected[rays, bounce - 1]
+
+    if accelerator is not None:
+        closest_distance, closest = accelerator.intersect(origins, directions)
+    else:
+        closest_distance, closest = engine.closest_surfaces(origins, directions, arrays)
+
+    hit = np.isfinite(closest_distance)
+    if not np.any(hit):
+        return
+    rays = rays[hit]
+    closest = closest[hit]
+    directions = directions[hit]
+    points = origins[hit] + closest_distance[hit][:, np.newaxis] * directions
+
+    # 入射角の計算（法線が反対向きの場合は反転）
+    surface_normals = arrays['normals'][closest]
+    cosines = -np.einsum('ij,ij->i', directions, surface_normals)
+    surface_normals = np.where((cosines < 0)[:, np.newaxis], -surface_normals, surface_normals)
+    cosines = np.abs(cosines)
+
+    reflection_dirs = directions + 2.0 * cosines[:, np.newaxis] * surface_normals
+    reflection_dirs = engine.scatter_reflections(
+        reflection_dirs, surface_normals, arrays['roughness'][closest], geometry.rng)
+
+    geometry.surface_index[rays, bounce] = closest
+    geometry.hit_points[rays, bounce] = points
+    geometry.reflected[rays, bounce] = reflection_dirs
+    geometry.cos_theta_i[rays, bounce] = cosines
+
+
+def replay_path_geometry(engine: OpticalEngine, geometry: PathGeometry, surfaces: List[Surface],
+                         wavelengths: np.ndarray, intensities: np.ndarray,
+                         polarizations: Optional[np.ndarray] = None,
+                         accelerator: Optional['SurfaceBVH'] = None) -> RayBuffer:
+    """
+    記録した幾何に波長・強度・材料の減衰を適用して RayBuffer を作る
+
+    反射ごとに、生き残っている光線の減衰率をまとめて計算し、強度が閾値未満に
+    なった光線を打ち切る（trace_rays の PathPolicy.THRESHOLD と同じ）。幾何が
+    まだ追跡されていない反射は、その反射まで生き残った光線だけをその場で追跡して
+    geometry に追加する。新しい幾何に対する結果は同じ乱数生成器の trace_rays と
+    一致し、面の粗さが 0 なら2回目以降も一致する（粗い面では記録した散乱を使い回す）。
+
+    surfaces は幾何を記録したときと同じ形状・粗さで、材料IDだけ変わっていてもよい。
+
+    Args:
+        engine: 材料と物理モードを設定済みの光学エンジン
+        geometry: PathGeometry.create で作った幾何（追跡した反射が追加される）
+        surfaces: 反射面のリスト（surface_index が指す面）
+        wavelengths: 波長 (N,)、またはスペクトルモードの波長サンプル (N, K)
+        intensities: 初期強度 (N,)
+        polarizations: 偏光状態 (N, 2)。省略時はs偏光
+        accelerator: surfaces から構築した BVH
+
+    Returns:
+        trace_rays と同じ並び順の RayBuffer
+    """
+    num_rays = len(geometry.origins)
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    spectral = wavelengths.ndim == 2
+    if not spectral:
+        wavelengths = np.broadcast_to(wavelengths, (num_rays,))
+    intensities = np.broadcast_to(np.asarray(intensities, dtype=np.float64), (num_rays,))
+    if polarizations is None:
+        polarizations = np.tile(np.array([1.0, 0.0]), (num_rays, 1))
+    else:
+        polarizations = np.asarray(polarizations, dtype=np.float64).reshape(-1, 2)
+    s_component = polarizations[:, 0]**2
+    p_component = polarizations[:, 1]**2
+
+    with geometry.lock:
+        alive_columns = []
+        hit_columns = []
+        spectral_columns = []
+        if surfaces and num_rays:
+            arrays = engine.surface_arrays(surfaces)
+            active = np.arange(num_rays)
+            current = (np.repeat(intensities[:, np.newaxis], wavelengths.shape[1], axis=1)
+                       if spectral else intensities)
+
+            for bounce in range(geometry.max_bounces):
+                pending = active[geometry.depth[active] <= bounce]
+                if len(pending):
+                    _extend_path_geometry(engine, geometry, arrays, pending, bounce, accelerator)
+
+                closest = geometry.surface_index[active, bounce]
+                hit = closest >= 0
+                if not np.any(hit):
+                    break
+                active = active[hit]
+                closest = closest[hit]
+                current = current[hit]
+
+                # 反射率による強度減衰（フレネル反射率・偏光・ウェットモード補正・波長による吸収）
+                attenuation_args = (arrays['material_ids'][closest],
+                                    geometry.cos_theta_i[active, bounce],
+                                    s_component[active], p_component[active], wavelengths[active])
+                if spectral:
+                    current = current * engine.spectral_attenuation(*attenuation_args)
+                    ray_intensities = current.mean(axis=1)
+                else:
+                    current = current * engine.reflection_attenuation(*attenuation_args)
+                    ray_intensities = current
+
+                alive = ray_intensities >= INTENSITY_THRESHOLD
+                if not np.any(alive):
+                    break
+                active = active[alive]
+                current = current[alive]
+
+                alive_column = np.zeros(num_rays, dtype=bool)
+                alive_column[active] = True
+                alive_columns.append(alive_column)
+                hit_column = np.zeros(num_rays)
+                hit_column[active] = ray_intensities[alive]
+                hit_columns.append(hit_column)
+                if spectral:
+                    spectral_column = np.zeros((num_rays, wavelengths.shape[1]))
+                    spectral_column[active] = current
+                    spectral_columns.append(spectral_column)
+
+        bounces = len(alive_columns)
+        hit_points = geometry.hit_points[:, :bounces]
+        reflected = geometry.reflected[:, :bounces]
+
+    # 初期光線を先頭列にした (N, B + 1) の表から残った行を行優先で取り出すと
+    # (path_index, bounce) の順になる
+    keep = np.column_stack([np.ones(num_rays, dtype=bool)] + alive_columns)
+
+    def table(initial, per_bounce):
+        return np.concatenate([initial[:, np.newaxis], per_bounce], axis=1)[keep]
+
+    path_index = np.broadcast_to(np.arange(num_rays)[:, np.newaxis], keep.shape)[keep]
+    columns = {
+        'origins': table(geometry.origins, hit_points),
+        'directions': table(geometry.directions, reflected),
+        'wavelengths': (wavelengths[:, 0] if spectral else wavelengths)[path_index],
+        'intensities': np.column_stack([intensities] + hit_columns)[keep],
+        'polarizations': polarizations[path_index],
+        'path_index': path_index,
+        'bounce': np.broadcast_to(np.arange(bounces + 1), keep.shape)[keep]
+    }
+    if spectral:
+        initial_spectral = np.repeat(intensities[:, np.newaxis], wavelengths.shape[1], axis=1)
+        columns['spectral_wavelengths'] = wavelengths[path_index]
+        columns['spectral_intensities'] = np.stack([initial_spectral] + spectral_columns,
+                                                   axis=1)[keep]
+    return RayBuffer(**columns)
+
+
+class PathGeometryCache:
+    """
+    path_geometry_key をキーとする PathGeometry のLRUキャッシュ
+
+    合計メモリ使用量（PathGeometry.nbytes）が max_bytes を超えた場合は最も古い
+    ものから破棄する。幾何は再生時に列が追加されて大きくなるため、再生後に
+    put し直してサイズを更新する。
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_PATH_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: 'OrderedDict[Hashable, PathGeometry]' = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[PathGeometry]:
+        """エントリの取得（ヒット時は最近使用として末尾に移動）"""
+        with self._lock:
+            geometry = self._entries.get(key)
+            if geometry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return geometry
+
+    def put(self, key: Hashable, geometry: PathGeometry):
+        """エントリの追加・サイズの更新（上限を超えた分は古いものから破棄）"""
+        size = geometry.nbytes
+        with self._lock:
+            self._bytes -= self._sizes.pop(key, 0)
+            self._entries.pop(key, None)
+            # 単独で上限を超える幾何は保持しない
+            if size > self.max_bytes:
+                return
+            self._entries[key] = geometry
+            self._sizes[key] = size
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest, _ = self._entries.popitem(last=False)
+                self._bytes -= self._sizes.pop(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        """全件の破棄"""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """ヒット・ミス数などの統計"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,207 @@
+import cProfile
+import marshal
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 計測するステージ（記録順）
+STAGES = ('config_load', 'engine_setup', 'surface_creation', 'ray_generation', 'tracing',
+          'projection', 'rasterization', 'serialization')
+
+# 集計するパーセンタイル
+PERCENTILES = (50, 90, 99)
+
+# tracemalloc はプロセス全体で1つなので、同時に計測できるリクエストは1つだけ
+_tracemalloc_lock = threading.Lock()
+
+PROFILE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def current_rss_bytes() -> Optional[int]:
+    """プロセスの常駐メモリ (RSS) をバイト単位で取得（取得できない場合は None）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        # /proc がない環境ではピークRSSで代用（macOS はバイト、Linux はKB単位）
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    return None
+
+
+class StageTimer:
+    """
+    リクエスト内の処理ステージごとの経過時間とピークメモリの計測
+
+    with 文で囲むと、trace_memory が True の場合はその間 tracemalloc で
+    ピークメモリを計測する（他のリクエストが計測中なら省略する）。
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.stages: Dict[str, float] = {}
+        self.peak_memory_bytes: Optional[int] = None
+        self._tracing = False
+
+    def __enter__(self) -> 'StageTimer':
+        if self.trace_memory and _tracemalloc_lock.acquire(blocking=False):
+            if tracemalloc.is_tracing():
+                _tracemalloc_lock.release()
+            else:
+                tracemalloc.start()
+                self._tracing = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._tracing:
+            _, self.peak_memory_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self._tracing = False
+            _tracemalloc_lock.release()
+        return False
+
+    @contextmanager
+    def stage(self, name: str):
+        """ステージの経過時間を計測（同じ名前は加算）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def summary(self) -> Dict:
+        """performance_data に保存する計測結果"""
+        return {
+            'stages': dict(self.stages),
+            'peak_memory_bytes': self.peak_memory_bytes,
+            'rss_bytes': current_rss_bytes()
+        }
+
+
+def percentile_summary(values: List[float]) -> Dict[str, float]:
+    """件数・平均・パーセンタイルの集計"""
+    values = np.asarray(values, dtype=np.float64)
+    summary = {'count': int(len(values)), 'mean': float(values.mean())}
+    for q, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        summary[f'p{q}'] = float(value)
+    return summary
+
+
+def summarize_performance(records: Iterable[Tuple[int, Dict]]) -> Dict:
+    """
+    保存済みの performance_data をステージごと・設定ごとに集計
+
+    Args:
+        records: (設定ID, performance_data) の列
+
+    Returns:
+        'overall' と 'by_config'（設定ID → 集計）。それぞれステージごとの
+        所要時間 (秒) と rays_per_sec・peak_memory_bytes のパーセンタイルを含む
+    """
+    samples: Dict[str, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+
+    for config_id, performance in records:
+        for scope in ('overall', str(config_id)):
+            bucket = samples[scope]
+            for name, seconds in (performance.get('stages') or {}).items():
+                bucket[name].append(seconds)
+            for metric in ('rays_per_sec', 'peak_memory_bytes'):
+                if performance.get(metric) is not None:
+                    bucket[metric].append(performance[metric])
+
+    def summarize(bucket):
+        ordered = sorted(bucket, key=lambda name: (STAGES.index(name) if name in STAGES
+                                                   else len(STAGES), name))
+        return {name: percentile_summary(bucket[name]) for name in ordered}
+
+    return {
+        'overall': summarize(samples.pop('overall', {})),
+        'by_config': {scope: summarize(bucket) for scope, bucket in samples.items()}
+    }
+
+
+class ProfileCapture:
+    """1回分のプロファイル取得結果"""
+
+    def __init__(self, profile_id: str):
+        self.profile_id = profile_id
+        self.path: Optional[str] = None
+
+
+class ProfileStore:
+    """
+    cProfile による単一リクエストのプロファイル取得と .prof ファイルの保存
+
+    ファイルはディレクトリに保存するため、複数ワーカープロセスのどれからでも
+    ダウンロードできる。max_profiles を超えた古いファイルは削除する。
+    """
+
+    def __init__(self, directory: str, max_profiles: int = 20):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+
+    def path_for(self, profile_id: str) -> Optional[str]:
+        """プロファイルIDに対応するファイルパス（不正なIDや存在しない場合は None）"""
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        path = os.path.join(self.directory, f'{profile_id}.prof')
+        return path if os.path.exists(path) else None
+
+    @contextmanager
+    def capture(self):
+        """
+        with 文の間の処理をプロファイルし、終了時に pstats 形式で保存
+
+        Yields:
+            ProfileCapture（終了後に path が設定される）
+        """
+        capture = ProfileCapture(uuid.uuid4().hex)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield capture
+        finally:
+            profiler.disable()
+            capture.path = self._save(capture.profile_id, profiler)
+
+    def _save(self, profile_id: str, profiler: cProfile.Profile) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{profile_id}.prof')
+        temp_path = f'{path}.tmp'
+
+        # cProfile.Profile.dump_stats と同じ形式（pstats.Stats で読み込める）
+        profiler.create_stats()
+        with open(temp_path, 'wb') as f:
+            marshal.dump(profiler.stats, f)
+        os.replace(temp_path, path)
+
+        self._prune()
+        return path
+
+    def _prune(self):
+        with self._lock:
+            try:
+                files = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                         if name.endswith('.prof')]
+                files.sort(key=os.path.getmtime, reverse=True)
+                for path in files[self.max_profiles:]:
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,174 @@
+import io
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def parse_tile(tile: Dict, width: int, height: int) -> Tuple[int, int, int, int]:
+    """
+    リクエストのタイル {"x", "y", "width", "height"} の検証
+
+    タイルは幅・高さが 1 以上で、width × height の画像の内側に収まる必要がある。
+
+    Returns:
+        (x, y, width, height)
+
+    Raises:
+        ValueError: キーが欠けている・整数でない・画像の範囲外の場合
+    """
+    if not isinstance(tile, dict):
+        raise ValueError("tile must be an object with x, y, width and height")
+    try:
+        x, y, tile_width, tile_height = (int(tile[key]) for key in ('x', 'y', 'width', 'height'))
+    except KeyError as e:
+        raise ValueError(f"tile is missing {e.args[0]!r}")
+    except (TypeError, ValueError):
+        raise ValueError("tile x, y, width and height must be integers")
+    if tile_width < 1 or tile_height < 1:
+        raise ValueError(f"tile width and height must be at least 1: {tile_width}x{tile_height}")
+    if x < 0 or y < 0 or x + tile_width > width or y + tile_height > height:
+        raise ValueError(f"tile ({x}, {y}, {tile_width}, {tile_height}) is outside "
+                         f"the {width}x{height} image")
+    return x, y, tile_width, tile_height
+
+
+class PatternRasterizer:
+    """
+    投影されたパターン点を固定解像度の画像バッファに蓄積するクラス
+
+    点ごとに強度×波長RGBで重み付けして (H, W, 3) の浮動小数点バッファへ加算し、
+    トーンマッピングしてPNGなどに変換する。出力サイズは光線数ではなく解像度で決まる。
+    """
+
+    def __init__(self, width: int = 512, height: int = 512, extent: float = 2.0,
+                 exposure: float = 1.0, gamma: float = 2.2):
+        """
+        Args:
+            width: 画像の幅 (px)
+            height: 画像の高さ (px)
+            extent: 画像の中心から端までの観察面上の距離
+            exposure: トーンマッピング前の露出倍率
+            gamma: 出力ガンマ
+        """
+        self.width = width
+        self.height = height
+        self.extent = extent
+        self.exposure = exposure
+        self.gamma = gamma
+        self.accumulation = np.zeros((height, width, 3), dtype=np.float64)
+        self.sample_count = 0
+
+    def clear(self):
+        """蓄積バッファのリセット"""
+        self.accumulation.fill(0.0)
+        self.sample_count = 0
+
+    def symmetry_transforms(self, mirror_count: int) -> np.ndarray:
+        """
+        万華鏡の N 回対称（二面体群 D_N）の線形変換を列挙
+
+        Returns:
+            (2N, 2, 2) の回転・鏡映行列（mirror_count が 1 以下なら恒等変換のみ）
+        """
+        if mirror_count <= 1:
+            return np.eye(2)[np.newaxis]
+
+        transforms = []
+        for k in range(mirror_count):
+            angle = 2.0 * np.pi * k / mirror_count
+            c, s = np.cos(angle), np.sin(angle)
+            # 回転
+            transforms.append([[c, -s], [s, c]])
+            # 角度 angle/2 の軸に関する鏡映
+            transforms.append([[c, s], [s, -c]])
+        return np.array(transforms)
+
+    def accumulate(self, projected: Dict[str, np.ndarray], mirror_count: int = 1):
+        """
+        投影済みの点を蓄積バッファに加算
+
+        Args:
+            projected: project_pattern の出力 (x, y, intensity, rgb)
+            mirror_count: 対称性を適用するミラー数（1 以下なら適用しない）
+        """
+        points = np.column_stack([projected['x'], projected['y']]).astype(np.float64)
+        weights = np.asarray(projected['rgb'], dtype=np.float64) * \
+            np.asarray(projected['intensity'], dtype=np.float64)[:, np.newaxis]
+        self.sample_count += len(points)
+        if not len(points):
+            return
+
+        transforms = self.symmetry_transforms(mirror_count)
+        # 対称コピーの分だけエネルギーを分配する
+        weights = weights / len(transforms)
+
+        all_points = np.einsum('kij,nj->kni', transforms, points).reshape(-1, 2)
+        all_weights = np.tile(weights, (len(transforms), 1))
+
+        self.splat(all_points, all_weights)
+
+    def splat(self, points: np.ndarray, weights: np.ndarray):
+        """座標 (N, 2) と重み (N, 3) を最近傍ピクセルに加算"""
+        scale_x = self.width / (2.0 * self.extent)
+        scale_y = self.height / (2.0 * self.extent)
+        ix = np.floor((points[:, 0] + self.extent) * scale_x).astype(np.int64)
+        # 画像の上方向を +y にする
+        iy = np.floor((self.extent - points[:, 1]) * scale_y).astype(np.int64)
+
+        inside = (ix >= 0) & (ix < self.width) & (iy >= 0) & (iy < self.height)
+        flat_index = iy[inside] * self.width + ix[inside]
+        weights = weights[inside]
+
+        size = self.width * self.height
+        flat = self.accumulation.reshape(size, 3)
+        for channel in range(3):
+            flat[:, channel] += np.bincount(flat_index, weights=weights[:, channel], minlength=size)
+
+    def tone_map(self) -> np.ndarray:
+        """
+        蓄積バッファを8bit RGB に変換
+
+        明るい画素の99.5パーセンタイルを基準に正規化し、
+        Reinhard 演算子とガンマ補正を適用する。
+        """
+        luminance = self.accumulation.max(axis=2)
+        lit = luminance[luminance > 0]
+        if not lit.size:
+            return np.zeros((self.height, self.width, 3), dtype=np.uint8)
+
+        reference = np.percentile(lit, 99.5)
+        scaled = self.accumulation * (self.exposure / max(reference, 1e-12))
+        mapped = scaled / (1.0 + scaled)
+        # 基準値が白に近くなるよう Reinhard の出力を引き伸ばす
+        mapped = np.clip(mapped * 2.0, 0.0, 1.0) ** (1.0 / self.gamma)
+        return (mapped * 255.0 + 0.5).astype(np.uint8)
+
+    def crop(self, image: np.ndarray, tile: Optional[Tuple[int, int, int, int]]) -> np.ndarray:
+        """タイル (x, y, width, height) の切り出し（範囲は parse_tile で検証済みであること）"""
+        if tile is None:
+            return image
+        x, y, width, height = tile
+        return image[y:y + height, x:x + width]
+
+    def encode_png(self, tile: Optional[Tuple[int, int, int, int]] = None) -> Tuple[bytes, Tuple[int, int]]:
+        """
+        トーンマッピング済み画像をPNGにエンコード
+
+        Returns:
+            (PNGバイト列, (幅, 高さ))
+        """
+        image = self.crop(self.tone_map(), tile)
+        output = io.BytesIO()
+        Image.fromarray(image).save(output, format='PNG')
+        return output.getvalue(), (image.shape[1], image.shape[0])
+
+    def encode_raw(self, tile: Optional[Tuple[int, int, int, int]] = None) -> Tuple[bytes, Tuple[int, int]]:
+        """
+        トーンマッピング済み画像を RGB8 の生バイト列で返す
+
+        Returns:
+            (バイト列, (幅, 高さ))
+        """
+        image = np.ascontiguousarray(self.crop(self.tone_map(), tile))
+        return image.tobytes(), (image.shape[1], image.shape[0])
@@ -0,0 +1,225 @@
+import time
+from typing import Any, Dict, List, Optional, Union, TYPE_CHECKING
+
+import numpy as np
+
+from .inline_config import config_to_request, is_inline_config
+from .optical_engine import (TraceSolver, PathPolicy, DEFAULT_SURVIVAL_PROBABILITY,
+                             check_spectral_samples)
+from .profiling import StageTimer
+from .sampling import SamplingMode
+
+if TYPE_CHECKING:
+    from .kaleidoscope_simulator import KaleidoscopeSimulator
+
+# 設定の内容を表すキー（差分でこれらを変更すると、設定IDで指定した設定をインライン設定に展開する）
+CONFIG_FIELDS = ('name', 'mirror_count', 'mirror_angles', 'material_ids', 'physics_mode',
+                 'light_sources', 'surfaces')
+
+# 要素ごとの差分 {"インデックス": 値} を受け付ける配列のキー
+INDEXED_FIELDS = ('material_ids', 'light_sources', 'surfaces')
+
+
+def apply_config_delta(base: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    リクエストに差分を適用した新しいリクエストを作る（base は変更しない）
+
+    差分の各キーは base の値を置き換え、値が null のキーは base から削除する。
+    INDEXED_FIELDS の値にはオブジェクト {"インデックス": 値} も使え、その要素だけを
+    置き換える（要素と値がどちらもオブジェクトなら、指定したキーだけを更新する）。
+
+    Args:
+        base: 差分の基準のリクエスト
+        delta: 差分
+
+    Returns:
+        差分を適用したリクエスト
+
+    Raises:
+        ValueError: 差分がオブジェクトでない、インデックスが不正・範囲外の場合
+    """
+    if not isinstance(delta, dict):
+        raise ValueError("delta must be an object")
+
+    request = dict(base)
+    for key, value in delta.items():
+        if value is None:
+            request.pop(key, None)
+        elif key in INDEXED_FIELDS and isinstance(value, dict):
+            request[key] = _apply_indexed(request.get(key), value, key)
+        else:
+            request[key] = value
+    return request
+
+
+def _apply_indexed(items: Any, changes: Dict[str, Any], field: str) -> List:
+    if not isinstance(items, list):
+        raise ValueError(f"{field} has no entries to update")
+    items = list(items)
+    for index, value in changes.items():
+        try:
+            position = int(index)
+        except ValueError:
+            raise ValueError(f"{field} index must be an integer: {index!r}")
+        if not 0 <= position < len(items):
+            raise ValueError(f"{field} index out of range: {position}")
+        if isinstance(value, dict) and isinstance(items[position], dict):
+            items[position] = dict(items[position], **value)
+        else:
+            items[position] = value
+    return items
+
+
+class RealtimeSession:
+    """
+    リアルタイムシミュレーションのセッション（WebSocket の接続ごと）
+
+    差分の基準になるリクエストと前のフレームの初期光線を保持し、変更の影響を
+    受けない状態を次のフレームで再利用する。
+
+    - 初期光線の方向は光源の位置・光線数・サンプリング方式・seed だけで決まるため、
+      光源の波長・強度の変更では生成し直さない
+    - 反射の幾何（PathGeometry）は初期光線・ミラーの形状・各面の粗さ・最大反射回数で
+      決まるため、波長・強度・物理モード・粗さの同じ材料への変更では追跡し直さず、
+      減衰の計算だけを行う（simulator.trace_cached_paths）。粗さ 0 の面の結果は毎回
+      追跡した場合と一致し、粗い面では散乱のサンプルを使い回す
+
+    seed を指定しないフレームではセッション固有の seed を使うため、同じ設定の
+    フレームは同じ結果になる（スライダー操作中に模様がちらつかない）。
+    """
+
+    def __init__(self, simulator: 'KaleidoscopeSimulator'):
+        self.simulator = simulator
+        self.base: Optional[Dict[str, Any]] = None
+        self.seed = int(np.random.SeedSequence().entropy)
+        self._initial_key = None
+        self._initial = None
+
+    def set_base(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """差分の基準になるリクエストを設定"""
+        if not isinstance(request, dict):
+            raise ValueError("realtime_simulation message must be an object")
+        self.base = dict(request)
+        return self.base
+
+    def apply_delta(self, delta: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        基準のリクエストに差分を適用し、新しい基準にする
+
+        基準が設定ID（DBの設定）を指していて差分が設定の内容を変更する場合は、
+        その設定をインライン設定に展開してから差分を適用する（DBは変更しない）。
+
+        Returns:
+            差分を適用したリクエスト
+
+        Raises:
+            ValueError: 基準のリクエストがない、差分が不正な場合
+        """
+        if self.base is None:
+            raise ValueError("No base configuration in this session; "
+                             "send a realtime_simulation message without delta first")
+        if not isinstance(delta, dict):
+            raise ValueError("delta must be an object")
+
+        base = self.base
+        if any(field in delta for field in CONFIG_FIELDS) and not is_inline_config(base):
+            config_id = delta.get('config_id', base.get('config_id')) or 1
+            config = self.simulator.prepare_config(config_id)['config']
+            base = dict(base, **config_to_request(config))
+            delta = {key: value for key, value in delta.items() if key != 'config_id'}
+
+        self.base = apply_config_delta(base, delta)
+        return self.base
+
+    def simulate(self, config_id: Union[int, Dict], num_rays: int = 50, max_bounces: int = 5,
+                 seed: Optional[int] = None, timer: Optional[StageTimer] = None, save: bool = True,
+                 solver: TraceSolver = TraceSolver.BOUNCE,
+                 sampling: SamplingMode = SamplingMode.RANDOM,
+                 policy: PathPolicy = PathPolicy.THRESHOLD,
+                 survival_probability: float = DEFAULT_SURVIVAL_PROBABILITY,
+                 spectral_samples: int = 0) -> Dict:
+        """
+        前のフレームの状態を再利用してシミュレーションを実行
+
+        引数と戻り値は KaleidoscopeSimulator.run_simulation と同じ（常に配列でまとめて
+        追跡する）。performance['reuse'] に設定・初期光線・反射の幾何を再利用したかが入る。
+        展開ソルバーとロシアンルーレットは経路が強度や乱数に依存するため、
+        run_simulation でそのまま追跡する。
+        """
+        start_time = time.time()
+        if timer is None:
+            timer = StageTimer()
+        solver = TraceSolver(solver)
+        sampling = SamplingMode(sampling)
+        policy = PathPolicy(policy)
+        check_spectral_samples(spectral_samples)
+        if seed is None:
+            seed = self.seed
+
+        if solver != TraceSolver.BOUNCE or policy != PathPolicy.THRESHOLD:
+            return self.simulator.run_simulation(
+                config_id, num_rays, max_bounces, seed=seed, timer=timer, save=save,
+                solver=solver, sampling=sampling, policy=policy,
+                survival_probability=survival_probability, spectral_samples=spectral_samples)
+
+        prepared = self.simulator.prepare_config(config_id, timer)
+        config = prepared['config']
+        surfaces = prepared['surfaces']
+        generation_seed, trace_seed = np.random.SeedSequence(seed).spawn(2)
+
+        # 初期光線の方向（と代表波長）は光源の波長・強度に依存しない
+        initial_key = (tuple(tuple(light_source[2:5]) for light_source in config['light_sources']),
+                       num_rays, sampling, spectral_samples, seed)
+        initial_reused = initial_key == self._initial_key
+        with timer.stage('ray_generation'):
+            if not initial_reused:
+                self._initial = self.simulator.generate_initial_ray_arrays(
+                    config, num_rays, rng=np.random.default_rng(generation_seed),
+                    sampling=sampling, spectral_samples=spectral_samples)
+                self._initial_key = initial_key
+            initial = self._initial
+            wavelengths, intensities = self.simulator.light_source_values(config, num_rays)
+            if spectral_samples:
+                wavelengths = initial['wavelengths']
+        initial_count = len(initial['origins'])
+
+        # 反射の幾何は初期光線・面の形状と粗さだけに依存する（材料IDは減衰の計算で使う）
+        with timer.stage('tracing'):
+            ray_buffer, geometry_reused = self.simulator.trace_cached_paths(
+                prepared, dict(initial, wavelengths=wavelengths, intensities=intensities),
+                max_bounces, np.random.default_rng(trace_seed))
+
+        computation_time = time.time() - start_time
+        performance = {
+            'ray_count': len(ray_buffer),
+            'computation_time': computation_time,
+            'initial_rays': initial_count,
+            'workers': 1,
+            'solver': solver.value,
+            'sampling': sampling.value,
+            'policy': policy.value,
+            'spectral_samples': spectral_samples,
+            'config_cache_hit': prepared['cache_hit'],
+            'path_cache_hit': geometry_reused,
+            'reuse': {
+                'config': prepared['cache_hit'],
+                'initial_rays': initial_reused,
+                'path_geometry': geometry_reused
+            },
+            'avg_bounces': len(ray_buffer) / initial_count if initial_count else 0,
+            'total_intensity': ray_buffer.total_intensity(),
+            'rays_per_sec': initial_count / computation_time if computation_time > 0 else 0.0,
+            'stages': dict(timer.stages)
+        }
+
+        self.simulator.performance_metrics = performance
+
+        if save:
+            self.simulator.save_simulation_result(config_id, timer, performance)
+
+        return {
+            'config': config,
+            'ray_paths': ray_buffer,
+            'surfaces': surfaces,
+            'performance': performance
+        }
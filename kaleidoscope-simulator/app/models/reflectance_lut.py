@@ -0,0 +1,279 @@
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Tuple
+
+import numpy as np
+
+# テーブルの線形補間と厳密な式との差（減衰率の絶対誤差）の上限
+LUT_TOLERANCE = 1e-5
+
+# テーブルの区間数の初期値と上限（許容誤差に収まるまで倍にする）
+MIN_TABLE_INTERVALS = 256
+MAX_TABLE_INTERVALS = 65536
+
+# 吸収テーブルの波長範囲 (nm)。範囲外の波長は厳密な式で計算する
+WAVELENGTH_RANGE = (360.0, 830.0)
+
+# ウェットモードの反射率の倍率（OpticalEngine と同じ）
+WET_REFLECTANCE_FACTOR = 1.1
+
+# プロセス内で保持するテーブルの上限（超えた場合は最も長く使われていないものを破棄）
+MAX_CACHED_TABLES = 64
+
+_TABLES: 'OrderedDict[Tuple[float, float, float, bool], ReflectanceTable]' = OrderedDict()
+_tables_lock = threading.Lock()
+
+
+def fresnel_reflectance(cos_theta_i: np.ndarray, refractive_index: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    空気から屈折率 refractive_index の材料への反射のフレネル反射率（厳密な式）
+
+    OpticalEngine.fresnel_coefficients と同じ式を入射角の余弦から計算する。
+
+    Args:
+        cos_theta_i: 入射角の余弦 (N,)
+        refractive_index: 材料の屈折率
+
+    Returns:
+        (rs, rp): s偏光とp偏光の反射率 (N,)
+    """
+    cos_theta_i = np.asarray(cos_theta_i, dtype=np.float64)
+    sin_theta_t = np.sqrt(np.maximum(0.0, 1.0 - cos_theta_i**2)) / refractive_index
+    total_reflection = sin_theta_t > 1.0
+    cos_theta_t = np.sqrt(np.maximum(0.0, 1.0 - sin_theta_t**2))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rs = ((cos_theta_i - refractive_index * cos_theta_t) /
+              (cos_theta_i + refractive_index * cos_theta_t))**2
+        rp = ((refractive_index * cos_theta_i - cos_theta_t) /
+              (refractive_index * cos_theta_i + cos_theta_t))**2
+    # 分母が 0 になるのは屈折率 1 で入射角 90 度の場合だけで、極限は 0
+    rs = np.where(total_reflection, 1.0, np.nan_to_num(rs, nan=0.0))
+    rp = np.where(total_reflection, 1.0, np.nan_to_num(rp, nan=0.0))
+    return rs, rp
+
+
+@dataclass
+class ReflectanceTable:
+    """
+    材料ごとの反射1回あたりの減衰率の参照テーブル
+
+    フレネル反射率（材料の反射率とウェットモードの倍率を掛けたもの）を入射角の
+    余弦で、波長による吸収を波長で引けるようにし、反射ごとの arccos・三角関数・
+    指数関数を線形補間に置き換える。全反射の境界の余弦 c0 の直後は反射率が
+    sqrt(c - c0) の形で急に変わるため、フレネルのテーブルは c ではなく
+    t = sqrt(c - c0) の等間隔でとる（c < c0 は全反射で反射率一定）。
+    構築時に区間の中間点で厳密な式と比べ、誤差が LUT_TOLERANCE 以下になるまで
+    区間数を増やす。達成した誤差は max_error に入る。
+
+    各行は (値, 次の行との差) を並べてあり、補間は1回の行の参照と積和で済む。
+    最後の行は端の値の複製で、端ちょうどの位置でも範囲外を参照しない。
+    """
+    critical_cos: float  # 全反射の境界の余弦 c0（全反射がない材料は 0）
+    fresnel_scale: float  # t からテーブルの位置への倍率
+    fresnel_rows: np.ndarray  # (s, p, s の差, p の差) の行 (M + 2, 4)
+    total_reflection: float  # 全反射時の減衰率（反射率 × ウェットモードの倍率）
+    absorption_scale: float  # 波長からテーブルの位置への倍率
+    absorption_rows: np.ndarray  # (吸収による減衰率, 差) の行 (K + 2, 2)
+    absorption_coefficient: float
+    clip: bool  # 減衰率を 1 で頭打ちにするか（ウェットモード）
+    max_error: float  # 構築時に確認した最大誤差
+
+    def __post_init__(self):
+        # trace_ray の1本ずつの参照は Python のリストの方が速い
+        self._fresnel_list = self.fresnel_rows.tolist()
+        self._absorption_list = self.absorption_rows.tolist()
+
+    @classmethod
+    def build(cls, reflectance: float, refractive_index: float,
+              absorption_coefficient: float, wet: bool = False) -> 'ReflectanceTable':
+        """
+        材料特性からテーブルを構築
+
+        Args:
+            reflectance: 材料の反射率
+            refractive_index: 材料の屈折率
+            absorption_coefficient: 材料の吸収係数
+            wet: ウェットモードか
+
+        Returns:
+            ReflectanceTable
+        """
+        scale = reflectance * (WET_REFLECTANCE_FACTOR if wet else 1.0)
+        critical_cos = math.sqrt(1.0 - refractive_index**2) if refractive_index < 1.0 else 0.0
+        # 屈折率 0 のような退化した材料でも区間幅が 0 にならないようにする
+        t_max = max(math.sqrt(1.0 - critical_cos), 1e-12)
+
+        def exact_fresnel(t):
+            rs, rp = fresnel_reflectance(critical_cos + t**2, refractive_index)
+            return np.column_stack([scale * rs, scale * rp])
+
+        def exact_absorption(wavelengths):
+            return np.exp(-absorption_coefficient * wavelengths / 1000.0)[:, np.newaxis]
+
+        low, high = WAVELENGTH_RANGE
+        fresnel_rows, fresnel_error = _build_rows(exact_fresnel, 0.0, t_max)
+        absorption_rows, absorption_error = _build_rows(exact_absorption, low, high)
+
+        return cls(
+            critical_cos=critical_cos,
+            fresnel_scale=(len(fresnel_rows) - 2) / t_max,
+            fresnel_rows=fresnel_rows,
+            total_reflection=scale,
+            absorption_scale=(len(absorption_rows) - 2) / (high - low),
+            absorption_rows=absorption_rows,
+            absorption_coefficient=absorption_coefficient,
+            clip=wet,
+            # 減衰率はフレネル項（scale 以下）と吸収項（1 以下）の積
+            max_error=float(fresnel_error + absorption_error * scale)
+        )
+
+    def fresnel(self, cos_theta_i: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        s偏光・p偏光の減衰率（反射率とウェットモードの倍率を含む）
+
+        Args:
+            cos_theta_i: 入射角の余弦 (N,)
+
+        Returns:
+            (s偏光の減衰率, p偏光の減衰率) (N,)
+        """
+        cos_theta_i = np.asarray(cos_theta_i, dtype=np.float64)
+        if self.critical_cos > 0.0:
+            offset = cos_theta_i - self.critical_cos
+            position = np.sqrt(np.maximum(offset, 0.0))
+        else:
+            offset = None
+            position = np.sqrt(np.abs(cos_theta_i))
+        # 余弦の丸め誤差で 1 をわずかに超えても端の行（複製）に収める
+        position = np.minimum(position * self.fresnel_scale, len(self.fresnel_rows) - 2)
+        index = position.astype(np.intp)
+        fraction = position - index
+        rows = self.fresnel_rows[index]
+        s = rows[:, 0] + fraction * rows[:, 2]
+        p = rows[:, 1] + fraction * rows[:, 3]
+        if offset is not None:
+            total_reflection = offset < 0.0
+            if np.any(total_reflection):
+                s[total_reflection] = self.total_reflection
+                p[total_reflection] = self.total_reflection
+        return s, p
+
+    def absorption_factor(self, wavelengths: np.ndarray) -> np.ndarray:
+        """波長による吸収の減衰率 (N,)"""
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        low, _ = WAVELENGTH_RANGE
+        position = (wavelengths - low) * self.absorption_scale
+        outside = (position < 0.0) | (position > len(self.absorption_rows) - 2)
+        if np.any(outside):
+            position = np.clip(position, 0.0, len(self.absorption_rows) - 2)
+        index = position.astype(np.intp)
+        rows = self.absorption_rows[index]
+        factor = rows[:, 0] + (position - index) * rows[:, 1]
+        if np.any(outside):
+            factor[outside] = np.exp(-self.absorption_coefficient * wavelengths[outside] / 1000.0)
+        return factor
+
+    def attenuation(self, cos_theta_i: np.ndarray, s_component: np.ndarray,
+                    p_component: np.ndarray, wavelengths: np.ndarray) -> np.ndarray:
+        """
+        反射1回あたりの強度の減衰率
+
+        reflect_ray の「反射率 ×（rs × s成分 + rp × p成分）、ウェットモードでは
+        ×1.1 して 1 で頭打ち、さらに波長による吸収」と同じ値をテーブルから求める。
+
+        Args:
+            cos_theta_i: 入射角の余弦 (N,)
+            s_component: s偏光の成分の二乗 (N,)
+            p_component: p偏光の成分の二乗 (N,)
+            wavelengths: 波長 (N,)
+
+        Returns:
+            減衰率 (N,)
+        """
+        s, p = self.fresnel(cos_theta_i)
+        reflectance = s * s_component + p * p_component
+        if self.clip:
+            reflectance = np.minimum(1.0, reflectance)
+        return reflectance * self.absorption_factor(wavelengths)
+
+    def attenuation_scalar(self, cos_theta_i: float, s_component: float,
+                           p_component: float, wavelength: float) -> float:
+        """attenuation の1本分（trace_ray 用。配列を作らず Python の数値で計算する）"""
+        offset = cos_theta_i - self.critical_cos
+        if offset < 0.0:
+            s = p = self.total_reflection
+        else:
+            position = min(math.sqrt(offset) * self.fresnel_scale, len(self._fresnel_list) - 2)
+            index = int(position)
+            fraction = position - index
+            s0, p0, ds, dp = self._fresnel_list[index]
+            s = s0 + fraction * ds
+            p = p0 + fraction * dp
+        reflectance = s * s_component + p * p_component
+        if self.clip:
+            reflectance = min(1.0, reflectance)
+
+        low, high = WAVELENGTH_RANGE
+        if low <= wavelength <= high:
+            position = (wavelength - low) * self.absorption_scale
+            index = int(position)
+            value, difference = self._absorption_list[index]
+            absorption = value + (position - index) * difference
+        else:
+            absorption = math.exp(-self.absorption_coefficient * wavelength / 1000.0)
+        return reflectance * absorption
+
+
+def _build_rows(exact, low: float, high: float) -> Tuple[np.ndarray, float]:
+    """
+    [low, high] の等間隔で (値, 差) の行を作り、許容誤差に収まるまで区間数を倍にする
+
+    Args:
+        exact: 位置の配列 (N,) から厳密な値 (N, C) を返す関数
+        low: 範囲の下端
+        high: 範囲の上端
+
+    Returns:
+        (行 (M + 2, 2C), 区間の4等分点で確認した最大誤差)
+    """
+    intervals = MIN_TABLE_INTERVALS
+    while True:
+        nodes = np.linspace(low, high, intervals + 1)
+        values = exact(nodes)
+        check = np.linspace(low, high, 4 * intervals + 1)
+        # 各確認点の属する区間での線形補間
+        index = np.minimum(np.arange(len(check)) // 4, intervals - 1)
+        fraction = ((check - nodes[index]) / (nodes[1] - nodes[0]))[:, np.newaxis]
+        interpolated = values[index] * (1.0 - fraction) + values[index + 1] * fraction
+        error = float(np.max(np.abs(interpolated - exact(check))))
+        if error <= LUT_TOLERANCE or intervals >= MAX_TABLE_INTERVALS:
+            break
+        intervals *= 2
+
+    values = np.vstack([values, values[-1:]])
+    differences = np.vstack([np.diff(values, axis=0), np.zeros((1, values.shape[1]))])
+    return np.ascontiguousarray(np.hstack([values, differences])), error
+
+
+def get_reflectance_table(reflectance: float, refractive_index: float,
+                          absorption_coefficient: float, wet: bool = False) -> ReflectanceTable:
+    """
+    材料特性ごとのテーブルの取得（プロセス内で設定をまたいで共有する）
+
+    材料を編集するたびに特性の異なるテーブルが増えないよう、ConfigCache と同じく
+    MAX_CACHED_TABLES 件の LRU で保持する。
+    """
+    key = (float(reflectance), float(refractive_index), float(absorption_coefficient), bool(wet))
+    with _tables_lock:
+        table = _TABLES.get(key)
+        if table is None:
+            table = ReflectanceTable.build(*key)
+            _TABLES[key] = table
+            while len(_TABLES) > MAX_CACHED_TABLES:
+                _TABLES.popitem(last=False)
+        else:
+            _TABLES.move_to_end(key)
+        return table
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+# キャッシュ状態（X-Cache ヘッダーの値）
+CACHE_HIT = 'HIT'
+CACHE_MISS = 'MISS'
+CACHE_COALESCED = 'COALESCED'
+CACHE_BYPASS = 'BYPASS'
+
+
+class _Flight:
+    """計算中のリクエスト（同じキーの後続リクエストは完了を待つ）"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SimulationResultCache:
+    """
+    決定的なシミュレーション結果のキャッシュ
+
+    シリアライズ済みのレスポンスバイト列を保持し、合計サイズが max_bytes を
+    超えたら最も古いものから破棄する (LRU)。同じキーの同時リクエストは
+    1回の計算を共有する (single-flight)。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        # キー → (値, サイズ, 設定ID)
+        self._entries: 'OrderedDict[str, Tuple[Any, int, Hashable]]' = OrderedDict()
+        self._inflight: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(config_fingerprint: str, **params) -> str:
+        """設定内容のハッシュとリクエストパラメータからキーを生成"""
+        encoded = json.dumps(params, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(f'{config_fingerprint}:{encoded}'.encode('utf-8')).hexdigest()
+
+    def get_or_compute(self, key: str, compute: Callable[[], Tuple[bytes, str, Dict[str, str]]],
+                       config_id: Hashable = None) -> Tuple[Tuple[bytes, str, Dict[str, str]], str]:
+        """
+        キャッシュから取得、なければ計算して保存
+
+        Args:
+            key: make_key で生成したキー
+            compute: (ペイロード, mimetype, 追加ヘッダー) を返す計算関数
+            config_id: 無効化用に記録する設定ID
+
+        Returns:
+            ((ペイロード, mimetype, 追加ヘッダー), キャッシュ状態)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], CACHE_HIT
+
+            flight = self._inflight.get(key)
+            if flight is None:
+                flight = _Flight()
+                self._inflight[key] = flight
+                leader = True
+                self.misses += 1
+            else:
+                leader = False
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, CACHE_COALESCED
+
+        try:
+            value = compute()
+            flight.value = value
+            self._store(key, value, config_id)
+            return value, CACHE_MISS
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def _store(self, key: str, value: Tuple[bytes, str, Dict[str, str]], config_id: Hashable):
+        size = len(value[0])
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+            self._entries[key] = (value, size, config_id)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate_config(self, config_id: Optional[Hashable] = None):
+        """設定IDに紐づくエントリの無効化（config_id 省略時は全件）"""
+        with self._lock:
+            if config_id is None:
+                self._entries.clear()
+                self.total_bytes = 0
+                return
+
+            for key in [key for key, entry in self._entries.items() if entry[2] == config_id]:
+                _, size, _ = self._entries.pop(key)
+                self.total_bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        """ヒット率・使用量などの統計"""
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0
+            }
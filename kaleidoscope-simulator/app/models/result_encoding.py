@@ -0,0 +1,70 @@
+import json
+import struct
+from typing import Dict, List
+
+import numpy as np
+
+from .optical_engine import RayBuffer, Surface
+
+# バイナリ形式の Content-Type
+BINARY_MIMETYPE = 'application/octet-stream'
+
+# ヘッダー: マジック, バージョン, 予約 (0), ヘッダー長, 光線数, 点数, 面数, メタデータ長
+# ヘッダー長は uint32（バージョン 1 の uint16 では 64KiB を超えるメタデータを表せない）
+HEADER_FORMAT = '<4sHHIIIII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAGIC = b'KSIM'
+VERSION = 2
+
+# 1要素あたりの float32 の数
+RAY_STRIDE = 11  # origin(3), direction(3), wavelength, intensity, rgb(3)
+POINT_STRIDE = 7  # x, y, intensity, rgb(3), wavelength
+SURFACE_STRIDE = 7  # point(3), normal(3), material_id
+
+
+def encode_simulation_binary(ray_paths: RayBuffer, ray_rgb: np.ndarray,
+                             projected: Dict[str, np.ndarray], surfaces: List[Surface],
+                             metadata: Dict) -> bytes:
+    """
+    シミュレーション結果をリトルエンディアン float32 の連続バッファに変換
+
+    レイアウト:
+        ヘッダー (28 bytes) + メタデータJSON (4バイト境界までパディング)
+        + 光線ブロック + パターン点ブロック + ミラー面ブロック
+
+    Args:
+        ray_paths: 送信する光線（表示用に切り詰め済み）
+        ray_rgb: 光線ごとのRGB (M, 3)
+        projected: project_pattern の出力
+        surfaces: ミラー面のリスト
+        metadata: performance・bounds などのJSONで送る情報
+
+    Returns:
+        エンコード済みのバイト列
+    """
+    meta_bytes = json.dumps(metadata).encode('utf-8')
+    meta_bytes += b' ' * (-len(meta_bytes) % 4)
+
+    rays = np.empty((len(ray_paths), RAY_STRIDE), dtype='<f4')
+    rays[:, 0:3] = ray_paths.origins
+    rays[:, 3:6] = ray_paths.directions
+    rays[:, 6] = ray_paths.wavelengths
+    rays[:, 7] = ray_paths.intensities
+    rays[:, 8:11] = ray_rgb
+
+    points = np.empty((len(projected['x']), POINT_STRIDE), dtype='<f4')
+    points[:, 0] = projected['x']
+    points[:, 1] = projected['y']
+    points[:, 2] = projected['intensity']
+    points[:, 3:6] = projected['rgb']
+    points[:, 6] = projected['wavelength']
+
+    surface_block = np.array(
+        [[*surface.point, *surface.normal, surface.material_id] for surface in surfaces],
+        dtype='<f4').reshape(-1, SURFACE_STRIDE)
+
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, 0, HEADER_SIZE + len(meta_bytes),
+                         len(rays), len(points), len(surface_block), len(meta_bytes))
+
+    return b''.join([header, meta_bytes, rays.tobytes(), points.tobytes(),
+                     surface_block.tobytes()])
@@ -0,0 +1,207 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+from .profiling import percentile_summary
+
+INSERT_RESULT_SQL = """
+    INSERT INTO simulation_results
+    (config_id, performance_data, ray_count, computation_time,
+     memory_usage, quality_score)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# キューが満杯の場合の振る舞い
+OVERFLOW_POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+# キュー待ちがタイムアウトしたことを表す内部マーカー
+_TIMEOUT = object()
+
+
+def apply_connection_pragmas(conn: sqlite3.Connection):
+    """書き込み用接続のPRAGMA設定（WAL前提で fsync を減らす）"""
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+
+
+class SimulationResultWriter:
+    """
+    simulation_results のバックグラウンド書き込み
+
+    結果をキューに積み、件数 (batch_size) または経過時間 (flush_interval 秒)
+    のどちらかに達した時点で executemany により1トランザクションで書き込む。
+    """
+
+    def __init__(self, db_path: str, batch_size: int = 64, flush_interval: float = 1.0,
+                 max_queue_size: int = 1024, overflow_policy: str = 'drop_oldest',
+                 block_timeout: float = 1.0):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+        # 直近のバッチ書き込みの所要時間（秒）
+        self._batch_times = deque(maxlen=256)
+
+        self._queue: 'queue.Queue[Any]' = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='simulation-result-writer',
+                                        daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, row: Tuple) -> bool:
+        """
+        結果1件をキューに追加
+
+        Returns:
+            キューに積めた場合は True、ポリシーにより破棄した場合は False
+        """
+        if self._closed:
+            raise RuntimeError("Result writer is closed")
+
+        with self._lock:
+            self.submitted += 1
+
+        try:
+            if self.overflow_policy == 'block':
+                self._queue.put(row, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            pass
+
+        if self.overflow_policy == 'drop_oldest':
+            # 最も古い結果を捨てて新しい結果を優先する
+            if self._replace_oldest(row):
+                with self._lock:
+                    self.dropped += 1
+                return True
+
+        with self._lock:
+            self.dropped += 1
+        return False
+
+    def _replace_oldest(self, row: Tuple) -> bool:
+        """
+        キュー内で最も古い結果を捨てて row を末尾に加える
+
+        flush 待ちのマーカーと停止の None は捨てず、位置も変えない（後ろに回すと
+        flush がその後に積まれた結果まで待つことになる）。
+
+        Returns:
+            置き換えた場合は True（キューに結果がない場合は False）
+        """
+        with self._queue.mutex:
+            items = self._queue.queue
+            for index, item in enumerate(items):
+                if item is not None and not isinstance(item, threading.Event):
+                    del items[index]
+                    items.append(row)
+                    self._queue.not_empty.notify()
+                    return True
+        return False
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """キュー内の結果をすべて書き込むまで待つ"""
+        if self._closed or not self._thread.is_alive():
+            return True
+        marker = threading.Event()
+        self._queue.put(marker)
+        return marker.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """残りを書き込んでスレッドを停止"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        """書き込み統計"""
+        with self._lock:
+            return {
+                'submitted': self.submitted,
+                'written': self.written,
+                'dropped': self.dropped,
+                'batches': self.batches,
+                'errors': self.errors,
+                'queued': self._queue.qsize(),
+                'overflow_policy': self.overflow_policy,
+                'batch_latency': (percentile_summary(list(self._batch_times))
+                                  if self._batch_times else None)
+            }
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        try:
+            apply_connection_pragmas(conn)
+        except sqlite3.Error:
+            pass
+
+        pending = []
+        markers = []
+        deadline = None
+        stopping = False
+
+        try:
+            while not stopping:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = _TIMEOUT  # 時間経過によるフラッシュ
+
+                if item is None:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    markers.append(item)
+                elif item is not _TIMEOUT:
+                    pending.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+
+                due = deadline is not None and time.monotonic() >= deadline
+                if pending and (stopping or markers or due or len(pending) >= self.batch_size):
+                    self._write_batch(conn, pending)
+                    pending = []
+                    deadline = None
+                elif not pending:
+                    deadline = None
+
+                for marker in markers:
+                    marker.set()
+                markers = []
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn: sqlite3.Connection, rows):
+        start = time.perf_counter()
+        try:
+            with conn:
+                conn.executemany(INSERT_RESULT_SQL, rows)
+            with self._lock:
+                self.written += len(rows)
+                self.batches += 1
+                self._batch_times.append(time.perf_counter() - start)
+        except sqlite3.Error:
+            with self._lock:
+                self.errors += 1
+                self.dropped += len(rows)
@@ -0,0 +1,51 @@
+from enum import Enum
+
+import numpy as np
+from scipy.stats import qmc
+
+
+class SamplingMode(Enum):
+    RANDOM = "random"  # 独立な一様乱数
+    STRATIFIED = "stratified"  # 格子の各セル内でジッターした層別サンプリング
+    SOBOL = "sobol"  # スクランブルした Sobol 列（低食い違い量列）
+    HALTON = "halton"  # スクランブルした Halton 列（低食い違い量列）
+
+
+def unit_square_samples(count: int, mode: SamplingMode, rng: np.random.Generator) -> np.ndarray:
+    """
+    [0, 1)^2 上のサンプル点の生成
+
+    層別・低食い違い量のサンプルは一様乱数より偏りが小さく、同じ光線数で
+    模様のノイズが少なくなる。スクランブルとジッターには rng を使うため、
+    同じ乱数生成器の状態からは同じ点列が得られる。
+
+    Args:
+        count: サンプル数
+        mode: サンプリング方式
+        rng: 乱数生成器
+
+    Returns:
+        サンプル点 (count, 2)。並び順は空間的に偏らないようにしてある
+        （先頭の一部だけを使っても全体に散らばる）
+    """
+    if count <= 0:
+        return np.empty((0, 2))
+
+    if mode == SamplingMode.STRATIFIED:
+        # 辺 cells の格子でジッターし、格子に収まらない端数は一様乱数で補う
+        cells = int(np.sqrt(count))
+        grid_x, grid_y = np.meshgrid(np.arange(cells), np.arange(cells), indexing='ij')
+        grid = np.column_stack([grid_x.ravel(), grid_y.ravel()])
+        stratified = (grid + rng.random(grid.shape)) / cells
+        samples = np.concatenate([stratified, rng.random((count - len(grid), 2))])
+        return samples[rng.permutation(count)]
+
+    if mode == SamplingMode.SOBOL:
+        # 2 の冪の点数で生成して先頭 count 点を使う（Sobol 列の先頭部分も低食い違い量）
+        exponent = int(np.ceil(np.log2(count)))
+        return qmc.Sobol(d=2, scramble=True, seed=rng).random_base2(exponent)[:count]
+
+    if mode == SamplingMode.HALTON:
+        return qmc.Halton(d=2, scramble=True, seed=rng).random(count)
+
+    return rng.random((count, 2))
@@ -0,0 +1,232 @@
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import numpy as np
+
+from .optical_engine import Surface
+
+# 葉ノードに入れる三角形の最大数
+LEAF_SIZE = 4
+
+# 光線と面が平行とみなす |方向・法線| の閾値（trace_rays と同じ）
+PARALLEL_EPSILON = 1e-6
+
+# 後方・起点上の交点を除く最小距離（trace_rays と同じ）
+MIN_DISTANCE = 1e-6
+
+
+@dataclass
+class SurfaceBVH:
+    """
+    反射面の交点探索用のバウンディングボリューム階層 (BVH)
+
+    有限の面（凸多角形）は三角形に分割して軸平行境界ボックスの二分木に入れ、
+    交点探索を面の数に対して対数的にする。無限平面は範囲を持たないため木には
+    入れず、全光線に対してまとめて判定する。設定ごとに1回構築して使い回す。
+    """
+    node_bounds: np.ndarray  # ノードの境界ボックス (M, 2, 3)（最小・最大）
+    node_children: np.ndarray  # 子ノードの番号 (M, 2)。葉は -1
+    node_triangles: np.ndarray  # 葉の三角形の範囲 (M, 2)（開始位置・個数）
+    triangle_origins: np.ndarray  # 三角形の頂点0 (T, 3)（葉の順に並ぶ）
+    triangle_edges: np.ndarray  # 三角形の辺 v1-v0, v2-v0 (T, 2, 3)
+    triangle_areas: np.ndarray  # 辺の外積の大きさ (T,)
+    triangle_surfaces: np.ndarray  # 三角形が属する面の番号 (T,)
+    plane_surfaces: np.ndarray  # 無限平面の面の番号 (P,)
+    plane_normals: np.ndarray  # 無限平面の法線 (P, 3)
+    plane_offsets: np.ndarray  # 無限平面の n・p (P,)
+    surface_count: int
+
+    @classmethod
+    def build(cls, surfaces: List[Surface]) -> 'SurfaceBVH':
+        """
+        反射面のリストから BVH を構築
+
+        重心の分布が最も広い軸で三角形を中央値で分割し、LEAF_SIZE 個以下に
+        なるまで繰り返す。
+
+        Args:
+            surfaces: 反射面のリスト（面の番号はこのリストの添字）
+
+        Returns:
+            SurfaceBVH
+        """
+        triangles, owners = [], []
+        planes = []
+        for index, surface in enumerate(surfaces):
+            if surface.vertices is None:
+                planes.append(index)
+                continue
+            # 凸多角形を扇形に三角形分割
+            vertices = surface.vertices
+            for k in range(1, len(vertices) - 1):
+                triangles.append((vertices[0], vertices[k], vertices[k + 1]))
+                owners.append(index)
+
+        triangles = np.array(triangles, dtype=np.float64).reshape(-1, 3, 3)
+        owners = np.array(owners, dtype=np.int64)
+        lower, upper = triangles.min(axis=1), triangles.max(axis=1)
+        centroids = triangles.mean(axis=1)
+
+        bounds, children, ranges, order = [], [], [], []
+        # (ノード番号, 三角形の添字) のスタックで上から分割する
+        stack = []
+        if len(triangles):
+            bounds.append(None)
+            children.append([-1, -1])
+            ranges.append([0, 0])
+            stack.append((0, np.arange(len(triangles))))
+
+        while stack:
+            node, members = stack.pop()
+            bounds[node] = (lower[members].min(axis=0), upper[members].max(axis=0))
+
+            if len(members) <= LEAF_SIZE:
+                ranges[node] = [len(order), len(members)]
+                order.extend(members.tolist())
+                continue
+
+            spread = centroids[members].max(axis=0) - centroids[members].min(axis=0)
+            axis = int(np.argmax(spread))
+            members = members[np.argsort(centroids[members, axis], kind='stable')]
+            half = len(members) // 2
+
+            for side, part in enumerate((members[:half], members[half:])):
+                child = len(bounds)
+                bounds.append(None)
+                children.append([-1, -1])
+                ranges.append([0, 0])
+                children[node][side] = child
+                stack.append((child, part))
+
+        order = np.array(order, dtype=np.int64)
+        triangles = triangles[order]
+        edges = np.stack([triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]], axis=1)
+
+        plane_normals = np.array([surfaces[i].normal for i in planes], dtype=np.float64).reshape(-1, 3)
+        plane_points = np.array([surfaces[i].point for i in planes], dtype=np.float64).reshape(-1, 3)
+
+        return cls(
+            node_bounds=np.array([np.stack(b) for b in bounds], dtype=np.float64).reshape(-1, 2, 3),
+            node_children=np.array(children, dtype=np.int64).reshape(-1, 2),
+            node_triangles=np.array(ranges, dtype=np.int64).reshape(-1, 2),
+            triangle_origins=triangles[:, 0],
+            triangle_edges=edges,
+            triangle_areas=np.linalg.norm(np.cross(edges[:, 0], edges[:, 1]), axis=1),
+            triangle_surfaces=owners[order],
+            plane_surfaces=np.array(planes, dtype=np.int64),
+            plane_normals=plane_normals,
+            plane_offsets=np.einsum('ij,ij->i', plane_points, plane_normals),
+            surface_count=len(surfaces)
+        )
+
+    @property
+    def node_count(self) -> int:
+        return len(self.node_bounds)
+
+    def intersect(self, origins: np.ndarray, directions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        各光線の最も近い交点
+
+        木は全光線をまとめて幅優先にたどる。各段で (光線, ノード) の組の
+        境界ボックスとの交差を判定し、既に見つかった交点より遠いノードは枝刈りする。
+
+        Args:
+            origins: 光線の起点 (N, 3)
+            directions: 光線の方向ベクトル (N, 3)
+
+        Returns:
+            (交点までの距離 (N,)、面の番号 (N,))。交点がない光線は (inf, -1)
+        """
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        num_rays = len(origins)
+        best_distance = np.full(num_rays, np.inf)
+        best_surface = np.full(num_rays, -1, dtype=np.int64)
+
+        if len(self.plane_surfaces) and num_rays:
+            denominator = directions @ self.plane_normals.T
+            numerator = self.plane_offsets[np.newaxis, :] - origins @ self.plane_normals.T
+            with np.errstate(divide='ignore', invalid='ignore'):
+                distances = numerator / denominator
+            valid = (np.abs(denominator) >= PARALLEL_EPSILON) & (distances >= MIN_DISTANCE)
+            distances = np.where(valid, distances, np.inf)
+            closest = np.argmin(distances, axis=1)
+            best_distance = distances[np.arange(num_rays), closest]
+            best_surface = np.where(np.isfinite(best_distance), self.plane_surfaces[closest], -1)
+
+        if not self.node_count or not num_rays:
+            return best_distance, best_surface
+
+        # 0 成分は非常に小さい値に置き換えて境界ボックスの判定で 0 除算を避ける
+        safe = np.where(np.abs(directions) < 1e-30, 1e-30, directions)
+        inverse = 1.0 / safe
+
+        rays = np.arange(num_rays)
+        nodes = np.zeros(num_rays, dtype=np.int64)
+
+        while len(rays):
+            bounds = self.node_bounds[nodes]
+            near = (bounds[:, 0] - origins[rays]) * inverse[rays]
+            far = (bounds[:, 1] - origins[rays]) * inverse[rays]
+            t_enter = np.minimum(near, far).max(axis=1)
+            t_exit = np.maximum(near, far).min(axis=1)
+            visit = (t_enter <= t_exit) & (t_exit >= MIN_DISTANCE) & (t_enter < best_distance[rays])
+            rays, nodes = rays[visit], nodes[visit]
+
+            leaf = self.node_children[nodes, 0] < 0
+            if np.any(leaf):
+                self._intersect_leaves(origins, directions, rays[leaf], nodes[leaf],
+                                       best_distance, best_surface)
+
+            inner_rays, inner_nodes = rays[~leaf], nodes[~leaf]
+            rays = np.concatenate([inner_rays, inner_rays])
+            nodes = np.concatenate([self.node_children[inner_nodes, 0],
+                                    self.node_children[inner_nodes, 1]])
+
+        return best_distance, best_surface
+
+    def first_hit(self, origin: np.ndarray, direction: np.ndarray) -> Tuple[float, int]:
+        """1本の光線の最も近い交点（trace_ray 用）。交点がなければ (inf, -1)"""
+        distances, surfaces = self.intersect(origin[np.newaxis, :], direction[np.newaxis, :])
+        return float(distances[0]), int(surfaces[0])
+
+    def _intersect_leaves(self, origins: np.ndarray, directions: np.ndarray,
+                          rays: np.ndarray, nodes: np.ndarray,
+                          best_distance: np.ndarray, best_surface: np.ndarray):
+        """葉ノードの三角形との交点で最短距離を更新（Möller–Trumbore 法）"""
+        start, count = self.node_triangles[nodes, 0], self.node_triangles[nodes, 1]
+        candidate_rays = np.concatenate([rays[count > k] for k in range(LEAF_SIZE)])
+        triangles = np.concatenate([start[count > k] + k for k in range(LEAF_SIZE)])
+
+        direction = directions[candidate_rays]
+        edge1 = self.triangle_edges[triangles, 0]
+        edge2 = self.triangle_edges[triangles, 1]
+        pvec = np.cross(direction, edge2)
+        determinant = np.einsum('ij,ij->i', edge1, pvec)
+        parallel = np.abs(determinant) < PARALLEL_EPSILON * self.triangle_areas[triangles]
+        inverse = 1.0 / np.where(parallel, 1.0, determinant)
+
+        tvec = origins[candidate_rays] - self.triangle_origins[triangles]
+        u = np.einsum('ij,ij->i', tvec, pvec) * inverse
+        qvec = np.cross(tvec, edge1)
+        v = np.einsum('ij,ij->i', direction, qvec) * inverse
+        distance = np.einsum('ij,ij->i', edge2, qvec) * inverse
+
+        valid = (~parallel & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) &
+                 (distance >= MIN_DISTANCE))
+        if not np.any(valid):
+            return
+        candidate_rays, triangles, distance = (candidate_rays[valid], triangles[valid],
+                                               distance[valid])
+
+        # 光線ごとに最も近い候補だけを残して既存の最短距離と比べる
+        order = np.lexsort((distance, candidate_rays))
+        candidate_rays, triangles, distance = (candidate_rays[order], triangles[order],
+                                               distance[order])
+        first = np.concatenate([[True], candidate_rays[1:] != candidate_rays[:-1]])
+        candidate_rays, triangles, distance = (candidate_rays[first], triangles[first],
+                                               distance[first])
+
+        closer = distance < best_distance[candidate_rays]
+        best_distance[candidate_rays[closer]] = distance[closer]
+        best_surface[candidate_rays[closer]] = self.triangle_surfaces[triangles[closer]]
@@ -0,0 +1,356 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .optical_engine import OpticalEngine, RayBuffer, Surface
+
+# 平面ミラーの並びが鏡映群になる正多角形の面数（1枚、平行2枚、正三角形、正方形）と
+# 同じ向きの鏡映線の間隔（内接円半径に対する比）。
+# 正五角形以上は鏡映で平面を敷き詰められないため展開できない
+_LINE_SPACING = {1: np.inf, 2: 2.0, 3: 3.0, 4: 2.0}
+
+# 展開に使う方向の数（向きが逆のミラーは同じ平行線の族に属する）
+_FAMILY_COUNT = {1: 1, 2: 1, 3: 3, 4: 2}
+
+# 一度に展開する光線数（(光線数, 反射回数) の配列のメモリを抑える）
+_CHUNK_SIZE = 65536
+
+
+@dataclass
+class MirrorGroup:
+    """
+    z 軸に平行な平面ミラーで囲まれた正多角形の筒が作る鏡映群
+
+    筒の断面を鏡映で敷き詰めると、ミラーの鏡映線は平行線の族
+    w_f・p = inradius + spacing * k (k は整数) になる。光線はこの展開面上では
+    直線で進むため、反射は各族の平行線との交差として等差数列で求まる。
+    """
+    outward_normals: np.ndarray  # 各ミラーの外向き単位法線の xy 成分 (N, 2)
+    family_normals: np.ndarray  # 平行線の族の単位法線 (F, 2)
+    inradius: float  # 中心から各ミラーまでの距離
+    spacing: float  # 同じ族の平行線の間隔（繰り返さない場合は inf）
+    center: np.ndarray  # 多角形の中心の xy 座標
+    linear_parts: np.ndarray  # 群の元の線形部分（点群） (G, 2, 2)。先頭は単位行列
+    compose: np.ndarray  # compose[g, f] = linear_parts[g] @ (族 f の鏡映) の添字 (G, F)
+    mirror_table: np.ndarray  # 元 g で族 f の線を正/負の向きに横切ったときのミラー番号 (G, F, 2)
+
+    @property
+    def mirror_count(self) -> int:
+        return len(self.outward_normals)
+
+
+def _point_group(family_normals: np.ndarray):
+    """族の鏡映が生成する有限点群と、右から鏡映を掛ける合成表"""
+    reflections = [np.eye(2) - 2.0 * np.outer(w, w) for w in family_normals]
+    elements = [np.eye(2)]
+    compose = []
+
+    index = 0
+    while index < len(elements):
+        row = []
+        for reflection in reflections:
+            product = elements[index] @ reflection
+            for existing, element in enumerate(elements):
+                if np.allclose(element, product, atol=1e-9):
+                    row.append(existing)
+                    break
+            else:
+                elements.append(product)
+                row.append(len(elements) - 1)
+        compose.append(row)
+        index += 1
+
+    return np.array(elements), np.array(compose, dtype=np.int64)
+
+
+def build_mirror_group(surfaces: List[Surface], tolerance: float = 1e-6) -> Optional[MirrorGroup]:
+    """
+    ミラー面の並びから鏡映群を構成（展開できない配置なら None）
+
+    create_mirror_surfaces と同じく、内向き法線を持つ鉛直な無限平面のミラーが
+    中心から等距離・等角度間隔で並んだ 1〜4 面の配置に対応する。
+
+    Args:
+        surfaces: 反射面のリスト
+        tolerance: 配置の判定に使う許容誤差
+
+    Returns:
+        MirrorGroup または None
+    """
+    count = len(surfaces)
+    if count not in _LINE_SPACING or any(surface.bounded for surface in surfaces):
+        return None
+
+    normals = np.array([surface.normal for surface in surfaces], dtype=np.float64)
+    points = np.array([surface.point for surface in surfaces], dtype=np.float64)
+
+    # ミラーはすべて z 軸に平行（法線が水平）である必要がある
+    if np.any(np.abs(normals[:, 2]) > tolerance):
+        return None
+
+    outward = -normals[:, :2]
+    outward /= np.linalg.norm(outward, axis=1, keepdims=True)
+    distances = np.einsum('ij,ij->i', outward, points[:, :2])
+
+    if count == 1:
+        center = points[0, :2] - outward[0]
+        inradius = 1.0
+    else:
+        # 各ミラーから等距離の点（多角形の中心）を最小二乗で求める
+        # u_j・c + r = u_j・p_j を c と r について解く
+        system = np.column_stack([outward, np.ones(count)])
+        solution, *_ = np.linalg.lstsq(system, distances, rcond=None)
+        center, inradius = solution[:2], float(solution[2])
+        if inradius <= tolerance or not np.allclose(system @ solution, distances, atol=tolerance):
+            return None
+
+        # 法線が等角度間隔で並んでいること
+        angles = np.sort(np.arctan2(outward[:, 1], outward[:, 0]) % (2.0 * np.pi))
+        gaps = np.diff(np.append(angles, angles[0] + 2.0 * np.pi))
+        if not np.allclose(gaps, 2.0 * np.pi / count, atol=1e-6):
+            return None
+
+    family_normals = outward[:_FAMILY_COUNT[count]].copy()
+    linear_parts, compose = _point_group(family_normals)
+
+    # 展開面で線を横切る向き s・w_f を実空間に戻した A_g (s・w_f) が当たったミラーの外向き法線
+    images = np.einsum('gij,fj->gfi', linear_parts, family_normals)
+    images = np.stack([-images, images], axis=2)  # (G, F, 2, 2)
+    mirror_table = np.argmax(images @ outward.T, axis=3)
+
+    return MirrorGroup(
+        outward_normals=outward,
+        family_normals=family_normals,
+        inradius=inradius,
+        spacing=_LINE_SPACING[count] * inradius,
+        center=np.asarray(center, dtype=np.float64),
+        linear_parts=linear_parts,
+        compose=compose,
+        mirror_table=mirror_table
+    )
+
+
+def inside_chamber(group: MirrorGroup, origins: np.ndarray, tolerance: float = 1e-9) -> np.ndarray:
+    """光線の起点が筒の内側にあるかの判定 (N,)"""
+    relative = np.asarray(origins, dtype=np.float64)[:, :2] - group.center
+    return np.all(relative @ group.outward_normals.T < group.inradius - tolerance, axis=1)
+
+
+def trace_rays_unfolded(engine: OpticalEngine, origins: np.ndarray, directions: np.ndarray,
+                        wavelengths: np.ndarray, intensities: np.ndarray,
+                        surfaces: List[Surface], group: MirrorGroup, max_bounces: int = 10,
+                        polarizations: Optional[np.ndarray] = None) -> RayBuffer:
+    """
+    鏡映群による展開を使った光線追跡
+
+    展開面上の直線が各族の平行線と交差する距離は等差数列になるため、
+    max_bounces 回分の反射をまとめて求めて並べ替え、これまでの鏡映の合成
+    （点群の元と平行移動）で実空間の交点・反射方向に戻す。反射ごとのループや
+    ミラー面との交点探索は行わない。
+
+    反射ごとのフレネル反射・波長吸収・ウェットモード補正・強度 0.01 未満での
+    打ち切りは trace_rays と同じで、粗さ 0 のミラーなら trace_rays と同じ結果になる。
+    角の近くで光線がミラーの間をすり抜けることもない。
+
+    Args:
+        engine: 材料と物理モードを設定済みの光学エンジン
+        origins: 光線の起点 (N, 3)。すべて筒の内側にあること
+        directions: 光線の方向ベクトル (N, 3)
+        wavelengths: 波長 (N,)
+        intensities: 強度 (N,)
+        surfaces: 反射面のリスト（group を構成したもの）
+        group: build_mirror_group の結果
+        max_bounces: 最大反射回数
+        polarizations: 偏光状態 (N, 2)。省略時はs偏光
+
+    Returns:
+        trace_rays と同じ並び順の RayBuffer
+    """
+    origins = np.array(origins, dtype=np.float64).reshape(-1, 3)
+    directions = np.array(directions, dtype=np.float64).reshape(-1, 3)
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    num_rays = len(origins)
+    wavelengths = np.broadcast_to(np.asarray(wavelengths, dtype=np.float64), (num_rays,)).copy()
+    intensities = np.broadcast_to(np.asarray(intensities, dtype=np.float64), (num_rays,)).copy()
+    if polarizations is None:
+        polarizations = np.tile(np.array([1.0, 0.0]), (num_rays, 1))
+    else:
+        polarizations = np.array(polarizations, dtype=np.float64).reshape(-1, 2)
+
+    mirror_properties = {
+        'material_id': np.array([surface.material_id for surface in surfaces], dtype=np.int64),
+    }
+
+    chunks = []
+    for start in range(0, max(num_rays, 1), _CHUNK_SIZE):
+        end = min(start + _CHUNK_SIZE, num_rays)
+        chunk = _unfold_chunk(engine, group, mirror_properties, max(0, max_bounces),
+                              origins[start:end], directions[start:end],
+                              wavelengths[start:end], intensities[start:end],
+                              polarizations[start:end])
+        chunk['path_index'] += start
+        chunks.append(chunk)
+
+    # 各チャンクは (path_index, bounce) の順に並んでいる
+    return RayBuffer(**{key: np.concatenate([chunk[key] for chunk in chunks])
+                        for key in chunks[0]})
+
+
+def _unfold_chunk(engine: OpticalEngine, group: MirrorGroup, mirror_properties: Dict[str, np.ndarray],
+                  max_bounces: int, origins: np.ndarray, directions: np.ndarray,
+                  wavelengths: np.ndarray, intensities: np.ndarray,
+                  polarizations: np.ndarray) -> Dict[str, np.ndarray]:
+    """光線のチャンクを展開して追跡し、RayBuffer の列を返す"""
+    num_rays = len(origins)
+
+    # 反射率は1以下なので、初期強度が打ち切りの閾値未満の光線は反射しない
+    active = np.flatnonzero(intensities >= 0.01)
+    if len(active) and max_bounces > 0:
+        bounces = _unfold_bounces(engine, group, mirror_properties, max_bounces, origins[active],
+                                  directions[active], wavelengths[active], intensities[active],
+                                  polarizations[active])
+    else:
+        bounces = {'alive': np.zeros((len(active), 0), dtype=bool)}
+    bounce_count = bounces['alive'].shape[1]
+
+    # 初期光線を先頭列にした (N, B + 1) の表から生き残った行を行優先で取り出すと
+    # (path_index, bounce) の順になる
+    keep = np.zeros((num_rays, bounce_count + 1), dtype=bool)
+    keep[:, 0] = True
+    keep[active, 1:] = bounces['alive']
+
+    def table(initial, key):
+        values = np.zeros(keep.shape + initial.shape[1:])
+        values[:, 0] = initial
+        if bounce_count:
+            values[active, 1:] = bounces[key]
+        return values[keep]
+
+    path_index = np.broadcast_to(np.arange(num_rays)[:, np.newaxis], keep.shape)[keep]
+
+    return {
+        'origins': table(origins, 'hit_points'),
+        'directions': table(directions, 'reflected'),
+        'wavelengths': wavelengths[path_index],
+        'intensities': table(intensities, 'intensities'),
+        'polarizations': polarizations[path_index],
+        'path_index': path_index,
+        'bounce': np.broadcast_to(np.arange(bounce_count + 1), keep.shape)[keep]
+    }
+
+
+def _unfold_bounces(engine: OpticalEngine, group: MirrorGroup, mirror_properties: Dict[str, np.ndarray],
+                    max_bounces: int, origins: np.ndarray, directions: np.ndarray,
+                    wavelengths: np.ndarray, intensities: np.ndarray,
+                    polarizations: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    各光線の反射を展開して一括で求める
+
+    Returns:
+        'alive'（その反射まで到達したか）、'hit_points'、'reflected'（反射後の方向）、
+        'intensities' を含む辞書。いずれも (N, B, ...) で、B は到達した最大反射回数
+    """
+    num_rays = len(origins)
+    # 平行線が1本だけの場合は高々1回しか反射しない
+    bounces = max_bounces if np.isfinite(group.spacing) else min(max_bounces, 1)
+    family_count = len(group.family_normals)
+    inradius, spacing = group.inradius, group.spacing
+
+    # 中心を原点とした展開面上の座標で計算する
+    start_xy = origins[:, :2] - group.center
+    slopes = directions[:, :2] @ group.family_normals.T  # (N, F)
+    positions = start_xy @ group.family_normals.T
+
+    # 各族で最初に交差する平行線の番号と、進む向き
+    steps = np.where(np.abs(slopes) >= 1e-6, np.sign(slopes), 0).astype(np.int64)
+    if np.isfinite(spacing):
+        relative = (positions - inradius) / spacing
+        first_lines = np.where(steps > 0, np.ceil(relative), np.floor(relative)).astype(np.int64)
+        first_lines += (first_lines == relative) * steps  # 線上から出発した場合は次の線
+        lines = first_lines[:, :, np.newaxis] + steps[:, :, np.newaxis] * np.arange(bounces)
+        line_offsets = inradius + spacing * lines
+    else:
+        # 平行線が1本だけの場合は外向きに進むときに1回だけ交差する
+        steps = np.where(steps > 0, steps, 0)
+        line_offsets = np.full((num_rays, family_count, bounces), inradius)
+
+    # 全族・全反射回数分の交差距離 (N, F, B) を求め、近い順に max_bounces 個を取る
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = (line_offsets - positions[:, :, np.newaxis]) / slopes[:, :, np.newaxis]
+    distances = np.where((steps[:, :, np.newaxis] != 0) & (distances > 0), distances, np.inf)
+
+    if family_count == 1:
+        t = distances[:, 0, :]
+        family = np.zeros((num_rays, bounces), dtype=np.int64)
+        offsets = line_offsets[:, 0, :]
+    else:
+        distances = distances.reshape(num_rays, family_count * bounces)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :bounces]
+        t = np.take_along_axis(distances, order, axis=1)  # (N, B)
+        family = order // bounces
+        offsets = np.take_along_axis(line_offsets.reshape(num_rays, -1), order, axis=1)
+
+    # 反射前後の点群の元（鏡映を右から順に合成）
+    compose = group.compose.ravel()
+    elements = np.zeros((num_rays, bounces + 1), dtype=np.int64)
+    for k in range(bounces):
+        elements[:, k + 1] = compose.take(elements[:, k] * family_count + family[:, k])
+    before = elements[:, :-1] * family_count + family  # (元, 族) の組の添字
+
+    # 当たるミラーは元と族と横切る向きだけで決まる
+    crossing_sign = np.take_along_axis(steps, family, axis=1) > 0
+    mirror = group.mirror_table.reshape(-1, 2)[before, crossing_sign.astype(np.int64)]
+
+    # 光線ごと・族ごと・材料ごとの減衰率を材料の参照テーブルから引く
+    # （入射角は展開面上の直線と平行線の角度なので反射しても変わらない）
+    material_ids, material_of_mirror = np.unique(mirror_properties['material_id'], return_inverse=True)
+    cos_theta_i = np.abs(slopes).ravel()
+    s_component = np.repeat(polarizations[:, 0]**2, family_count)
+    p_component = np.repeat(polarizations[:, 1]**2, family_count)
+    family_wavelengths = np.repeat(wavelengths, family_count)
+    per_material = np.stack([
+        engine.reflectance_tables[int(material_id)].attenuation(
+            cos_theta_i, s_component, p_component, family_wavelengths)
+        for material_id in material_ids], axis=1)  # (N * F, M)
+
+    # 反射ごとの減衰率
+    attenuation_index = family * len(material_ids) + material_of_mirror[mirror]
+    attenuation = np.take_along_axis(per_material.reshape(num_rays, -1), attenuation_index, axis=1)
+    hit_intensities = intensities[:, np.newaxis] * np.cumprod(attenuation, axis=1)
+
+    # 交差がなくなるか強度が閾値以下になった以降の反射は捨てる
+    alive = np.logical_and.accumulate(np.isfinite(t) & (hit_intensities >= 0.01), axis=1)
+
+    # どの光線も届かない反射回数の列は以降の計算から除く
+    bounces = int(np.count_nonzero(alive.any(axis=0)))
+    alive, hit_intensities, elements = alive[:, :bounces], hit_intensities[:, :bounces], elements[:, :bounces + 1]
+    before = before[:, :bounces]
+    t = np.where(alive, t[:, :bounces], 0.0)
+    offsets = np.where(alive, offsets[:, :bounces], 0.0)
+
+    # 展開面上の交点を A p + b で実空間に戻す。平行移動 b は各反射で 2 c A w ずつ加わる
+    linear = group.linear_parts.reshape(-1, 4)
+    images = np.einsum('gij,fj->gfi', group.linear_parts, group.family_normals).reshape(-1, 2)
+    increments_x = 2.0 * offsets * images[:, 0].take(before)
+    increments_y = 2.0 * offsets * images[:, 1].take(before)
+    translation_x = np.cumsum(increments_x, axis=1) - increments_x
+    translation_y = np.cumsum(increments_y, axis=1) - increments_y
+
+    unfolded_x = start_xy[:, 0:1] + t * directions[:, 0:1]
+    unfolded_y = start_xy[:, 1:2] + t * directions[:, 1:2]
+    parts = [linear[:, j].take(elements[:, :-1]) for j in range(4)]
+
+    hit_points = np.empty((num_rays, bounces, 3))
+    hit_points[:, :, 0] = parts[0] * unfolded_x + parts[1] * unfolded_y + translation_x + group.center[0]
+    hit_points[:, :, 1] = parts[2] * unfolded_x + parts[3] * unfolded_y + translation_y + group.center[1]
+    hit_points[:, :, 2] = origins[:, 2:3] + t * directions[:, 2:3]
+
+    parts = [linear[:, j].take(elements[:, 1:]) for j in range(4)]
+    reflected = np.empty((num_rays, bounces, 3))
+    reflected[:, :, 0] = parts[0] * directions[:, 0:1] + parts[1] * directions[:, 1:2]
+    reflected[:, :, 1] = parts[2] * directions[:, 0:1] + parts[3] * directions[:, 1:2]
+    reflected[:, :, 2] = directions[:, 2:3]
+
+    return {'alive': alive, 'hit_points': hit_points, 'reflected': reflected,
+            'intensities': hit_intensities}
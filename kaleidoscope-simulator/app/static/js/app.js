@@ -35,6 +35,10 @@ class KaleidoscopeApp {
             this.handleSimulationResult(data);
         });
 
+        this.socket.on('simulation_progress', (data) => {
+            this.handleSimulationProgress(data);
+        });
+
         this.socket.on('simulation_error', (data) => {
             this.showError('シミュレーションエラー: ' + data.error);
         });
@@ -261,15 +265,25 @@ class KaleidoscopeApp {
         try {
             const config = this.getCurrentConfig();
 
-            const response = await fetch('/api/simulate', {
+            // バイナリ形式で受け取り、型付き配列でデコードする（エラー時はJSON）
+            const response = await fetch('/api/simulate?format=binary', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'Accept': 'application/octet-stream'
                 },
                 body: JSON.stringify(config)
             });
 
-            const data = await response.json();
+            let data;
+            if ((response.headers.get('Content-Type') || '').startsWith('application/octet-stream')) {
+                data = {
+                    success: true,
+                    simulation_result: decodeSimulationBuffer(await response.arrayBuffer())
+                };
+            } else {
+                data = await response.json();
+            }
 
             if (data.success) {
                 this.displaySimulationResult(data.simulation_result);
@@ -288,8 +302,10 @@ class KaleidoscopeApp {
     }
 
     runRealtimeSimulation() {
+        // プログレッシブ描画: サーバーが小さなバッチごとに途中経過の画像を送る
+        // 新しい要求を送るとサーバー側で前の描画は中断される
         const config = this.getRealtimeConfig();
-        this.socket.emit('realtime_simulation', config);
+        this.socket.emit('progressive_simulation', config);
     }
 
     getCurrentConfig() {
@@ -297,7 +313,7 @@ class KaleidoscopeApp {
         const materialIds = Array.from(materialSelects).map(select => parseInt(select.value));
 
         return {
-            config_id: null, // 新規設定
+            config_id: null, // DBに保存せずインライン設定としてシミュレーション
             mirror_count: parseInt(document.getElementById('mirror-count').value),
             material_ids: materialIds,
             physics_mode: document.getElementById('physics-mode').value,
@@ -316,6 +332,10 @@ class KaleidoscopeApp {
         const config = this.getCurrentConfig();
         config.num_rays = 50; // リアルタイム用に軽量化
         config.max_bounces = 5;
+        config.target_rays = Math.max(config.num_rays, 20000);
+        config.batch_size = 500;
+        config.width = window.visualizer.canvas.width;
+        config.height = window.visualizer.canvas.height;
         return config;
     }
 
@@ -395,6 +415,14 @@ class KaleidoscopeApp {
         }
     }
 
+    handleSimulationProgress(data) {
+        window.visualizer.renderImage(data.image);
+        document.getElementById('ray-count').textContent =
+            `${data.samples} / ${data.target_samples}`;
+        document.getElementById('computation-time').textContent = data.elapsed_time.toFixed(3) + 's';
+        document.getElementById('last-update').textContent = new Date().toLocaleTimeString();
+    }
+
     handleConfigUpdate(data) {
         // 他のクライアントからの設定変更を反映
         console.log('Config updated:', data);
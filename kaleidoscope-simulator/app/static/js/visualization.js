@@ -7,6 +7,7 @@ class KaleidoscopeVisualizer {
         this.currentPattern = null;
         this.animationFrame = null;
         this.viewMode = '2d'; // '2d' or '3d'
+        this.imageSequence = 0; // サーバー描画画像の到着順
 
         this.init();
     }
@@ -141,6 +142,23 @@ class KaleidoscopeVisualizer {
         }
     }
 
+    renderImage(imageData) {
+        // サーバー側でラスタライズされたPNGを描画（古いデコード結果は破棄）
+        const sequence = ++this.imageSequence;
+        const blob = new Blob([imageData], { type: 'image/png' });
+
+        createImageBitmap(blob).then(bitmap => {
+            if (sequence !== this.imageSequence) {
+                bitmap.close();
+                return;
+            }
+            this.ctx.fillStyle = '#0f0f23';
+            this.ctx.fillRect(0, 0, this.canvas.width, this.canvas.height);
+            this.ctx.drawImage(bitmap, 0, 0, this.canvas.width, this.canvas.height);
+            bitmap.close();
+        });
+    }
+
     render2DPattern(patternData) {
         // キャンバスクリア
         this.ctx.fillStyle = '#0f0f23';
@@ -424,6 +442,89 @@ class KaleidoscopeVisualizer {
     }
 }
 
+// バイナリ形式のシミュレーション結果（/api/simulate?format=binary）をデコード
+// レイアウトは app/models/result_encoding.py を参照
+const SIMULATION_BUFFER_LAYOUT = {
+    version: 2,
+    headerSize: 28,
+    rayStride: 11,
+    pointStride: 7,
+    surfaceStride: 7
+};
+
+function decodeSimulationBuffer(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+    if (magic !== 'KSIM') {
+        throw new Error('Unknown simulation buffer format');
+    }
+    const version = view.getUint16(4, true);
+    if (version !== SIMULATION_BUFFER_LAYOUT.version) {
+        throw new Error(`Unsupported simulation buffer version: ${version}`);
+    }
+
+    const dataOffset = view.getUint32(8, true);
+    const rayCount = view.getUint32(12, true);
+    const pointCount = view.getUint32(16, true);
+    const surfaceCount = view.getUint32(20, true);
+    const metaLength = view.getUint32(24, true);
+
+    const meta = JSON.parse(new TextDecoder().decode(
+        new Uint8Array(buffer, SIMULATION_BUFFER_LAYOUT.headerSize, metaLength)));
+
+    // 各ブロックは float32 の連続配列としてそのまま参照する
+    let offset = dataOffset;
+    const rays = new Float32Array(buffer, offset, rayCount * SIMULATION_BUFFER_LAYOUT.rayStride);
+    offset += rays.byteLength;
+    const points = new Float32Array(buffer, offset, pointCount * SIMULATION_BUFFER_LAYOUT.pointStride);
+    offset += points.byteLength;
+    const surfaces = new Float32Array(buffer, offset, surfaceCount * SIMULATION_BUFFER_LAYOUT.surfaceStride);
+
+    const rayPaths = [];
+    for (let i = 0; i < rayCount; i++) {
+        const base = i * SIMULATION_BUFFER_LAYOUT.rayStride;
+        rayPaths.push({
+            origin: rays.subarray(base, base + 3),
+            direction: rays.subarray(base + 3, base + 6),
+            wavelength: rays[base + 6],
+            intensity: rays[base + 7],
+            rgb: rays.subarray(base + 8, base + 11)
+        });
+    }
+
+    const patternPoints = [];
+    for (let i = 0; i < pointCount; i++) {
+        const base = i * SIMULATION_BUFFER_LAYOUT.pointStride;
+        patternPoints.push({
+            x: points[base],
+            y: points[base + 1],
+            intensity: points[base + 2],
+            rgb: points.subarray(base + 3, base + 6),
+            wavelength: points[base + 6]
+        });
+    }
+
+    const surfaceList = [];
+    for (let i = 0; i < surfaceCount; i++) {
+        const base = i * SIMULATION_BUFFER_LAYOUT.surfaceStride;
+        surfaceList.push({
+            point: surfaces.subarray(base, base + 3),
+            normal: surfaces.subarray(base + 3, base + 6),
+            material_id: surfaces[base + 6]
+        });
+    }
+
+    return {
+        ray_paths: rayPaths,
+        surfaces: surfaceList,
+        pattern_data: {
+            points: patternPoints,
+            bounds: meta.bounds
+        },
+        performance: meta.performance
+    };
+}
+
 // グローバルに可視化エンジンを初期化
 document.addEventListener('DOMContentLoaded', () => {
     window.visualizer = new KaleidoscopeVisualizer();
@@ -0,0 +1,548 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+# app/ と database/ をインポートパスに追加
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+sys.path.insert(0, os.path.join(ROOT, 'database'))
+
+from models.kaleidoscope_simulator import KaleidoscopeSimulator
+from models.optical_engine import Ray, Surface
+from models.path_geometry import PathGeometry, replay_path_geometry
+from models.sampling import SamplingMode
+from models.surface_bvh import SurfaceBVH
+from models.unfolded_solver import trace_rays_unfolded
+from init_db import KaleidoscopeDatabase
+
+# スイープの設定
+PROFILES = {
+    'quick': {
+        'ray_counts': [100, 1000],
+        'bounce_limits': [5],
+        'mirror_counts': [3],
+        'facet_counts': [100],
+        'repeat': 5
+    },
+    'full': {
+        'ray_counts': [100, 1000, 10000],
+        'bounce_limits': [1, 5, 10],
+        'mirror_counts': [2, 3, 4, 6],
+        'facet_counts': [100, 1000],
+        'repeat': 20
+    }
+}
+
+# 1本ずつ追跡するベンチマークの光線数の上限（これを超える組み合わせは省略）
+SCALAR_RAY_LIMIT = 1000
+
+# 総当たりで追跡する光線数 × 面の数の上限（これを超える組み合わせは BVH のみ計測）
+BRUTE_FORCE_PAIR_LIMIT = 1_000_000
+
+BENCHMARKS = ('fresnel_coefficients', 'reflection_attenuation', 'ray_surface_intersection', 'reflect_ray', 'trace_ray',
+              'trace_rays', 'replay_path_geometry', 'trace_rays_unfolded', 'trace_rays_facets', 'generate_initial_rays', 'create_pattern_visualization_data',
+              'api_simulate')
+
+
+def create_benchmark_database(db_path: str, mirror_counts: List[int]):
+    """
+    ベンチマーク用の一時データベースを作成
+
+    ミラー数ごとに設定を1件ずつ作り、設定IDはミラー数と同じ値にする。
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        database = KaleidoscopeDatabase(db_path)
+        database.insert_default_materials()
+
+    with sqlite3.connect(db_path) as conn:
+        for mirror_count in mirror_counts:
+            conn.execute("""
+                INSERT INTO kaleidoscope_configs
+                (id, name, mirror_count, mirror_angles, materials, physics_mode)
+                VALUES (?, ?, ?, ?, ?, 'dry')
+            """, (mirror_count, f'Benchmark {mirror_count} mirrors', mirror_count,
+                  json.dumps([360.0 / mirror_count] * mirror_count),
+                  json.dumps([1] * mirror_count)))
+            conn.execute("""
+                INSERT INTO light_sources
+                (config_id, wavelength, intensity, position_x, position_y, position_z, type)
+                VALUES (?, 550.0, 1.0, 0.0, 0.0, 1.0, 'point')
+            """, (mirror_count,))
+        conn.commit()
+
+
+def load_flask_app(db_path: str):
+    """app.py を読み込み、シミュレーターの接続先を一時データベースに切り替える"""
+    spec = importlib.util.spec_from_file_location('kaleidoscope_app', os.path.join(ROOT, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.simulator.db_path = db_path
+    module.simulator.invalidate_config()
+    module.result_cache.invalidate_config()
+    return module
+
+
+def measure(func: Callable[[], None], repeat: int, rays: int) -> Dict:
+    """
+    関数の実行時間とピークメモリを計測
+
+    ウォームアップ1回の後に repeat 回計時し、tracemalloc を有効にした
+    別の1回でピークメモリを測る（計時には tracemalloc のオーバーヘッドを含めない）。
+
+    Args:
+        func: 計測対象の関数
+        repeat: 計時の回数
+        rays: 1回の実行で処理する光線（呼び出し）数
+
+    Returns:
+        レイテンシの統計・スループット・ピークメモリ
+    """
+    func()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    timings = np.array(timings)
+    p50 = float(np.percentile(timings, 50))
+    return {
+        'repeat': repeat,
+        'rays': rays,
+        'mean': float(timings.mean()),
+        'min': float(timings.min()),
+        'p50': p50,
+        'p99': float(np.percentile(timings, 99)),
+        'rays_per_sec': rays / p50 if p50 > 0 else 0.0,
+        'peak_memory_bytes': int(peak)
+    }
+
+
+def case_id(benchmark: str, params: Dict) -> str:
+    """ベースラインとの突き合わせに使うケースID"""
+    encoded = ','.join(f'{key}={params[key]}' for key in sorted(params))
+    return f'{benchmark}[{encoded}]'
+
+
+class BenchmarkRunner:
+    """各ベンチマークのスイープと結果の収集"""
+
+    def __init__(self, db_path: str, profile: Dict, selected: List[str], seed: int = 0):
+        self.db_path = db_path
+        self.profile = profile
+        self.selected = selected
+        self.seed = seed
+        self.simulator = KaleidoscopeSimulator(db_path, async_writes=False)
+        self.flask_module = None
+        self.results = []
+
+    def run(self) -> List[Dict]:
+        for benchmark in self.selected:
+            getattr(self, f'bench_{benchmark}')()
+        return self.results
+
+    def close(self):
+        if self.flask_module is not None:
+            self.flask_module.simulator.flush_results(timeout=10.0)
+            if self.flask_module.simulator.result_writer is not None:
+                self.flask_module.simulator.result_writer.close()
+
+    def record(self, benchmark: str, params: Dict, func: Callable[[], None], rays: int):
+        metrics = measure(func, self.profile['repeat'], rays)
+        result = {'id': case_id(benchmark, params), 'benchmark': benchmark,
+                  'params': params, **metrics}
+        self.results.append(result)
+        print(f"{result['id']:<70} p50={metrics['p50'] * 1e3:9.3f}ms "
+              f"p99={metrics['p99'] * 1e3:9.3f}ms {metrics['rays_per_sec']:12.0f} rays/s "
+              f"peak={metrics['peak_memory_bytes'] / 1024:9.1f}KiB", file=sys.stderr)
+
+    def sample_rays(self, count: int, config_id: int) -> List[Ray]:
+        """設定の光源から初期光線を生成"""
+        prepared = self.simulator.prepare_config(config_id)
+        return self.simulator.generate_initial_rays(prepared['config'], count,
+                                                    rng=np.random.default_rng(self.seed))
+
+    def scalar_ray_counts(self) -> List[int]:
+        return [count for count in self.profile['ray_counts'] if count <= SCALAR_RAY_LIMIT]
+
+    def bench_fresnel_coefficients(self):
+        engine = self.simulator.engine
+        for count in self.profile['ray_counts']:
+            angles = np.linspace(0.0, np.pi / 2, count, endpoint=False).tolist()
+
+            def func():
+                for theta in angles:
+                    engine.fresnel_coefficients(1.0, 1.5, theta)
+
+            self.record('fresnel_coefficients', {'rays': count}, func, count)
+
+    def bench_reflection_attenuation(self):
+        prepared = self.simulator.prepare_config(self.profile['mirror_counts'][0])
+        engine = prepared['engine']
+        material_id = prepared['surfaces'][0].material_id
+        for count in self.profile['ray_counts']:
+            material_ids = np.full(count, material_id)
+            cos_theta_i = np.linspace(0.0, 1.0, count)
+            s_component = np.full(count, 0.5)
+            p_component = np.full(count, 0.5)
+            wavelengths = np.linspace(380.0, 780.0, count)
+
+            def func():
+                engine.reflection_attenuation(material_ids, cos_theta_i, s_component,
+                                              p_component, wavelengths)
+
+            self.record('reflection_attenuation', {'rays': count}, func, count)
+
+    def bench_ray_surface_intersection(self):
+        mirror_count = self.profile['mirror_counts'][0]
+        for count in self.profile['ray_counts']:
+            rays = self.sample_rays(count, mirror_count)
+            engine = self.simulator.engine
+            surface = self.simulator.current_surfaces[0]
+
+            def func():
+                for ray in rays:
+                    engine.ray_surface_intersection(ray, surface)
+
+            self.record('ray_surface_intersection', {'rays': count}, func, count)
+
+    def bench_reflect_ray(self):
+        mirror_count = self.profile['mirror_counts'][0]
+        for count in self.profile['ray_counts']:
+            rays = self.sample_rays(count, mirror_count)
+            engine = self.simulator.engine
+            surface = self.simulator.current_surfaces[0]
+
+            def func():
+                rng = np.random.default_rng(self.seed)
+                for ray in rays:
+                    engine.reflect_ray(ray, surface, rng)
+
+            self.record('reflect_ray', {'rays': count}, func, count)
+
+    def bench_trace_ray(self):
+        for mirror_count in self.profile['mirror_counts']:
+            for max_bounces in self.profile['bounce_limits']:
+                for count in self.scalar_ray_counts():
+                    rays = self.sample_rays(count, mirror_count)
+                    engine = self.simulator.engine
+                    surfaces = self.simulator.current_surfaces
+
+                    def func():
+                        rng = np.random.default_rng(self.seed)
+                        for ray in rays:
+                            engine.trace_ray(ray, surfaces, max_bounces, rng=rng)
+
+                    self.record('trace_ray', {'rays': count, 'bounces': max_bounces,
+                                              'mirrors': mirror_count}, func, count)
+
+    def bench_trace_rays(self):
+        for mirror_count in self.profile['mirror_counts']:
+            prepared = self.simulator.prepare_config(mirror_count)
+            for max_bounces in self.profile['bounce_limits']:
+                for count in self.profile['ray_counts']:
+                    initial = self.simulator.generate_initial_ray_arrays(
+                        prepared['config'], count, rng=np.random.default_rng(self.seed))
+                    engine = prepared['engine']
+                    surfaces = prepared['surfaces']
+
+                    def func():
+                        engine.trace_rays(initial['origins'], initial['directions'],
+                                          initial['wavelengths'], initial['intensities'],
+                                          surfaces, max_bounces, rng=np.random.default_rng(self.seed))
+
+                    self.record('trace_rays', {'rays': count, 'bounces': max_bounces,
+                                               'mirrors': mirror_count}, func, count)
+
+    def bench_replay_path_geometry(self):
+        # 記録済みの幾何に別の波長の減衰を適用する（trace_rays との差が幾何の再利用の効果）
+        for mirror_count in self.profile['mirror_counts']:
+            prepared = self.simulator.prepare_config(mirror_count)
+            for max_bounces in self.profile['bounce_limits']:
+                for count in self.profile['ray_counts']:
+                    initial = self.simulator.generate_initial_ray_arrays(
+                        prepared['config'], count, rng=np.random.default_rng(self.seed))
+                    engine = prepared['engine']
+                    surfaces = prepared['surfaces']
+                    geometry = PathGeometry.create(initial['origins'], initial['directions'],
+                                                   max_bounces, np.random.default_rng(self.seed))
+                    replay_path_geometry(engine, geometry, surfaces, initial['wavelengths'],
+                                         initial['intensities'])
+                    wavelengths = initial['wavelengths'] + 100.0
+
+                    def func():
+                        replay_path_geometry(engine, geometry, surfaces, wavelengths,
+                                             initial['intensities'])
+
+                    self.record('replay_path_geometry', {'rays': count, 'bounces': max_bounces,
+                                                         'mirrors': mirror_count}, func, count)
+
+    def bench_trace_rays_unfolded(self):
+        for mirror_count in self.profile['mirror_counts']:
+            prepared = self.simulator.prepare_config(mirror_count)
+            group = prepared['mirror_group']
+            if group is None:
+                # 鏡映で展開できない配置（5面以上）は対象外
+                continue
+            for max_bounces in self.profile['bounce_limits']:
+                for count in self.profile['ray_counts']:
+                    initial = self.simulator.generate_initial_ray_arrays(
+                        prepared['config'], count, rng=np.random.default_rng(self.seed))
+                    engine = prepared['engine']
+                    surfaces = prepared['surfaces']
+
+                    def func():
+                        trace_rays_unfolded(engine, initial['origins'], initial['directions'],
+                                            initial['wavelengths'], initial['intensities'],
+                                            surfaces, group, max_bounces)
+
+                    self.record('trace_rays_unfolded', {'rays': count, 'bounces': max_bounces,
+                                                        'mirrors': mirror_count}, func, count)
+
+    def bench_trace_rays_facets(self):
+        """ミラーの内側に有限の三角形ファセットを散らした構成（総当たりと BVH）"""
+        mirror_count = self.profile['mirror_counts'][0]
+        prepared = self.simulator.prepare_config(mirror_count)
+        engine = prepared['engine']
+        max_bounces = self.profile['bounce_limits'][-1]
+
+        for facet_count in self.profile['facet_counts']:
+            rng = np.random.default_rng(self.seed)
+            centers = rng.uniform([-0.6, -0.6, -2.0], [0.6, 0.6, 0.0], (facet_count, 3))
+            facets = [Surface.polygon(center + rng.normal(scale=0.1, size=(3, 3)), 1)
+                      for center in centers]
+            surfaces = prepared['surfaces'] + facets
+            accelerator = SurfaceBVH.build(surfaces)
+
+            for count in self.profile['ray_counts']:
+                initial = self.simulator.generate_initial_ray_arrays(
+                    prepared['config'], count, rng=np.random.default_rng(self.seed))
+                # 強度の打ち切りで反射が止まらないよう1本あたりの強度をそろえる
+                intensities = np.ones(count)
+
+                for accelerated in (False, True):
+                    if not accelerated and count * len(surfaces) > BRUTE_FORCE_PAIR_LIMIT:
+                        continue
+
+                    def func():
+                        engine.trace_rays(initial['origins'], initial['directions'],
+                                          initial['wavelengths'], intensities, surfaces,
+                                          max_bounces, rng=np.random.default_rng(self.seed),
+                                          accelerator=accelerator if accelerated else None)
+
+                    self.record('trace_rays_facets', {'rays': count, 'bounces': max_bounces,
+                                                      'facets': facet_count,
+                                                      'bvh': accelerated}, func, count)
+
+    def bench_generate_initial_rays(self):
+        config = self.simulator.prepare_config(self.profile['mirror_counts'][0])['config']
+        for sampling in SamplingMode:
+            for count in self.profile['ray_counts']:
+                def func():
+                    self.simulator.generate_initial_rays(
+                        config, count, rng=np.random.default_rng(self.seed), sampling=sampling)
+
+                self.record('generate_initial_rays', {'rays': count, 'sampling': sampling.value},
+                            func, count)
+
+    def bench_create_pattern_visualization_data(self):
+        max_bounces = max(self.profile['bounce_limits'])
+        for mirror_count in self.profile['mirror_counts']:
+            for count in self.profile['ray_counts']:
+                ray_paths = self.simulator.run_simulation(
+                    mirror_count, count, max_bounces, seed=self.seed)['ray_paths']
+
+                def func():
+                    self.simulator.create_pattern_visualization_data(ray_paths)
+
+                self.record('create_pattern_visualization_data',
+                            {'rays': count, 'mirrors': mirror_count}, func, len(ray_paths))
+
+    def bench_api_simulate(self):
+        if self.flask_module is None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.flask_module = load_flask_app(self.db_path)
+        client = self.flask_module.app.test_client()
+
+        for mirror_count in self.profile['mirror_counts']:
+            for max_bounces in self.profile['bounce_limits']:
+                for count in self.profile['ray_counts']:
+                    # seed を付けないので結果キャッシュは使われない
+                    body = {'config_id': mirror_count, 'num_rays': count,
+                            'max_bounces': max_bounces}
+
+                    def func():
+                        response = client.post('/api/simulate', json=body)
+                        if response.status_code != 200:
+                            raise RuntimeError(f'/api/simulate failed: {response.get_data(as_text=True)}')
+
+                    self.record('api_simulate', {'rays': count, 'bounces': max_bounces,
+                                                 'mirrors': mirror_count}, func, count)
+
+
+def compare_results(results: List[Dict], baseline: Dict, threshold: float,
+                    memory_threshold: float) -> Dict:
+    """
+    ベースラインと比較して性能の劣化を検出
+
+    Args:
+        results: 今回の計測結果
+        baseline: 以前に保存したベンチマーク結果 (JSON)
+        threshold: p50 レイテンシの許容増加率
+        memory_threshold: ピークメモリの許容増加率
+
+    Returns:
+        ケースごとの比較と劣化したケースの一覧
+    """
+    baseline_cases = {case['id']: case for case in baseline.get('results', [])}
+    cases = []
+    regressions = []
+
+    for result in results:
+        base = baseline_cases.get(result['id'])
+        if base is None:
+            continue
+
+        time_ratio = result['p50'] / base['p50'] if base['p50'] > 0 else 1.0
+        memory_ratio = (result['peak_memory_bytes'] / base['peak_memory_bytes']
+                        if base['peak_memory_bytes'] > 0 else 1.0)
+        regressed = []
+        if time_ratio > 1.0 + threshold:
+            regressed.append('p50')
+        if memory_ratio > 1.0 + memory_threshold:
+            regressed.append('peak_memory')
+
+        case = {
+            'id': result['id'],
+            'baseline_p50': base['p50'],
+            'p50': result['p50'],
+            'time_ratio': time_ratio,
+            'baseline_peak_memory_bytes': base['peak_memory_bytes'],
+            'peak_memory_bytes': result['peak_memory_bytes'],
+            'memory_ratio': memory_ratio,
+            'regressed': regressed
+        }
+        cases.append(case)
+        if regressed:
+            regressions.append(case)
+
+    return {
+        'threshold': threshold,
+        'memory_threshold': memory_threshold,
+        'compared': len(cases),
+        'missing': sorted(set(baseline_cases) - {result['id'] for result in results}),
+        'cases': cases,
+        'regressions': regressions
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='光学エンジンとシミュレーターのベンチマーク')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='quick',
+                        help='スイープの規模')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, metavar='NAME',
+                        help=f'実行するベンチマーク ({", ".join(BENCHMARKS)})')
+    parser.add_argument('--rays', type=int, nargs='+', help='光線数のスイープを上書き')
+    parser.add_argument('--bounces', type=int, nargs='+', help='最大反射回数のスイープを上書き')
+    parser.add_argument('--mirrors', type=int, nargs='+', help='ミラー数のスイープを上書き')
+    parser.add_argument('--repeat', type=int, help='計時の回数を上書き')
+    parser.add_argument('--seed', type=int, default=0, help='乱数シード')
+    parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    parser.add_argument('--compare', metavar='BASELINE', help='比較するベースラインのJSONファイル')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='劣化とみなす p50 の増加率（既定 0.15 = 15%%）')
+    parser.add_argument('--memory-threshold', type=float, default=0.25,
+                        help='劣化とみなすピークメモリの増加率（既定 0.25 = 25%%）')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+
+    profile = dict(PROFILES[args.profile])
+    for key, value in (('ray_counts', args.rays), ('bounce_limits', args.bounces),
+                       ('mirror_counts', args.mirrors), ('repeat', args.repeat)):
+        if value:
+            profile[key] = value
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    temp_dir = tempfile.mkdtemp(prefix='kaleidoscope-bench-')
+    db_path = os.path.join(temp_dir, 'benchmark.db')
+    create_benchmark_database(db_path, profile['mirror_counts'])
+
+    runner = BenchmarkRunner(db_path, profile, list(args.only or BENCHMARKS), seed=args.seed)
+    try:
+        results = runner.run()
+    finally:
+        runner.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    report = {
+        'created_at': datetime.now().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count()
+        },
+        'profile': args.profile,
+        'sweep': profile,
+        'seed': args.seed,
+        'results': results
+    }
+
+    exit_code = 0
+    if baseline is not None:
+        comparison = compare_results(results, baseline, args.threshold, args.memory_threshold)
+        report['comparison'] = comparison
+        print(f"\nCompared {comparison['compared']} cases against {args.compare}", file=sys.stderr)
+        for case in comparison['cases']:
+            flag = 'REGRESSION' if case['regressed'] else 'ok'
+            print(f"{case['id']:<70} time x{case['time_ratio']:.2f} "
+                  f"memory x{case['memory_ratio']:.2f} {flag}", file=sys.stderr)
+        if comparison['regressions']:
+            print(f"{len(comparison['regressions'])} regression(s) detected", file=sys.stderr)
+            exit_code = 1
+
+    if args.output:
+        output_dir = os.path.dirname(os.path.abspath(args.output))
+        os.makedirs(output_dir, exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
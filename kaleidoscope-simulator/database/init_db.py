@@ -1,8 +1,13 @@
 
 import sqlite3
 import os
+import sys
 from datetime import datetime
 
+# simulation_jobs のスキーマはジョブキュー（app/models/job_queue.py）と共有する
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+from models.job_queue import CREATE_JOBS_TABLE_SQL, CREATE_JOBS_INDEX_SQL  # noqa: E402
+
 class KaleidoscopeDatabase:
     def __init__(self, db_path="database/kaleidoscope.db"):
         self.db_path = db_path
@@ -15,6 +20,13 @@ class KaleidoscopeDatabase:
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
 
+            # 同時読み書きと書き込み性能のためのPRAGMA設定
+            # journal_mode=WAL はDBファイルに保存され、以降の接続にも適用される
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA wal_autocheckpoint=1000")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+
             # kaleidoscope_configs テーブル
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS kaleidoscope_configs (
@@ -45,6 +57,18 @@ class KaleidoscopeDatabase:
                 )
             """)
 
+            # config_surfaces テーブル（ミラー以外の有限の反射面）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS config_surfaces (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    config_id INTEGER,
+                    vertices TEXT NOT NULL, -- 凸多角形の頂点 [[x, y, z], ...] のJSON配列
+                    material_id INTEGER NOT NULL,
+                    FOREIGN KEY (config_id) REFERENCES kaleidoscope_configs (id),
+                    FOREIGN KEY (material_id) REFERENCES materials (id)
+                )
+            """)
+
             # materials テーブル
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS materials (
@@ -75,6 +99,17 @@ class KaleidoscopeDatabase:
                 )
             """)
 
+            # パフォーマンス履歴の取得用インデックス
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_simulation_results_timestamp
+                ON simulation_results (timestamp)
+            """)
+
+            # simulation_jobs テーブル（POST /api/jobs のオフライン描画ジョブ）と、ワーカーが
+            # 待機中のジョブを古い順に取り出すためのインデックス
+            cursor.execute(CREATE_JOBS_TABLE_SQL)
+            cursor.execute(CREATE_JOBS_INDEX_SQL)
+
             # user_presets テーブル（ユーザー設定保存用）
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS user_presets (
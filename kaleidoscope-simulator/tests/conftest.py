@@ -0,0 +1,44 @@
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import sys
+
+import pytest
+
+# app/ と database/ をインポートパスに追加（app.py・benchmarks と同じ models パッケージとして読み込む）
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+sys.path.insert(0, os.path.join(ROOT, 'database'))
+
+from init_db import KaleidoscopeDatabase  # noqa: E402
+from models.kaleidoscope_simulator import KaleidoscopeSimulator  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """既定の材料と設定ID 1（3枚ミラー・光源1つ）だけを持つ一時データベース"""
+    path = str(tmp_path / 'kaleidoscope.db')
+    with contextlib.redirect_stdout(io.StringIO()):
+        database = KaleidoscopeDatabase(path)
+        database.insert_default_materials()
+
+    with sqlite3.connect(path) as conn:
+        conn.execute("""
+            INSERT INTO kaleidoscope_configs
+            (id, name, mirror_count, mirror_angles, materials, physics_mode)
+            VALUES (1, 'Default Triangle', 3, ?, ?, 'dry')
+        """, (json.dumps([60, 60, 60]), json.dumps([1, 1, 1])))
+        conn.execute("""
+            INSERT INTO light_sources
+            (config_id, wavelength, intensity, position_x, position_y, position_z, type)
+            VALUES (1, 550.0, 1.0, 0.0, 0.0, 1.0, 'point')
+        """)
+    return path
+
+
+@pytest.fixture
+def simulator(db_path):
+    """結果を同期的に書き込むシミュレーター"""
+    return KaleidoscopeSimulator(db_path, async_writes=False)
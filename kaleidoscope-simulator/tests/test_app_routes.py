@@ -0,0 +1,67 @@
+import importlib.util
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def ksapp():
+    # app.py はパッケージではないため、ファイルから読み込む（インポートではDBに書き込まない）
+    spec = importlib.util.spec_from_file_location('ksapp', os.path.join(ROOT, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def client(ksapp, db_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(ksapp.simulator, 'db_path', db_path)
+    monkeypatch.setattr(ksapp.job_queue, 'result_dir', str(tmp_path / 'jobs'))
+    monkeypatch.setattr(ksapp.profile_store, 'directory', str(tmp_path / 'profiles'))
+    return ksapp.app.test_client()
+
+
+def test_invalid_job_request_is_400(client):
+    for body in ({'num_rays': 0}, {'solver': 'unknown'}, {'mirror_count': 1,
+                                                         'material_ids': [1]}):
+        response = client.post('/api/jobs', json=body)
+        assert response.status_code == 400, body
+        assert response.get_json()['success'] is False
+
+    assert client.get('/api/jobs?status=unknown').status_code == 400
+
+
+def test_job_is_accepted(client):
+    response = client.post('/api/jobs', json={'num_rays': 100})
+    assert response.status_code == 202
+    assert response.headers['Location'] == f"/api/jobs/{response.get_json()['job']['id']}"
+
+
+def test_profiling_is_opt_in(ksapp, client, monkeypatch):
+    response = client.post('/api/simulate?profile=1', json={'num_rays': 10, 'max_bounces': 2})
+    assert response.status_code == 200
+    assert 'X-Profile-Id' not in response.headers
+
+    monkeypatch.setattr(ksapp, 'PROFILING_ENABLED', True)
+    response = client.post('/api/simulate?profile=1', json={'num_rays': 10, 'max_bounces': 2})
+    profile_url = response.headers['X-Profile-Url']
+    assert client.get(profile_url).status_code == 200
+
+    monkeypatch.setattr(ksapp, 'PROFILING_ENABLED', False)
+    assert client.get(profile_url).status_code == 404
+
+
+def test_invalid_progressive_request_leaves_no_job(ksapp, client):
+    socket = ksapp.socketio.test_client(ksapp.app)
+    socket.get_received()
+    for options in ({'policy': 'unknown'}, {'solver': 'unknown'}, {'sampling': 'unknown'},
+                    {'color_mode': 'unknown'}, {'survival_probability': 0},
+                    {'spectral_samples': -1}):
+        socket.emit('progressive_simulation', dict(options, target_rays=100))
+        errors = [message for message in socket.get_received()
+                  if message['name'] == 'simulation_error']
+        assert errors, options
+    assert not ksapp.progressive_jobs
+    socket.disconnect()
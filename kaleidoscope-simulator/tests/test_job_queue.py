@@ -0,0 +1,129 @@
+import json
+import time
+
+import numpy as np
+import pytest
+
+from models.job_queue import SimulationJobQueue, job_parameters
+
+
+@pytest.fixture
+def job_queue(simulator, tmp_path):
+    # ワーカーは起動せず、run_next で1件ずつ実行する
+    return SimulationJobQueue(simulator, str(tmp_path / 'jobs'), workers=0)
+
+
+def test_job_parameters_validation():
+    parameters = job_parameters({'num_rays': 1000})
+    assert parameters['config_id'] == 1
+    assert isinstance(parameters['seed'], int)
+    assert parameters['batch_size'] == 1000
+
+    for invalid in ({'num_rays': 0}, {'max_bounces': -1}, {'batch_size': 0},
+                    {'solver': 'unknown'}, {'spectral_samples': 10000}, {'width': 0},
+                    {'height': 5000}, {'extent': 0}):
+        with pytest.raises(ValueError):
+            job_parameters(invalid)
+
+
+def test_completed_job_matches_run_simulation(simulator, job_queue):
+    job = job_queue.submit({'num_rays': 3000, 'max_bounces': 5, 'seed': 7, 'batch_size': 1000,
+                            'store_rays': True})
+    assert job['status'] == 'queued'
+    assert job_queue.result_path(job['id']) is None
+
+    assert job_queue.run_next() == job['id']
+    assert job_queue.run_next() is None
+
+    job = job_queue.get(job['id'])
+    assert job['status'] == 'completed'
+    assert job['traced_rays'] == 3000
+    assert job['progress'] == 1.0
+
+    with np.load(job_queue.result_path(job['id'])) as result:
+        metadata = json.loads(str(result['metadata']))
+        rays_total = result['rays_intensities'].sum()
+        path_index = result['rays_path_index']
+        assert result['rays_origins'].shape == (job['performance']['ray_count'], 3)
+        assert result['pattern_image'].shape == (512, 512, 3)
+        assert result['pattern_image'].dtype == np.uint8
+        assert result['pattern_accumulation'].sum() > 0
+    assert metadata['parameters']['seed'] == 7
+    # path_index はバッチをまたいだ初期光線の通し番号
+    np.testing.assert_array_equal(np.unique(path_index), np.arange(3000))
+    # 強度は同じ光線数の run_simulation と同じ尺度
+    reference = simulator.run_simulation(1, 3000, 5, seed=7, save=False)
+    assert rays_total == pytest.approx(reference['ray_paths'].total_intensity(), rel=0.05)
+
+
+def test_cancel(job_queue):
+    queued = job_queue.submit({'num_rays': 1000})
+    assert job_queue.cancel(queued['id'])['status'] == 'cancelled'
+    assert job_queue.run_next() is None
+    assert job_queue.cancel('missing') is None
+
+
+def test_cancel_running_job_stops_after_batch(job_queue):
+    job = job_queue.submit({'num_rays': 5000, 'batch_size': 1000})
+    job_queue.on_batch = lambda *args: job_queue.cancel(job['id'])
+
+    job_queue.run_next()
+    job = job_queue.get(job['id'])
+    assert job['status'] == 'cancelled'
+    assert job['traced_rays'] == 1000
+    assert job_queue.result_path(job['id']) is None
+
+
+def test_result_memory_does_not_grow_with_rays(job_queue):
+    import tracemalloc
+
+    peaks = []
+    for num_rays in (4000, 16000):
+        job = job_queue.submit({'num_rays': num_rays, 'batch_size': 1000, 'store_rays': True,
+                                'width': 64, 'height': 64})
+        tracemalloc.start()
+        job_queue.run_next()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert job_queue.get(job['id'])['status'] == 'completed'
+
+    # 全バッチの光線とパターンを保持すると4倍の光線数で約4倍になる
+    assert peaks[1] < peaks[0] * 1.5
+
+
+def test_stale_running_job_is_claimed_again(job_queue):
+    job = job_queue.submit({'num_rays': 100})
+    claimed = job_queue._claim()
+    assert claimed['id'] == job['id']
+    assert job_queue._claim() is None
+
+    job_queue.stale_timeout = 0.0
+    time.sleep(0.01)
+    assert job_queue.run_next() == job['id']
+    job = job_queue.get(job['id'])
+    assert job['status'] == 'completed'
+    assert job['attempts'] == 2
+
+
+def test_worker_uses_the_database_only_inside_the_pool(simulator, tmp_path):
+    class RecordingPool:
+        running = False
+
+        def run(self, func, *args, **kwargs):
+            self.running = True
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.running = False
+
+    pool = RecordingPool()
+    job_queue = SimulationJobQueue(simulator, str(tmp_path / 'jobs'), workers=0, pool=pool)
+    job = job_queue.submit({'num_rays': 1000, 'batch_size': 500})
+
+    # eventlet では pool の外の sqlite3 の呼び出しがイベントループを止める
+    connect = job_queue._connect
+    inside = []
+    job_queue._connect = lambda: inside.append(pool.running) or connect()
+    assert job_queue.run_next() == job['id']
+    assert job_queue.run_next() is None
+    assert inside and all(inside)
@@ -0,0 +1,55 @@
+import numpy as np
+
+from models.parallel_tracer import trace_rays_parallel
+
+
+def trace(simulator, max_bounces, num_rays=400, workers=2, seed=3):
+    prepared = simulator.prepare_config(1)
+    initial = simulator.generate_initial_ray_arrays(
+        prepared['config'], num_rays, rng=np.random.default_rng(seed))
+    return trace_rays_parallel(prepared['engine'], initial, prepared['surfaces'], max_bounces,
+                               workers, seed=seed, accelerator=prepared['accelerator'])
+
+
+def test_large_max_bounces_allocates_only_traced_rows(simulator):
+    # 最大反射回数分を先に確保すると 400 × 200001 行（数GB）になる
+    deep = trace(simulator, max_bounces=200000)
+    shallow = trace(simulator, max_bounces=50)
+
+    assert len(deep) == len(shallow)
+    assert int(deep.bounce.max()) < 50
+    np.testing.assert_array_equal(deep.path_index, shallow.path_index)
+    np.testing.assert_array_equal(deep.origins, shallow.origins)
+    np.testing.assert_array_equal(deep.intensities, shallow.intensities)
+
+
+def test_path_index_is_global(simulator):
+    ray_buffer = trace(simulator, max_bounces=10, num_rays=101, workers=3)
+
+    np.testing.assert_array_equal(np.unique(ray_buffer.path_index), np.arange(101))
+
+
+def test_concurrent_requests_with_growing_workers_share_the_pool(simulator):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from models.parallel_tracer import get_executor
+
+    executor = get_executor()
+    # ワーカー数の多い要求が、投入中の他の要求のプールを停止しない
+    with ThreadPoolExecutor(4) as threads:
+        results = list(threads.map(lambda workers: len(trace(simulator, 10, workers=workers)),
+                                   [1, 2, 3, 4, 6, 8]))
+
+    assert all(count > 0 for count in results)
+    assert get_executor() is executor
+
+
+def test_bounce_column_holds_more_than_int16():
+    from models.optical_engine import RayBuffer
+
+    bounce = np.array([0, 32767, 32768, 200000])
+    ray_buffer = RayBuffer(origins=np.zeros((4, 3)), directions=np.zeros((4, 3)),
+                           wavelengths=np.zeros(4), intensities=np.zeros(4),
+                           polarizations=np.zeros((4, 2)), path_index=np.zeros(4),
+                           bounce=bounce)
+    np.testing.assert_array_equal(ray_buffer.bounce, bounce)
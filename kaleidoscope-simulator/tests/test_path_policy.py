@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from models.optical_engine import ROULETTE_THRESHOLD, PathPolicy
+
+
+def trace(simulator, policy, num_rays=2000, max_bounces=80, seed=2):
+    prepared = simulator.prepare_config(1)
+    initial = simulator.generate_initial_ray_arrays(
+        prepared['config'], num_rays, rng=np.random.default_rng(seed))
+    # 閾値 0.01 で初期光線が打ち切られないよう、1本あたりの強度を1にする
+    initial['intensities'] = np.ones(num_rays)
+    return prepared['engine'].trace_rays(**initial, surfaces=prepared['surfaces'],
+                                         max_bounces=max_bounces,
+                                         rng=np.random.default_rng(seed),
+                                         accelerator=prepared['accelerator'], policy=policy)
+
+
+def test_roulette_preserves_mean_intensity(simulator):
+    threshold = trace(simulator, PathPolicy.THRESHOLD)
+    roulette = trace(simulator, PathPolicy.ROULETTE)
+
+    assert len(roulette) < len(threshold)
+    assert roulette.intensities.sum() / 2000 == pytest.approx(
+        threshold.intensities.sum() / 2000, rel=0.01)
+
+
+def test_roulette_uses_the_same_scatter_lobe(simulator):
+    threshold = trace(simulator, PathPolicy.THRESHOLD)
+    roulette = trace(simulator, PathPolicy.ROULETTE)
+
+    # ロシアンルーレットが始まる前の反射は同じ乱数から同じ方向に散乱する
+    first_roll = int(threshold.bounce[threshold.intensities < ROULETTE_THRESHOLD].min())
+    assert first_roll > 10
+    early_threshold = threshold.bounce < first_roll
+    early_roulette = roulette.bounce < first_roll
+    np.testing.assert_array_equal(roulette.directions[early_roulette],
+                                  threshold.directions[early_threshold])
+    np.testing.assert_array_equal(roulette.intensities[early_roulette],
+                                  threshold.intensities[early_threshold])
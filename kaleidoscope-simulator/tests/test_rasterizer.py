@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from models.rasterizer import PatternRasterizer, parse_tile
+
+
+def test_parse_tile_accepts_tiles_inside_the_image():
+    assert parse_tile({'x': 0, 'y': 0, 'width': 512, 'height': 512}, 512, 512) == (0, 0, 512, 512)
+    assert parse_tile({'x': '256', 'y': 128, 'width': 256, 'height': 1}, 512, 512) == (256, 128, 256, 1)
+
+
+@pytest.mark.parametrize('tile', [
+    {'x': -1, 'y': 0, 'width': 10, 'height': 10},
+    {'x': 0, 'y': -5, 'width': 10, 'height': 10},
+    {'x': 500, 'y': 0, 'width': 20, 'height': 10},
+    {'x': 0, 'y': 0, 'width': 0, 'height': 10},
+    {'x': 0, 'y': 0, 'width': 10, 'height': -3},
+    {'x': 600, 'y': 600, 'width': 1, 'height': 1},
+    {'x': 0, 'y': 0, 'width': 10},
+    {'x': 'a', 'y': 0, 'width': 10, 'height': 10},
+    [0, 0, 10, 10],
+])
+def test_parse_tile_rejects_invalid_tiles(tile):
+    with pytest.raises(ValueError):
+        parse_tile(tile, 512, 512)
+
+
+def test_encode_png_tile_size():
+    rasterizer = PatternRasterizer(64, 32)
+    rasterizer.accumulate({
+        'x': np.zeros(4), 'y': np.zeros(4), 'intensity': np.ones(4),
+        'rgb': np.ones((4, 3)), 'wavelength': np.full(4, 550.0)
+    }, 3)
+
+    _, size = rasterizer.encode_png(parse_tile({'x': 60, 'y': 0, 'width': 4, 'height': 32}, 64, 32))
+    assert size == (4, 32)
+    payload, size = rasterizer.encode_raw(parse_tile({'x': 1, 'y': 2, 'width': 3, 'height': 5}, 64, 32))
+    assert size == (3, 5)
+    assert len(payload) == 3 * 5 * 3
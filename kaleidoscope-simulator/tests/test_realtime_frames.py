@@ -0,0 +1,157 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from models.frame_scheduler import FrameMailbox
+from models.optical_engine import ColorMode, OpticalEngine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# eventlet のモンキーパッチはプロセス全体に影響するため、別プロセスで app.py を読み込む
+EVENTLET_PRELUDE = """
+import eventlet
+eventlet.monkey_patch()
+
+import importlib.util
+import json
+import os
+import sys
+import time
+
+root, db_path, messages = sys.argv[1], sys.argv[2], int(sys.argv[3])
+sys.path.insert(0, os.path.join(root, 'app'))
+spec = importlib.util.spec_from_file_location('ksapp', os.path.join(root, 'app.py'))
+ksapp = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ksapp)
+ksapp.simulator.db_path = db_path
+assert ksapp.socketio.async_mode == 'eventlet'
+
+client = ksapp.socketio.test_client(ksapp.app)
+client.get_received()
+"""
+
+EVENTLET_SCRIPT = EVENTLET_PRELUDE + """
+for index in range(messages):
+    if index == 0:
+        client.emit('realtime_simulation', {'num_rays': 3000, 'max_bounces': 5, 'seed': 1})
+    else:
+        client.emit('realtime_simulation', {'delta': {'num_rays': 3000 + index}})
+    # スライダー操作と同じく 200 件/秒 で送る（送信の間は hub がフレームを処理する）
+    eventlet.sleep(0.005)
+
+mailbox = next(iter(ksapp.realtime_clients.values())).mailbox
+for _ in range(600):
+    eventlet.sleep(0.05)
+    if not mailbox._busy:
+        break
+
+frames = [message['args'][0] for message in client.get_received()
+          if message['name'] == 'simulation_result']
+print(json.dumps({
+    'stats': mailbox.stats(),
+    'frames': len(frames),
+    'last_initial_rays': frames[-1]['performance']['initial_rays'] if frames else None
+}))
+"""
+
+PROGRESSIVE_SCRIPT = EVENTLET_PRELUDE + """
+# hub が止まっていないかを 10ms ごとに起きる green thread の遅れで測る
+gaps = []
+def heartbeat():
+    while True:
+        start = time.monotonic()
+        eventlet.sleep(0.01)
+        gaps.append(time.monotonic() - start)
+eventlet.spawn(heartbeat)
+
+for index in range(messages):
+    client.emit('progressive_simulation', {'num_rays': 500, 'max_bounces': 30, 'seed': index, 'policy': 'roulette',
+                                           'target_rays': 60000, 'batch_size': 500,
+                                           'width': 64, 'height': 64})
+    eventlet.sleep(0.005)
+
+progressive = next(iter(ksapp.realtime_clients.values())).progressive
+for _ in range(1200):
+    eventlet.sleep(0.05)
+    if not progressive._busy:
+        break
+
+passes = [message['args'][0] for message in client.get_received()
+          if message['name'] == 'simulation_progress']
+print(json.dumps({
+    'stats': progressive.stats(),
+    'last': {key: passes[-1][key] for key in ('samples', 'target_samples', 'done')},
+    'max_gap': max(gaps)
+}))
+"""
+
+
+def run_eventlet_script(script, db_path, messages):
+    environment = dict(os.environ, REALTIME_MAX_FPS='30', JOB_WORKERS='0')
+    completed = subprocess.run(
+        [sys.executable, '-c', script, ROOT, db_path, str(messages)],
+        capture_output=True, text=True, timeout=300, env=environment)
+    assert completed.returncode == 0, completed.stderr
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def test_frames_are_coalesced_under_eventlet(db_path):
+    pytest.importorskip('eventlet')
+    messages = 40
+    result = run_eventlet_script(EVENTLET_SCRIPT, db_path, messages)
+
+    stats = result['stats']
+    assert stats['received'] == messages
+    assert stats['coalesced'] >= messages // 4
+    assert stats['frames'] == result['frames'] == messages - stats['coalesced']
+    # 最後のフレームは最後の差分を反映している
+    assert result['last_initial_rays'] == 3000 + messages - 1
+
+
+def test_progressive_requests_are_coalesced_off_the_hub(db_path):
+    pytest.importorskip('eventlet')
+    messages = 20
+    result = run_eventlet_script(PROGRESSIVE_SCRIPT, db_path, messages)
+
+    stats = result['stats']
+    assert stats['received'] == messages
+    assert stats['coalesced'] >= messages // 2
+    # 最後の要求の描画は中断されずに目標の光線数まで届く
+    assert result['last'] == {'samples': 60000, 'target_samples': 60000, 'done': True}
+    # バッチの追跡中も hub は他の green thread を動かし続ける
+    assert result['max_gap'] < 0.1
+
+
+def test_mailbox_keeps_latest_request():
+    mailbox = FrameMailbox(max_fps=0)
+    assert mailbox.post('first')
+    assert not mailbox.post('second')
+    assert not mailbox.post('third')
+    assert mailbox.take() == 'third'
+    assert mailbox.complete()
+    assert mailbox.take() is None
+
+    stats = mailbox.stats()
+    assert (stats['received'], stats['coalesced'], stats['frames']) == (3, 2, 1)
+
+
+def test_projection_does_not_use_the_shared_engine(simulator):
+    from concurrent.futures import ThreadPoolExecutor
+
+    ray_paths = simulator.run_simulation(1, 2000, 5, seed=3, save=False, spectral_samples=4)['ray_paths']
+    reference = simulator.project_pattern(ray_paths)
+    reference_colors = simulator.ray_colors(ray_paths)
+
+    # 別の要求の prepare_config が self.engine を差し替えても投影の結果は変わらない
+    simulator.engine = OpticalEngine(color_mode=ColorMode.CIE1931)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        projections = list(executor.map(lambda _: simulator.project_pattern(ray_paths), range(8)))
+
+    for projected in projections:
+        for key, values in reference.items():
+            np.testing.assert_array_equal(projected[key], values)
+    np.testing.assert_array_equal(simulator.ray_colors(ray_paths), reference_colors)
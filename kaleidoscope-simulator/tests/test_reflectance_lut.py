@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from models import reflectance_lut
+from models.reflectance_lut import (LUT_TOLERANCE, WAVELENGTH_RANGE, WET_REFLECTANCE_FACTOR,
+                                    ReflectanceTable, fresnel_reflectance, get_reflectance_table)
+
+# (反射率, 屈折率, 吸収係数, ウェットモード)
+MATERIALS = [
+    pytest.param(0.95, 0.05, 0.001, False, id='silver-total-reflection-edge'),
+    pytest.param(0.9, 1.52, 0.005, False, id='glass'),
+    pytest.param(0.92, 0.47, 0.003, True, id='gold-wet'),
+    pytest.param(0.95, 1.44, 0.002, True, id='wet-clipped'),
+]
+
+
+def exact_attenuation(reflectance, refractive_index, absorption_coefficient, wet,
+                      cos_theta_i, s_component, p_component, wavelengths):
+    """reflect_ray と同じ厳密な式"""
+    rs, rp = fresnel_reflectance(cos_theta_i, refractive_index)
+    value = reflectance * (rs * s_component + rp * p_component)
+    if wet:
+        value = np.minimum(1.0, value * WET_REFLECTANCE_FACTOR)
+    return value * np.exp(-absorption_coefficient * wavelengths / 1000.0)
+
+
+def random_inputs(count=20000, seed=7):
+    rng = np.random.default_rng(seed)
+    cos_theta_i = rng.random(count)
+    s_component = rng.random(count)
+    # 範囲外の波長も含める
+    low, high = WAVELENGTH_RANGE
+    wavelengths = rng.uniform(low - 200.0, high + 200.0, count)
+    return cos_theta_i, s_component, 1.0 - s_component, wavelengths
+
+
+@pytest.mark.parametrize('reflectance,refractive_index,absorption_coefficient,wet', MATERIALS)
+def test_attenuation_matches_exact_formula(reflectance, refractive_index,
+                                           absorption_coefficient, wet):
+    table = ReflectanceTable.build(reflectance, refractive_index, absorption_coefficient, wet)
+    inputs = random_inputs()
+    exact = exact_attenuation(reflectance, refractive_index, absorption_coefficient, wet, *inputs)
+
+    assert table.max_error <= 2 * LUT_TOLERANCE
+    np.testing.assert_allclose(table.attenuation(*inputs), exact, rtol=0, atol=2 * LUT_TOLERANCE)
+
+
+@pytest.mark.parametrize('reflectance,refractive_index,absorption_coefficient,wet', MATERIALS)
+def test_scalar_attenuation_matches_vectorized(reflectance, refractive_index,
+                                               absorption_coefficient, wet):
+    table = ReflectanceTable.build(reflectance, refractive_index, absorption_coefficient, wet)
+    inputs = random_inputs(count=2000)
+    vectorized = table.attenuation(*inputs)
+    scalar = [table.attenuation_scalar(*row) for row in zip(*(x.tolist() for x in inputs))]
+
+    np.testing.assert_allclose(scalar, vectorized, rtol=0, atol=1e-12)
+
+
+def test_total_reflection_edge():
+    table = ReflectanceTable.build(0.92, 0.47, 0.003)
+    critical_cos = np.sqrt(1.0 - 0.47**2)
+    cos_theta_i = critical_cos + np.array([-1e-9, 0.0, 1e-9, 1e-6, 1e-3])
+    ones = np.ones(len(cos_theta_i))
+    exact = exact_attenuation(0.92, 0.47, 0.003, False, cos_theta_i, ones, 0 * ones, 550 * ones)
+
+    np.testing.assert_allclose(table.attenuation(cos_theta_i, ones, 0 * ones, 550 * ones),
+                               exact, rtol=0, atol=2 * LUT_TOLERANCE)
+
+
+def test_tables_are_bounded_lru(monkeypatch):
+    monkeypatch.setattr(reflectance_lut, '_TABLES', type(reflectance_lut._TABLES)())
+    monkeypatch.setattr(reflectance_lut, 'MAX_CACHED_TABLES', 3)
+
+    first = get_reflectance_table(0.9, 1.5, 0.001)
+    for index in range(2):
+        get_reflectance_table(0.9, 1.5, 0.002 + index * 0.001)
+    # 最近使ったテーブルは残り、最も古いものから破棄される
+    assert get_reflectance_table(0.9, 1.5, 0.001) is first
+    get_reflectance_table(0.9, 1.5, 0.01)
+
+    assert len(reflectance_lut._TABLES) == 3
+    assert (0.9, 1.5, 0.002, False) not in reflectance_lut._TABLES
+    assert get_reflectance_table(0.9, 1.5, 0.001) is first
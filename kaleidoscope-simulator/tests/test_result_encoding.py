@@ -0,0 +1,50 @@
+import json
+import struct
+
+import numpy as np
+
+from models.optical_engine import RayBuffer, Surface
+from models.result_encoding import (encode_simulation_binary, HEADER_FORMAT, HEADER_SIZE, MAGIC,
+                                    VERSION, RAY_STRIDE, POINT_STRIDE, SURFACE_STRIDE)
+
+
+def decode(payload):
+    magic, version, _, data_offset, rays, points, surfaces, meta_length = struct.unpack_from(
+        HEADER_FORMAT, payload)
+    metadata = json.loads(payload[HEADER_SIZE:HEADER_SIZE + meta_length])
+    blocks = np.frombuffer(payload, dtype='<f4', offset=data_offset)
+    return magic, version, metadata, blocks, (rays, points, surfaces)
+
+
+def encode(metadata, rays=3, points=2):
+    ray_paths = RayBuffer(
+        origins=np.zeros((rays, 3)), directions=np.tile([0.0, 0.0, -1.0], (rays, 1)),
+        wavelengths=np.full(rays, 550.0), intensities=np.ones(rays),
+        polarizations=np.zeros((rays, 2)), path_index=np.arange(rays), bounce=np.zeros(rays))
+    projected = {
+        'x': np.arange(points, dtype=float), 'y': np.zeros(points), 'intensity': np.ones(points),
+        'rgb': np.ones((points, 3)), 'wavelength': np.full(points, 550.0)
+    }
+    surfaces = [Surface(point=np.zeros(3), normal=np.array([1.0, 0.0, 0.0]), material_id=1)]
+    return encode_simulation_binary(ray_paths, np.ones((rays, 3)), projected, surfaces, metadata)
+
+
+def test_roundtrip():
+    magic, version, metadata, blocks, counts = decode(encode({'performance': {'ray_count': 3}}))
+
+    assert (magic, version) == (MAGIC, VERSION)
+    assert metadata == {'performance': {'ray_count': 3}}
+    assert counts == (3, 2, 1)
+    assert len(blocks) == 3 * RAY_STRIDE + 2 * POINT_STRIDE + SURFACE_STRIDE
+    np.testing.assert_array_equal(blocks[3 * RAY_STRIDE:3 * RAY_STRIDE + 2 * POINT_STRIDE:POINT_STRIDE],
+                                  [0.0, 1.0])
+
+
+def test_metadata_larger_than_64kib():
+    large = {'performance': {'stages': {f'stage_{i}': 'x' * 64 for i in range(2000)}}}
+    payload = encode(large)
+    _, _, metadata, blocks, _ = decode(payload)
+
+    assert struct.unpack_from(HEADER_FORMAT, payload)[3] > 0xFFFF
+    assert metadata == large
+    assert len(blocks) == 3 * RAY_STRIDE + 2 * POINT_STRIDE + SURFACE_STRIDE
@@ -0,0 +1,71 @@
+import sqlite3
+import threading
+
+from models.result_writer import SimulationResultWriter
+
+
+def result_row(index):
+    return (1, '{}', index, 0.0, 0.0, 0.0)
+
+
+def test_flush_under_overflow_keeps_marker_position(db_path, monkeypatch):
+    gate = threading.Event()
+    later_gate = threading.Event()
+    writing = threading.Event()
+    write_batch = SimulationResultWriter._write_batch
+
+    def blocked_write_batch(self, conn, rows):
+        # 1件目は gate、それ以降は later_gate まで書き込みを止める
+        (later_gate if writing.is_set() else gate).wait(10)
+        writing.set()
+        write_batch(self, conn, rows)
+
+    monkeypatch.setattr(SimulationResultWriter, '_write_batch', blocked_write_batch)
+    writer = SimulationResultWriter(db_path, batch_size=1, max_queue_size=4,
+                                    overflow_policy='drop_oldest')
+    try:
+        # 1件目の書き込み中に後続の結果とマーカーを積む
+        writer.submit(result_row(0))
+        while writer._queue.qsize():
+            pass
+        writer.submit(result_row(1))
+        writer.submit(result_row(2))
+
+        flushed = []
+        flusher = threading.Thread(target=lambda: flushed.append(writer.flush(10)))
+        flusher.start()
+        while writer._queue.qsize() < 3:
+            pass
+
+        # キューがあふれ続けてもマーカーは捨てず、後ろにも回さない
+        for index in range(3, 40):
+            assert writer.submit(result_row(index))
+        items = list(writer._queue.queue)
+        assert isinstance(items[0], threading.Event)
+        assert sum(isinstance(item, threading.Event) for item in items) == 1
+        assert writer.dropped == 36
+
+        gate.set()
+        flusher.join(10)
+        assert flushed == [True]
+        # マーカーより前の結果（書き込み中だった1件）を書き込んだ時点で返る
+        assert writer.stats()['written'] == 1
+    finally:
+        gate.set()
+        later_gate.set()
+        writer.close()
+
+    with sqlite3.connect(db_path) as conn:
+        count, = conn.execute("SELECT COUNT(*) FROM simulation_results").fetchone()
+    assert count == writer.written == 4
+
+
+def test_drop_oldest_without_overflow_keeps_all_rows(db_path):
+    writer = SimulationResultWriter(db_path, batch_size=8, max_queue_size=64)
+    for index in range(20):
+        writer.submit(result_row(index))
+    assert writer.flush(10)
+    writer.close()
+
+    assert writer.written == 20
+    assert writer.dropped == 0